@@ -0,0 +1,100 @@
+# Production entry point; main.py is the development server with auto-reload.
+#
+#     cd app && python serve.py --workers 8
+#
+# Runs gunicorn with uvicorn workers when gunicorn is installed (preloading the
+# app in the master, so workers fork with it imported), and plain uvicorn
+# worker processes otherwise. Defaults come from the environment, see the
+# "Production server" settings in server/config.py.
+#
+# On SIGTERM the workers stop accepting connections, finish in-flight requests
+# for up to --graceful-timeout seconds and run the shutdown handlers, which
+# close the MongoDB client. GET /ready answers 503 until MongoDB has been
+# reached and the indexes are in place. A draining worker has already closed
+# its socket and idle connections, so readiness probes fail by not connecting
+# rather than with a 503; load balancers should treat both as not ready.
+import argparse
+import importlib.util
+
+import uvicorn
+
+from server import config
+
+APP = "server.app:app"
+
+
+def installed(module: str) -> bool:
+    return importlib.util.find_spec(module) is not None
+
+
+def run_gunicorn(args, loop: str, http: str):
+    from gunicorn.app.base import BaseApplication
+    from uvicorn.workers import UvicornWorker
+
+    class Worker(UvicornWorker):
+        CONFIG_KWARGS = {"loop": loop, "http": http}
+
+    class Application(BaseApplication):
+        def load_config(self):
+            options = {
+                "bind": "{}:{}".format(args.host, args.port),
+                "workers": args.workers,
+                "worker_class": Worker,
+                "keepalive": args.keepalive,
+                "backlog": args.backlog,
+                "graceful_timeout": args.graceful_timeout,
+                "preload_app": args.preload,
+                "max_requests": args.max_requests,
+                "max_requests_jitter": args.max_requests // 10,
+            }
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            from server.app import app
+            return app
+
+    Application().run()
+
+
+def run_uvicorn(args, loop: str, http: str):
+    uvicorn.run(
+        APP,
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+        loop=loop,
+        http=http,
+        backlog=args.backlog,
+        timeout_keep_alive=args.keepalive,
+        limit_max_requests=args.max_requests or None,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default=config.HOST)
+    parser.add_argument("--port", type=int, default=config.PORT)
+    parser.add_argument("--workers", type=int, default=config.WEB_CONCURRENCY)
+    parser.add_argument("--keepalive", type=int, default=config.KEEPALIVE_TIMEOUT)
+    parser.add_argument("--backlog", type=int, default=config.BACKLOG)
+    parser.add_argument("--graceful-timeout", type=int, default=config.GRACEFUL_TIMEOUT)
+    parser.add_argument("--max-requests", type=int, default=config.MAX_REQUESTS)
+    parser.add_argument("--preload", dest="preload", action="store_true", default=config.PRELOAD)
+    parser.add_argument("--no-preload", dest="preload", action="store_false")
+    parser.add_argument("--server", choices=["auto", "gunicorn", "uvicorn"], default="auto")
+    args = parser.parse_args()
+
+    loop = "uvloop" if installed("uvloop") else "asyncio"
+    http = "httptools" if installed("httptools") else "h11"
+    server = args.server
+    if server == "auto":
+        server = "gunicorn" if installed("gunicorn") else "uvicorn"
+    if server == "gunicorn":
+        run_gunicorn(args, loop, http)
+    else:
+        run_uvicorn(args, loop, http)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+import asyncio
+import time
+from datetime import datetime, timedelta
+
+from server import database
+from server.cache import MemoryBackend, ReadThroughCache
+from server.models.basket import Status
+
+# Reports are recomputed at most every ANALYTICS_TTL seconds, so dashboards
+# polling faster than that share one aggregation. Daily volume is refreshed
+# incrementally: past days are kept and only the current day is aggregated
+# again, with a full rebuild every DAILY_FULL_REFRESH seconds to pick up
+# deletions. Revenue and top products are built from the line totals, which a
+# background job keeps up to date (see line_totals).
+ANALYTICS_TTL = 5
+DAILY_FULL_REFRESH = 3600
+
+report_cache = ReadThroughCache(MemoryBackend(256), namespace="analytics", ttl=ANALYTICS_TTL)
+
+# created_at is stored as an ISO string by the API; older documents may hold a
+# BSON date. Both are reduced to "YYYY-MM-DD".
+DAY_EXPRESSION = {
+    "$cond": [
+        {"$eq": [{"$type": "$created_at"}, "date"]},
+        {"$dateToString": {"format": "%Y-%m-%d", "date": "$created_at"}},
+        {"$substrBytes": ["$created_at", 0, 10]},
+    ]
+}
+
+
+async def aggregate(pipeline: list) -> list:
+    return await database.basket_collection.aggregate(pipeline, allowDiskUse=True).to_list(None)
+
+
+# Reports cover archived baskets through the totals added up as they were
+# archived (see fold_archived in server/database.py): one small document per
+# product and per day, and one for the count, rather than the archive itself.
+async def archive_totals(kind: str) -> list:
+    return await database.database[database.ARCHIVE_TOTALS_COLLECTION].find({"kind": kind}).to_list(None)
+
+
+# Each status is counted on its own so the count is answered from the status
+# index without touching the documents. Everything archived was delivered;
+# the archived count comes from the totals rather than the archive's size,
+# which also holds the copies of a pass still in flight, whose baskets are
+# counted here until they are deleted.
+async def status_counts() -> dict:
+    counts = await asyncio.gather(
+        *(database.basket_collection.count_documents({"status": status.value}) for status in Status),
+        archive_totals("baskets"),
+    )
+    result = {status.value: count for status, count in zip(Status, counts)}
+    result[Status.delivered.value] += sum(row["baskets"] for row in counts[-1])
+    return result
+
+
+class DailyVolume:
+    def __init__(self):
+        self.days = {}
+        self.open_day = None
+        self.rebuilt_at = 0.0
+
+    async def refresh(self):
+        full = self.open_day is None or time.monotonic() - self.rebuilt_at > DAILY_FULL_REFRESH
+        pipeline = [
+            {"$group": {"_id": DAY_EXPRESSION, "baskets": {"$sum": 1}}},
+        ]
+        if not full:
+            pipeline.insert(0, {"$match": {"created_at": {"$gte": self.open_day}}})
+        today = datetime.utcnow().date().isoformat()
+        rows = await aggregate(pipeline)
+        if full:
+            self.days = {}
+            self.rebuilt_at = time.monotonic()
+            for row in await archive_totals("day"):
+                self.days[row["day"]] = row["baskets"]
+        else:
+            self.days = {day: count for day, count in self.days.items() if day < self.open_day}
+        # The open day is recent enough not to be archived yet.
+        for row in rows:
+            if row["_id"]:
+                self.days[row["_id"]] = self.days.get(row["_id"], 0) + row["baskets"]
+        self.open_day = today
+
+    def window(self, days: int) -> list:
+        start = datetime.utcnow().date() - timedelta(days=days - 1)
+        return [
+            {"day": day.isoformat(), "baskets": self.days.get(day.isoformat(), 0)}
+            for day in (start + timedelta(days=offset) for offset in range(days))
+        ]
+
+
+daily = DailyVolume()
+
+
+async def daily_volume(days: int = 30) -> list:
+    async def load():
+        await daily.refresh()
+        return True
+
+    await report_cache.get_or_load("daily", load)
+    return daily.window(days)
+
+
+# Quantity and line count per (product_id, status), from the line totals kept
+# by the basket.tally job (see tally_baskets in server/database.py) and, as
+# delivered, the archive's per-product totals: a few small documents however
+# many baskets there are.
+async def line_totals() -> dict:
+    totals = {}
+    async for row in database.database[database.LINE_TOTALS_COLLECTION].find({"kind": "line"}):
+        if row["lines"]:
+            totals[(row["product_id"], row["status"])] = [row["quantity"], row["lines"]]
+    for row in await archive_totals("product"):
+        total = totals.setdefault((row["product_id"], Status.delivered.value), [0, 0])
+        total[0] += row["quantity"]
+        total[1] += row["lines"]
+    return totals
+
+
+# The products named by `ids` that still exist, by id, from the product cache.
+async def current_products(ids) -> dict:
+    products = await database.retrieve_many(database.retrieve_product, list(ids))
+    return {product["id"]: product for product in products if product["error"] is None}
+
+
+# Revenue per basket status: quantity times the product's current price.
+# Lines whose product no longer exists are left out.
+async def revenue() -> dict:
+    async def load():
+        totals = await line_totals()
+        products = await current_products({product_id for product_id, _ in totals})
+        by_status = {}
+        for (product_id, status), (quantity, _) in totals.items():
+            product = products.get(product_id)
+            if product is None:
+                continue
+            row = by_status.setdefault(status, {"units": 0, "revenue": 0})
+            row["units"] += quantity
+            if database.is_number(product.get("price")):
+                row["revenue"] += quantity * product["price"]
+        return {
+            "by_status": by_status,
+            "total": sum(row["revenue"] for row in by_status.values()),
+        }
+
+    return await report_cache.get_or_load("revenue", load)
+
+
+async def top_products(limit: int = 10) -> list:
+    async def load():
+        per_product = {}
+        for (product_id, _), (quantity, lines) in (await line_totals()).items():
+            row = per_product.setdefault(product_id, [0, 0])
+            row[0] += quantity
+            row[1] += lines
+        top = sorted(per_product.items(), key=lambda entry: (-entry[1][0], entry[0]))[:limit]
+        products = await current_products(product_id for product_id, _ in top)
+        return [
+            {
+                "product_id": product_id,
+                "name": products[product_id].get("name") if product_id in products else None,
+                "quantity": quantity,
+                "baskets": lines,
+            }
+            for product_id, (quantity, lines) in top
+        ]
+
+    return await report_cache.get_or_load("top:{}".format(limit), load)
+
+
+async def cached_status_counts() -> dict:
+    return await report_cache.get_or_load("status", status_counts)
@@ -1,29 +1,63 @@
+import asyncio
+import hmac
+import json
+import logging
+import math
+import os
+import signal
 from datetime import datetime, timedelta
-from typing import Union
+from typing import List, Optional, Union
 
-from fastapi import FastAPI, HTTPException, status, Depends, Body
+from fastapi import FastAPI, HTTPException, status, Depends, Body, Header, Query, Request, Response
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from fastapi.encoders import jsonable_encoder
+from bson.errors import InvalidId
 from jose import JWTError, jwt
-from passlib.context import CryptContext
-from pydantic import BaseModel
+from pydantic import BaseModel, ValidationError
+from pymongo.errors import PyMongoError
 
 from server.database import (add_basket, delete_basket, retrieve_basket, retrieve_baskets,update_basket,
-    add_product, delete_product, retrieve_product, retrieve_products, update_product)
-
-from server.models.basket import ( ErrorResponseModel, ResponseModel, BasketSchema, UpdateBasketModel,)
-from server.models.product import ( ProductSchema, UpdateProductModel)
+    add_product, delete_product, retrieve_product, retrieve_products, update_product,
+    stream_baskets, stream_products, product_cache, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE,
+    add_products_bulk, update_products_bulk, delete_products_bulk,
+    add_baskets_bulk, update_baskets_bulk, delete_baskets_bulk,
+    decode_cursor, encode_cursor, product_query, basket_query,
+    PRODUCT_FIELDS, PRODUCT_SORT_FIELDS, BASKET_FIELDS, BASKET_SORT_FIELDS,
+    connect, disconnect, prewarm, pool_metrics, hydrate_baskets, hydrate_basket_stream,
+    add_basket_item, set_basket_item_quantity, remove_basket_item, VersionConflict,
+    build_search_index, retrieve_many, user_loader, product_loader, basket_loader, archive_loader)
+
+from server.models.basket import ( ErrorResponseModel, ResponseModel, PageResponseModel, BasketSchema, UpdateBasketModel,
+    BulkUpdateBasketModel, Status, BasketItem, UpdateBasketItemModel,)
+from server.models.product import ( ProductSchema, UpdateProductModel, BulkUpdateProductModel)
 
 from server.database import (
     add_user,
     delete_user,
+    auth_user_helper,
+    retrieve_active_user,
+    retrieve_auth_user,
     retrieve_user,
     retrieve_users,
+    store_password_hash,
+    stream_users,
     update_user,
+    user_cache,
 )
 from server.models.user import ( UserSchema, UpdateUserModel)
+from server.cache import TokenCache
+from server.passwords import get_password_hash, verify_and_update
+from server import analytics, jobs, transfer
+from server.indexes import ensure_indexes
+from server.responses import FastJSONResponse, document_etag, http_date, is_not_modified, page_etag
+from server.metrics import MetricsMiddleware, phase, registry
+from server.search import search_index
+from server.events import change_feed, sse_stream
+from server.ratelimit import AdaptiveConcurrency, LoadShedMiddleware, RateLimiter, Rule, limit_backend_from_url
+from server import config
 
-from .database import user_collection 
+logger = logging.getLogger(__name__)
 
 
 # to get a string like this run:
@@ -32,16 +66,10 @@ SECRET_KEY = "09d25e094faa6ca2556c818166b7a9563b93f7099f6f0f4caa6cf63b88e8d3e7"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
-
-user_collection = {
-    "johndoe": {
-        "username": "johndoe",
-        "full_name": "John Doe",
-        "email": "johndoe@example.com",
-        "hashed_password": "$2b$12$EixZaYVK1fsbw1ZfbX3OXePaWxn96p36WQoeG6Lruj3vjPGga31lW",
-        "disabled": False,
-    }
-}
+# Verified tokens are remembered for at most this long (and never past their
+# `exp`), so most requests skip jwt.decode and the user lookup.
+TOKEN_CACHE_SIZE = 10000
+TOKEN_CACHE_TTL = 60
 
 
 class Token(BaseModel):
@@ -60,36 +88,35 @@ class User(BaseModel):
     disabled: Union[bool, None] = None
 
 
-class UserInDB(User):
-    hashed_password: str
-
-
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
+token_cache = TokenCache(TOKEN_CACHE_SIZE, TOKEN_CACHE_TTL)
 
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
-
-
-def get_password_hash(password):
-    return pwd_context.hash(password)
 
-
-def get_user(db, username: str):
-    if username in db:
-        user_dict = db[username]
-        return UserInDB(**user_dict)
+async def get_user(username: str):
+    user = await retrieve_active_user(username)
+    if user:
+        return User(**user)
 
 
-def authenticate_user(db, username: str, password: str):
-    user = get_user(db,username)
+# Users stored before passwords were hashed still have a plaintext `password`;
+# it is checked once more and replaced by a hash on their first login. Hashes
+# made with outdated bcrypt settings are upgraded the same way.
+async def authenticate_user(username: str, password: str):
+    user = await retrieve_auth_user(username)
     if not user:
         return False
-    if not verify_password(password, user.hashed_password):
+    if user.get("hashed_password"):
+        valid, new_hash = await verify_and_update(password, user["hashed_password"])
+    else:
+        legacy = user.get("password")
+        valid = legacy is not None and hmac.compare_digest(legacy.encode(), password.encode())
+        new_hash = await get_password_hash(password) if valid else None
+    if not valid:
         return False
-    return user
+    if new_hash:
+        await store_password_hash(username, new_hash)
+    return User(**auth_user_helper(user))
 
 
 def create_access_token(data: dict, expires_delta: Union[timedelta, None] = None):
@@ -104,23 +131,28 @@ def create_access_token(data: dict, expires_delta: Union[timedelta, None] = None
 
 
 async def get_current_user(token: str = Depends(oauth2_scheme)):
-    credentials_exception = HTTPException(
-        status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="Could not validate credentials",
-        headers={"WWW-Authenticate": "Bearer"},
-    )
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
+    with phase("auth"):
+        user = token_cache.get(token)
+        if user is not None:
+            return user
+        credentials_exception = HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not validate credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+        try:
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+            username: str = payload.get("sub")
+            if username is None:
+                raise credentials_exception
+            token_data = TokenData(username=username)
+        except JWTError:
             raise credentials_exception
-        token_data = TokenData(username=username)
-    except JWTError:
-        raise credentials_exception
-    user = get_user(username=token_data.username)
-    if user is None:
-        raise credentials_exception
-    return user
+        user = await get_user(token_data.username)
+        if user is None:
+            raise credentials_exception
+        token_cache.set(token, user, payload["exp"])
+        return user
 
 
 async def get_current_active_user(current_user: User = Depends(get_current_user)):
@@ -128,11 +160,352 @@ async def get_current_active_user(current_user: User = Depends(get_current_user)
         raise HTTPException(status_code=400, detail="Inactive user")
     return current_user
 
-app = FastAPI()
 
-@app.post("/token", response_model=Token)
+# Listing endpoints share these query parameters. Without `stream` a page of
+# at most `limit` documents is returned together with the cursor of the next
+# page; with `stream` the documents are written out as NDJSON while the cursor
+# produces them, and `limit` is only applied when given. `sort` names a field
+# ("-" prefix for descending) and `fields` is a comma separated projection.
+def check_cursor(after: Optional[str], sort: Optional[str] = None):
+    if after is not None:
+        try:
+            decode_cursor(after, sort)
+        except ValueError as exc:
+            raise HTTPException(status_code=400, detail=str(exc))
+
+
+def sort_pattern(fields) -> str:
+    return "^-?({})$".format("|".join(fields))
+
+
+def parse_fields(fields: Optional[str], allowed) -> Optional[tuple]:
+    if not fields:
+        return None
+    requested = tuple(field.strip() for field in fields.split(",") if field.strip())
+    unknown = [field for field in requested if field not in allowed]
+    if unknown:
+        raise HTTPException(status_code=400, detail="Unknown fields: {}".format(", ".join(unknown)))
+    return requested
+
+
+# `ids=a,b,c` on a listing asks for exactly those documents instead of a page
+# (at most MAX_PAGE_SIZE of them), all fetched with one `$in` query. Each id
+# gets its document or an error entry, in the order given.
+def parse_ids(ids: str) -> list:
+    requested = [id.strip() for id in ids.split(",") if id.strip()]
+    if not requested:
+        raise HTTPException(status_code=400, detail="No ids given")
+    if len(requested) > MAX_PAGE_SIZE:
+        raise HTTPException(status_code=400, detail="At most {} ids per request".format(MAX_PAGE_SIZE))
+    return requested
+
+
+def multi_get_response(results, name: str):
+    found = sum(1 for result in results if result["error"] is None)
+    return ResponseModel(results, "{} of {} {} found".format(found, len(results), name))
+
+
+def ndjson_response(documents):
+    async def lines():
+        async for document in documents:
+            yield json.dumps(jsonable_encoder(document)) + "\n"
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+def page_response(documents, limit: int, name: str, sort: Optional[str] = None):
+    next_after = encode_cursor(documents[-1], sort) if len(documents) == limit else None
+    if documents:
+        return PageResponseModel(documents, "{} data retrieved successfully".format(name), next_after)
+    return PageResponseModel(documents, "Empty list returned", next_after)
+
+
+# `fast=true` listings: documents straight from the driver, encoded by
+# FastJSONResponse in one pass, and `data` is the list itself instead of a
+# one-element list around it.
+def fast_page_response(documents, limit: int, name: str, sort: Optional[str] = None, headers: dict = None):
+    next_after = encode_cursor(documents[-1], sort) if len(documents) == limit else None
+    message = "{} data retrieved successfully".format(name) if documents else "Empty list returned"
+    return FastJSONResponse(
+        {"data": documents, "code": 200, "message": message, "next_after": next_after}, headers=headers)
+
+
+# Validators and Cache-Control for product reads. A request whose
+# If-None-Match / If-Modified-Since still matches gets an empty 304 before
+# anything is serialized.
+def catalog_headers(etag: str, last_modified: Optional[str] = None) -> dict:
+    headers = {"ETag": etag, "Cache-Control": config.CATALOG_CACHE_CONTROL}
+    if last_modified:
+        headers["Last-Modified"] = last_modified
+    return headers
+
+
+def not_modified(request: Request, headers: dict) -> Optional[Response]:
+    if is_not_modified(request.headers.get("if-none-match"), request.headers.get("if-modified-since"),
+                       headers["ETag"], headers.get("Last-Modified")):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return None
+
+
+# Bulk endpoints validate every item on its own so that one bad item is
+# reported in its slot of the per-item results instead of failing the batch.
+MAX_BULK_ITEMS = 100000
+
+
+def check_bulk_size(items: list):
+    if len(items) > MAX_BULK_ITEMS:
+        raise HTTPException(status_code=413, detail="At most {} items per request".format(MAX_BULK_ITEMS))
+
+
+def validate_items(items: List[dict], schema):
+    valid, results = [], [None] * len(items)
+    for index, item in enumerate(items):
+        try:
+            valid.append((index, schema.parse_obj(item)))
+        except ValidationError as exc:
+            results[index] = {"index": index, "id": item.get("id"), "error": exc.errors()}
+    return valid, results
+
+
+def merge_bulk_results(valid, results, written):
+    for (index, _), result in zip(valid, written):
+        results[index] = {"index": index, **result}
+    return results
+
+
+def bulk_response(results, name: str, action: str):
+    failed = sum(1 for result in results if result["error"] is not None)
+    return ResponseModel(results, "{} of {} {} {}".format(len(results) - failed, len(results), name, action))
+
+
+async def bulk_add(items: List[dict], schema, add_many, name: str):
+    check_bulk_size(items)
+    valid, results = validate_items(items, schema)
+    written = await add_many([jsonable_encoder(document) for _, document in valid])
+    return bulk_response(merge_bulk_results(valid, results, written), name, "added")
+
+
+async def bulk_update(items: List[dict], schema, update_many, name: str):
+    check_bulk_size(items)
+    valid, results = validate_items(items, schema)
+    updates = [
+        (document.id, {k: v for k, v in jsonable_encoder(document).items() if v is not None and k != "id"})
+        for _, document in valid
+    ]
+    written = await update_many(updates)
+    return bulk_response(merge_bulk_results(valid, results, written), name, "updated")
+
+
+async def bulk_delete(ids: List[str], delete_many, name: str):
+    check_bulk_size(ids)
+    written = await delete_many(ids)
+    results = [{"index": index, **result} for index, result in enumerate(written)]
+    return bulk_response(results, name, "deleted")
+
+
+# Catalog import/export (see server/transfer.py). The body is either the raw
+# NDJSON/CSV file or a multipart upload with the file in a `file` field.
+async def import_response(request: Request, format: Optional[str], schema, add_many, name: str):
+    content_type = request.headers.get("content-type", "")
+    if content_type.startswith("multipart/form-data"):
+        form = await request.form()
+        upload = form.get("file")
+        if upload is None or isinstance(upload, str):
+            raise HTTPException(status_code=400, detail="Missing file field")
+        format = transfer.detect_format(format, upload.content_type)
+        chunks = transfer.upload_chunks(upload)
+    else:
+        format = transfer.detect_format(format, content_type)
+        chunks = request.stream()
+    summary = await transfer.import_documents(chunks, format, schema, add_many, name)
+    return ResponseModel(summary, "{} of {} {} imported".format(summary["inserted"], summary["rows"], name))
+
+
+def export_response(documents, format: str, fields, name: str):
+    media_type = "text/csv" if format == "csv" else "application/x-ndjson"
+    return StreamingResponse(
+        transfer.export_documents(documents, format, fields, name),
+        media_type=media_type,
+        headers={"Content-Disposition": "attachment; filename={}.{}".format(name, format)},
+    )
+
+
+# Basket item routes take the basket version in If-Match (as returned in the
+# ETag of the previous item write) and answer 412 if the basket has moved on.
+def parse_if_match(if_match: Optional[str]) -> Optional[int]:
+    if if_match is None:
+        return None
+    try:
+        return int(if_match.strip().lstrip("W/").strip('"'))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="If-Match must be a basket version")
+
+
+async def basket_item_response(write, response: Response, message: str):
+    try:
+        result = await write
+    except VersionConflict as exc:
+        raise HTTPException(
+            status_code=status.HTTP_412_PRECONDITION_FAILED,
+            detail="Basket has changed, current version is {}".format(exc.args[0]),
+            headers={"ETag": '"{}"'.format(exc.args[0])},
+        )
+    if result is None:
+        return ErrorResponseModel("An error occurred.", 404, "basket or item doesn't exist.")
+    response.headers["ETag"] = '"{}"'.format(result["version"])
+    return ResponseModel(result, message)
+
+
+# Rate limits are per client: the user a bearer token belongs to, or the
+# client address for anonymous requests. Every route is under the default
+# rule; expensive ones add a stricter one with `dependencies=[limit(...)]`.
+RATE_LIMITS = {
+    "default": Rule(*config.RATE_LIMIT_DEFAULT),
+    "login": Rule(*config.RATE_LIMIT_LOGIN),
+    "listing": Rule(*config.RATE_LIMIT_LISTING),
+    "bulk": Rule(*config.RATE_LIMIT_BULK),
+}
+
+rate_limiter = RateLimiter(limit_backend_from_url(config.RATE_LIMIT_URL))
+
+concurrency = AdaptiveConcurrency(
+    config.CONCURRENCY_INITIAL,
+    config.CONCURRENCY_MIN,
+    config.CONCURRENCY_MAX,
+    config.CONCURRENCY_TARGET_LATENCY,
+    config.CONCURRENCY_QUEUE_TIMEOUT,
+    config.CONCURRENCY_MAX_QUEUE,
+)
+
+
+def client_key(request: Request) -> str:
+    scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+    if scheme.lower() == "bearer" and token:
+        user = token_cache.peek(token)
+        if user is not None:
+            return "user:" + user.username
+        try:
+            return "user:" + jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])["sub"]
+        except (JWTError, KeyError):
+            pass
+    return "ip:" + (request.client.host if request.client else "unknown")
+
+
+# Health checks and metrics must answer whoever polls them, however often.
+UNLIMITED_PATHS = ("/ready", "/metrics")
+
+
+def limit(name: str, exempt: tuple = ()):
+    rule = RATE_LIMITS[name]
+
+    async def check_rate_limit(request: Request):
+        if request.url.path in exempt:
+            return
+        retry_after = await rate_limiter.check(name, client_key(request), rule)
+        if retry_after:
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail="Rate limit exceeded",
+                headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+            )
+    return Depends(check_rate_limit)
+
+
+app = FastAPI(dependencies=[limit("default", exempt=UNLIMITED_PATHS)])
+app.add_middleware(LoadShedMiddleware, limiter=concurrency, exempt=UNLIMITED_PATHS + ("/events",))
+app.add_middleware(MetricsMiddleware)
+
+
+# A malformed id in a path or body is the client's mistake, not a 500.
+@app.exception_handler(InvalidId)
+async def invalid_id_handler(request: Request, exc: InvalidId):
+    return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST, content={"detail": str(exc)})
+
+
+app.state.ready = False
+app.state.preparing = None
+app.state.failed = None
+
+
+# Requests are served as soon as the client exists; warming the pool and
+# creating the indexes (slow on large collections) happen in the background,
+# retried until MongoDB answers and the unique indexes could be built (see
+# ensure_indexes), and /ready reports 503 until they are done.
+# Any other error before then stops the worker instead of leaving it unready
+# for good: it drains and exits with status 3, on which gunicorn shuts down
+# rather than respawning it. One after it leaves /events or search at 503.
+WORKER_BOOT_ERROR = 3
+
+
+async def prepare():
+    while True:
+        try:
+            await prewarm()
+            await ensure_indexes()
+            break
+        except PyMongoError as exc:
+            logger.warning("MongoDB is not ready yet: %s", exc)
+            await asyncio.sleep(1)
+    app.state.ready = True
+    jobs.job_pool.start(config.JOBS_WORKERS)
+    # /events answers 503 until the change feed runs, search until its index
+    # is built; everything else is up.
+    while True:
+        try:
+            await change_feed.start()
+            break
+        except PyMongoError as exc:
+            logger.warning("Starting the change feed failed: %s", exc)
+            await asyncio.sleep(1)
+    while True:
+        try:
+            await build_search_index()
+            break
+        except PyMongoError as exc:
+            logger.warning("Building the search index failed: %s", exc)
+            await asyncio.sleep(1)
+
+
+def prepare_done(task: asyncio.Task):
+    if task.cancelled() or task.exception() is None:
+        return
+    if app.state.ready:
+        logger.error("Starting the change feed or search failed", exc_info=task.exception())
+        return
+    logger.critical("Startup failed, stopping", exc_info=task.exception())
+    app.state.failed = repr(task.exception())
+    os.kill(os.getpid(), signal.SIGTERM)
+
+
+@app.on_event("startup")
+async def startup():
+    connect()
+    app.state.preparing = asyncio.ensure_future(prepare())
+    app.state.preparing.add_done_callback(prepare_done)
+
+
+# uvicorn runs this once in-flight requests have finished after SIGTERM.
+@app.on_event("shutdown")
+async def shutdown():
+    app.state.ready = False
+    app.state.preparing.cancel()
+    change_feed.stop()
+    await jobs.job_pool.stop(config.JOBS_SHUTDOWN_TIMEOUT)
+    disconnect()
+    if app.state.failed:
+        os._exit(WORKER_BOOT_ERROR)
+
+
+@app.get("/ready", tags=["health"], response_description="the service is ready")
+async def get_ready():
+    if not app.state.ready:
+        detail = "Startup failed" if app.state.failed else "Not ready"
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=detail)
+    return ResponseModel("ready", "service is ready")
+
+
+@app.post("/token", response_model=Token, dependencies=[limit("login")])
 async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends()):
-    user = authenticate_user(user_collection,form_data.username, form_data.password)
+    user = await authenticate_user(form_data.username, form_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -146,6 +519,91 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
     return {"access_token": access_token, "token_type": "bearer"}
 
 
+@app.get("/cache/stats", tags=["cache"], response_description="cache statistics retrieved")
+async def get_cache_stats(current_uer: User = Depends(get_current_active_user)):
+    return ResponseModel(
+        {"product": product_cache.stats(), "token": token_cache.stats(), "user": user_cache.stats(),
+         "loaders": [loader.stats() for loader in (user_loader, product_loader, basket_loader, archive_loader)]},
+        "cache statistics retrieved successfully",
+    )
+
+
+@app.get("/limits/stats", tags=["limits"], response_description="rate limit and load shedding statistics retrieved")
+async def get_limit_stats(current_uer: User = Depends(get_current_active_user)):
+    return ResponseModel(
+        {"rate_limits": rate_limiter.stats(), "concurrency": concurrency.stats()},
+        "limit statistics retrieved successfully",
+    )
+
+
+# Product and basket changes as Server-Sent Events (see server/events.py). A
+# client reconnecting with the Last-Event-ID header (or `last_event_id`) gets
+# every change after that event, each once.
+@app.get("/events", tags=["events"], response_description="change stream opened")
+async def get_events(
+    collections: Optional[str] = Query(None, regex="^(product|basket)(,(product|basket))*$"),
+    last_event_id: Optional[str] = Header(None), after: Optional[str] = Query(None, alias="last_event_id"),
+    current_uer: User = Depends(get_current_active_user)):
+    if not change_feed.running:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Change feed is starting",
+                            headers={"Retry-After": "5"})
+    return StreamingResponse(
+        sse_stream(after or last_event_id, tuple(collections.split(",")) if collections else None),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.get("/events/stats", tags=["events"], response_description="change feed statistics retrieved")
+async def get_event_stats(current_uer: User = Depends(get_current_active_user)):
+    return ResponseModel(change_feed.stats(), "change feed statistics retrieved successfully")
+
+
+@app.get("/jobs", tags=["jobs"], response_description="jobs retrieved")
+async def get_jobs(
+    status: Optional[str] = Query(None, regex="^(queued|running|succeeded|failed)$"),
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE), after: Optional[str] = None,
+    current_uer: User = Depends(get_current_active_user)):
+    check_cursor(after)
+    return page_response(await jobs.retrieve_jobs(limit, after, status), limit, "jobs")
+
+
+@app.get("/jobs/stats", tags=["jobs"], response_description="job statistics retrieved")
+async def get_job_stats(current_uer: User = Depends(get_current_active_user)):
+    return ResponseModel(
+        {"statuses": await jobs.status_counts(), "pool": jobs.job_pool.stats()},
+        "job statistics retrieved successfully",
+    )
+
+
+@app.get("/jobs/{id}", tags=["jobs"], response_description="job retrieved")
+async def get_job_data(id: str, current_uer: User = Depends(get_current_active_user)):
+    job = await jobs.retrieve_job(id)
+    if job:
+        return ResponseModel(job, "job retrieved successfully")
+    return ErrorResponseModel("An error occurred.", 404, "job doesn't exist.")
+
+
+@app.post("/jobs/{id}/retry", tags=["jobs"], response_description="job queued again")
+async def retry_job_data(id: str, current_uer: User = Depends(get_current_active_user)):
+    job = await jobs.retry_job(id)
+    if job is False:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Only failed jobs can be retried")
+    if job:
+        return ResponseModel(job, "job queued again successfully")
+    return ErrorResponseModel("An error occurred.", 404, "job doesn't exist.")
+
+
+@app.get("/metrics", tags=["metrics"], response_class=PlainTextResponse)
+async def get_metrics():
+    return PlainTextResponse(registry.render(pool_metrics.stats()["pools"]), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/db/pool", tags=["database"], response_description="connection pool statistics retrieved")
+async def get_pool_stats(current_uer: User = Depends(get_current_active_user)):
+    return ResponseModel(pool_metrics.stats(), "connection pool statistics retrieved successfully")
+
+
 @app.post("/product", tags=["product"],response_description="product data added into the database")
 async def add_product_data(product: ProductSchema = Body(...), current_uer: User = Depends(get_current_active_user)):
     product = jsonable_encoder(product)
@@ -153,18 +611,102 @@ async def add_product_data(product: ProductSchema = Body(...), current_uer: User
     return ResponseModel(new_product, "product added successfully.")
 
 
-@app.get("/product", tags=["product"],response_description="products retrieved")
-async def get_products( current_uer: User = Depends(get_current_active_user)):
-    products = await retrieve_products()
-    if products:
-        return ResponseModel(products, "products data retrieved successfully")
-    return ResponseModel(products, "Empty list returned")
+@app.get("/product", dependencies=[limit("listing")], tags=["product"],response_description="products retrieved")
+async def get_products(
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE), after: Optional[str] = None, stream: bool = False,
+    min_price: Optional[float] = None, max_price: Optional[float] = None, name_prefix: Optional[str] = None,
+    sort: Optional[str] = Query(None, regex=sort_pattern(PRODUCT_SORT_FIELDS)), fields: Optional[str] = None,
+    fast: bool = False, ids: Optional[str] = None, request: Request = None, response: Response = None,
+    current_uer: User = Depends(get_current_active_user)):
+    if ids is not None:
+        return multi_get_response(await retrieve_many(retrieve_product, parse_ids(ids)), "products")
+    check_cursor(after, sort)
+    query = product_query(min_price, max_price, name_prefix)
+    fields = parse_fields(fields, PRODUCT_FIELDS)
+    if stream:
+        return ndjson_response(stream_products(after, limit or 0, query, sort, fields))
+    limit = limit or DEFAULT_PAGE_SIZE
+    products = await retrieve_products(limit, after, query, sort, fields, raw=fast)
+    # Deleted products leave no trace in a page's timestamps, so listings are
+    # validated by ETag only.
+    headers = catalog_headers(page_etag(products))
+    cached = not_modified(request, headers)
+    if cached:
+        return cached
+    # The versions are read for the ETag; a `fields` list without them does
+    # not get them back.
+    if fields and "version" not in fields:
+        for product in products:
+            product.pop("version", None)
+    if fast:
+        return fast_page_response(products, limit, "products", sort, headers)
+    response.headers.update(headers)
+    return page_response(products, limit, "products", sort)
+
+
+@app.post("/product/bulk", dependencies=[limit("bulk")], tags=["product"], response_description="products added into the database")
+async def add_products_bulk_data(products: List[dict] = Body(...), current_uer: User = Depends(get_current_active_user)):
+    return await bulk_add(products, ProductSchema, add_products_bulk, "products")
+
+
+@app.put("/product/bulk", dependencies=[limit("bulk")], tags=["product"], response_description="products updated")
+async def update_products_bulk_data(products: List[dict] = Body(...), current_uer: User = Depends(get_current_active_user)):
+    return await bulk_update(products, BulkUpdateProductModel, update_products_bulk, "products")
+
+
+@app.delete("/product/bulk", dependencies=[limit("bulk")], tags=["product"], response_description="products deleted from the database")
+async def delete_products_bulk_data(ids: List[str] = Body(..., embed=True), current_uer: User = Depends(get_current_active_user)):
+    return await bulk_delete(ids, delete_products_bulk, "products")
+
+
+@app.post("/product/import", dependencies=[limit("bulk")], tags=["product"], response_description="products imported into the database")
+async def import_products(
+    request: Request, format: Optional[str] = Query(None, regex="^(ndjson|csv)$"),
+    current_uer: User = Depends(get_current_active_user)):
+    return await import_response(request, format, ProductSchema, add_products_bulk, "products")
+
+
+@app.get("/product/export", dependencies=[limit("listing")], tags=["product"], response_description="products exported")
+async def export_products(
+    format: str = Query("ndjson", regex="^(ndjson|csv)$"), current_uer: User = Depends(get_current_active_user)):
+    return export_response(stream_products(), format, ["id", "name", "description", "price"], "products")
+
+
+# Full-text search over product names and descriptions (see server/search.py).
+# Every word must match; the last one also matches as a prefix, so the route
+# doubles as autocomplete, and a word with no match is corrected by one edit.
+@app.get("/product/search", tags=["product"], response_description="products found")
+async def search_products(
+    q: str = Query(..., min_length=1, max_length=200), limit: int = Query(10, ge=1, le=MAX_PAGE_SIZE),
+    offset: int = Query(0, ge=0, le=1000), current_uer: User = Depends(get_current_active_user)):
+    if not search_index.ready:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Search index is being built",
+                            headers={"Retry-After": "5"})
+    with phase("search"):
+        hits, total, exact = search_index.search(q, limit, offset)
+    products = []
+    for (_, score), product in zip(hits, await retrieve_many(retrieve_product, [id for id, _ in hits])):
+        if product.pop("error") is None:
+            products.append(dict(product, score=round(score, 4)))
+    message = "products found successfully" if products else "Empty list returned"
+    return ResponseModel({"total": total, "total_exact": exact, "offset": offset, "products": products}, message)
+
+
+@app.get("/search/stats", tags=["product"], response_description="search index statistics retrieved")
+async def get_search_stats(current_uer: User = Depends(get_current_active_user)):
+    return ResponseModel(search_index.stats(), "search index statistics retrieved successfully")
 
 
 @app.get("/product/{id}", tags=["product"],response_description="product data retrieved")
-async def get_product_data(id, current_uer: User = Depends(get_current_active_user)):
+async def get_product_data(id, request: Request, response: Response,
+                           current_uer: User = Depends(get_current_active_user)):
     product = await retrieve_product(id)
     if product:
+        headers = catalog_headers(document_etag(product), http_date(product.get("updated_at")))
+        cached = not_modified(request, headers)
+        if cached:
+            return cached
+        response.headers.update(headers)
         return ResponseModel(product, "product data retrieved successfully")
     return ErrorResponseModel("An error occurred.", 404, "product doesn't exist.")
 
@@ -196,24 +738,115 @@ async def delete_product_data(id: str, current_uer: User = Depends(get_current_a
         "An error occurred", 404, "product with id {0} doesn't exist".format(id)
     )
 
+# Basket writes that set a status queue that status's jobs (see
+# server/jobs.py) and return without waiting for them to run.
+async def add_baskets_queueing_jobs(documents: list) -> list:
+    results = await add_baskets_bulk(documents)
+    await jobs.basket_status_changed([
+        (result["id"], document["status"]) for document, result in zip(documents, results) if result["error"] is None])
+    return results
+
+
+async def update_baskets_queueing_jobs(updates: list) -> list:
+    results = await update_baskets_bulk(updates)
+    await jobs.basket_status_changed([
+        (id, data["status"]) for (id, data), result in zip(updates, results)
+        if result["error"] is None and data.get("status")])
+    return results
+
+
 @app.post("/basket", tags=["Basket"],response_description="basket data added into the database")
 async def add_basket_data(basket: BasketSchema = Body(...), current_uer: User = Depends(get_current_active_user)):
     basket = jsonable_encoder(basket)
     new_basket = await add_basket(basket)
+    await jobs.basket_status_changed([(new_basket["id"], new_basket["status"])])
     return ResponseModel(new_basket, "basket added successfully.")
 
 
-@app.get("/basket", tags=["Basket"],response_description="baskets retrieved")
-async def get_baskets( current_uer: User = Depends(get_current_active_user)):
-    baskets = await retrieve_baskets()
-    if baskets:
-        return ResponseModel(baskets, "baskets data retrieved successfully")
-    return ResponseModel(baskets, "Empty list returned")
+@app.get("/basket", dependencies=[limit("listing")], tags=["Basket"],response_description="baskets retrieved")
+async def get_baskets(
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE), after: Optional[str] = None, stream: bool = False,
+    status: Optional[Status] = None, created_after: Optional[datetime] = None, created_before: Optional[datetime] = None,
+    sort: Optional[str] = Query(None, regex=sort_pattern(BASKET_SORT_FIELDS)), fields: Optional[str] = None,
+    expand: bool = False, fast: bool = False, ids: Optional[str] = None,
+    current_uer: User = Depends(get_current_active_user)):
+    if ids is not None:
+        baskets = await retrieve_many(retrieve_basket, parse_ids(ids))
+        return multi_get_response(await hydrate_baskets(baskets) if expand else baskets, "baskets")
+    check_cursor(after, sort)
+    query = basket_query(status and status.value, created_after, created_before)
+    fields = parse_fields(fields, BASKET_FIELDS)
+    if stream:
+        baskets = stream_baskets(after, limit or 0, query, sort, fields)
+        return ndjson_response(hydrate_basket_stream(baskets) if expand else baskets)
+    limit = limit or DEFAULT_PAGE_SIZE
+    baskets = await retrieve_baskets(limit, after, query, sort, fields, raw=fast)
+    if expand:
+        baskets = await hydrate_baskets(baskets)
+    if fast:
+        return fast_page_response(baskets, limit, "baskets", sort)
+    return page_response(baskets, limit, "baskets", sort)
+
+
+@app.post("/basket/bulk", dependencies=[limit("bulk")], tags=["Basket"], response_description="baskets added into the database")
+async def add_baskets_bulk_data(baskets: List[dict] = Body(...), current_uer: User = Depends(get_current_active_user)):
+    return await bulk_add(baskets, BasketSchema, add_baskets_queueing_jobs, "baskets")
+
+
+@app.put("/basket/bulk", dependencies=[limit("bulk")], tags=["Basket"], response_description="baskets updated")
+async def update_baskets_bulk_data(baskets: List[dict] = Body(...), current_uer: User = Depends(get_current_active_user)):
+    return await bulk_update(baskets, BulkUpdateBasketModel, update_baskets_queueing_jobs, "baskets")
+
+
+@app.delete("/basket/bulk", dependencies=[limit("bulk")], tags=["Basket"], response_description="baskets deleted from the database")
+async def delete_baskets_bulk_data(ids: List[str] = Body(..., embed=True), current_uer: User = Depends(get_current_active_user)):
+    return await bulk_delete(ids, delete_baskets_bulk, "baskets")
+
+
+@app.post("/basket/import", dependencies=[limit("bulk")], tags=["Basket"], response_description="baskets imported into the database")
+async def import_baskets(
+    request: Request, format: Optional[str] = Query(None, regex="^(ndjson|csv)$"),
+    current_uer: User = Depends(get_current_active_user)):
+    return await import_response(request, format, BasketSchema, add_baskets_queueing_jobs, "baskets")
+
+
+@app.get("/basket/export", dependencies=[limit("listing")], tags=["Basket"], response_description="baskets exported")
+async def export_baskets(
+    format: str = Query("ndjson", regex="^(ndjson|csv)$"), current_uer: User = Depends(get_current_active_user)):
+    return export_response(
+        stream_baskets(), format, ["id", "items", "created_at", "updated_at", "status"], "baskets")
+
+
+@app.get("/transfer/stats", tags=["transfer"], response_description="recent imports and exports")
+async def get_transfer_stats(current_uer: User = Depends(get_current_active_user)):
+    return ResponseModel(list(transfer.recent_runs), "transfer statistics retrieved successfully")
+
+
+@app.get("/analytics/status", tags=["analytics"], response_description="basket counts per status retrieved")
+async def get_status_counts(current_uer: User = Depends(get_current_active_user)):
+    return ResponseModel(await analytics.cached_status_counts(), "basket counts retrieved successfully")
+
+
+@app.get("/analytics/volume", tags=["analytics"], response_description="daily basket volume retrieved")
+async def get_daily_volume(days: int = Query(30, ge=1, le=366), current_uer: User = Depends(get_current_active_user)):
+    return ResponseModel(await analytics.daily_volume(days), "daily volume retrieved successfully")
+
+
+@app.get("/analytics/revenue", tags=["analytics"], response_description="revenue per status retrieved")
+async def get_revenue(current_uer: User = Depends(get_current_active_user)):
+    return ResponseModel(await analytics.revenue(), "revenue retrieved successfully")
+
+
+@app.get("/analytics/top-products", tags=["analytics"], response_description="top products retrieved")
+async def get_top_products(limit: int = Query(10, ge=1, le=100), current_uer: User = Depends(get_current_active_user)):
+    return ResponseModel(await analytics.top_products(limit), "top products retrieved successfully")
 
 
 @app.get("/basket/{id}", tags=["Basket"],response_description="basket data retrieved")
-async def get_basket_data(id, current_uer: User = Depends(get_current_active_user)):
+async def get_basket_data(id, expand: bool = False, current_uer: User = Depends(get_current_active_user)):
     basket = await retrieve_basket(id)
+    if basket and expand:
+        basket, = await hydrate_baskets([basket])
     if basket:
         return ResponseModel(basket, "basket data retrieved successfully")
     return ErrorResponseModel("An error occurred.", 404, "basket doesn't exist.")
@@ -224,6 +857,8 @@ async def update_basket_data(id: str, req: UpdateBasketModel = Body(...), curren
     req = {k: v for k, v in req.dict().items() if v is not None}
     updated_basket = await update_basket(id, req)
     if updated_basket:
+        if "status" in req:
+            await jobs.basket_status_changed([(id, req["status"])])
         return ResponseModel(
             "basket with ID: {} name update is successful".format(id),
             "basket name updated successfully",
@@ -234,6 +869,30 @@ async def update_basket_data(id: str, req: UpdateBasketModel = Body(...), curren
         "There was an error updating the basket data.",
     )
 
+@app.post("/basket/{id}/items", tags=["Basket"], response_description="item added to the basket")
+async def add_basket_item_data(
+    id: str, response: Response, item: BasketItem = Body(...), if_match: Optional[str] = Header(None),
+    current_uer: User = Depends(get_current_active_user)):
+    write = add_basket_item(id, item.product_id, item.quantity, parse_if_match(if_match))
+    return await basket_item_response(write, response, "item added successfully")
+
+
+@app.patch("/basket/{id}/items/{product_id}", tags=["Basket"], response_description="basket item updated")
+async def update_basket_item_data(
+    id: str, product_id: str, response: Response, req: UpdateBasketItemModel = Body(...),
+    if_match: Optional[str] = Header(None), current_uer: User = Depends(get_current_active_user)):
+    write = set_basket_item_quantity(id, product_id, req.quantity, parse_if_match(if_match))
+    return await basket_item_response(write, response, "item updated successfully")
+
+
+@app.delete("/basket/{id}/items/{product_id}", tags=["Basket"], response_description="item removed from the basket")
+async def delete_basket_item_data(
+    id: str, product_id: str, response: Response, if_match: Optional[str] = Header(None),
+    current_uer: User = Depends(get_current_active_user)):
+    write = remove_basket_item(id, product_id, parse_if_match(if_match))
+    return await basket_item_response(write, response, "item removed successfully")
+
+
 @app.delete("basket/{id}", tags=["Basket"],response_description="basket data deleted from the database")
 async def delete_basket_data(id: str, current_uer: User = Depends(get_current_active_user)):
     deleted_basket = await delete_basket(id)
@@ -249,15 +908,25 @@ async def delete_basket_data(id: str, current_uer: User = Depends(get_current_ac
 async def add_user_data(user: UserSchema = Body(...)):
     user = jsonable_encoder(user)
     new_user = await add_user(user)
+    if new_user is None:
+        return ErrorResponseModel("An error occurred.", 409, "username or email already exists.")
     return ResponseModel(new_user, "user added successfully.")
 
 
-@app.get("/user", tags=["user"], response_description="users retrieved")
-async def get_users():
-    users = await retrieve_users()
-    if users:
-        return ResponseModel(users, "users data retrieved successfully")
-    return ResponseModel(users, "Empty list returned")
+@app.get("/user", dependencies=[limit("listing")], tags=["user"], response_description="users retrieved")
+async def get_users(
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE), after: Optional[str] = None, stream: bool = False,
+    fast: bool = False, ids: Optional[str] = None):
+    if ids is not None:
+        return multi_get_response(await retrieve_many(retrieve_user, parse_ids(ids)), "users")
+    check_cursor(after)
+    if stream:
+        return ndjson_response(stream_users(after, limit or 0))
+    limit = limit or DEFAULT_PAGE_SIZE
+    users = await retrieve_users(limit, after, raw=fast)
+    if fast:
+        return fast_page_response(users, limit, "users")
+    return page_response(users, limit, "users")
 
 
 @app.get("/user/{id}", tags=["user"], response_description="user data retrieved")
@@ -273,6 +942,11 @@ async def update_user_data(id: str, req: UpdateUserModel = Body(...), current_ue
     req = {k: v for k, v in req.dict().items() if v is not None}
     updated_user = await update_user(id, req)
     if updated_user:
+        # A renamed user's old username is gone, so forget every cached login.
+        if "username" in req:
+            token_cache.clear()
+        else:
+            token_cache.invalidate_user(updated_user["username"])
         return ResponseModel(
             "user with ID: {} name update is successful".format(id),
             "user name updated successfully",
@@ -288,6 +962,7 @@ async def update_user_data(id: str, req: UpdateUserModel = Body(...), current_ue
 async def delete_user_data(id: str, current_uer: User = Depends(get_current_active_user)):
     deleted_user = await delete_user(id)
     if deleted_user:
+        token_cache.invalidate_user(deleted_user.get("username"))
         return ResponseModel(
             "user with ID: {} removed".format(id), "user deleted successfully"
         )
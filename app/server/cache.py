@@ -0,0 +1,509 @@
+import argparse
+import asyncio
+import copy
+import json
+import logging
+import time
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+
+# Bounded mapping with an optional per-entry expiry. Reads move an entry to the
+# end, so when the cache is full the least recently used entry is dropped.
+class LRUCache:
+    def __init__(self, maxsize: int, ttl: float = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.evictions = 0
+        self.expirations = 0
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        expires_at, value = entry
+        if expires_at is not None and expires_at <= time.monotonic():
+            del self._data[key]
+            self.expirations += 1
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl: float = None):
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl else None
+        self._data[key] = (expires_at, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key, default=None):
+        entry = self._data.pop(key, None)
+        if entry is None:
+            return default
+        return entry[1]
+
+    def clear(self):
+        self._data.clear()
+
+
+# Interface every cache backend implements. Values must be JSON serializable so
+# that shared backends can store them; `incr` counters are never evicted.
+# `shared` backends are the same for every worker, so one invalidation reaches
+# them all.
+class CacheBackend:
+    shared = False
+
+    async def get(self, key):
+        raise NotImplementedError
+
+    async def set(self, key, value, ttl: float = None):
+        raise NotImplementedError
+
+    async def delete(self, *keys):
+        raise NotImplementedError
+
+    async def incr(self, key) -> int:
+        raise NotImplementedError
+
+    @property
+    def evictions(self) -> int:
+        return 0
+
+    @property
+    def size(self) -> int:
+        return 0
+
+
+# Per-process backend. Cheapest option, but every worker has its own copy and
+# only sees its own invalidations. Values are copied in and out, so callers
+# can change what they get as they could with a shared backend.
+class MemoryBackend(CacheBackend):
+    def __init__(self, maxsize: int = 10000):
+        self._entries = LRUCache(maxsize)
+        self._counters = {}
+
+    async def get(self, key):
+        if key in self._counters:
+            return self._counters[key]
+        return copy.deepcopy(self._entries.get(key))
+
+    async def set(self, key, value, ttl: float = None):
+        self._entries.set(key, copy.deepcopy(value), ttl)
+
+    async def delete(self, *keys):
+        for key in keys:
+            self._entries.pop(key)
+
+    async def incr(self, key) -> int:
+        self._counters[key] = self._counters.get(key, 0) + 1
+        return self._counters[key]
+
+    @property
+    def evictions(self) -> int:
+        return self._entries.evictions
+
+    @property
+    def size(self) -> int:
+        return len(self._entries)
+
+
+# Verified access tokens mapped to the user they resolved to. An entry never
+# outlives the token's `exp` claim, and can be dropped per token or for every
+# token of a username when that user changes.
+class TokenCache:
+    def __init__(self, maxsize: int, ttl: float):
+        self.hits = 0
+        self.misses = 0
+        self._entries = LRUCache(maxsize, ttl)
+        self._tokens_by_user = {}
+
+    def get(self, token: str):
+        user = self._entries.get(token)
+        if user is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return user
+
+    # Like get(), without counting towards the hit rate.
+    def peek(self, token: str):
+        return self._entries.get(token)
+
+    def set(self, token: str, user, expires_at: float):
+        ttl = min(self._entries.ttl, expires_at - time.time())
+        if ttl <= 0:
+            return
+        self._entries.set(token, user, ttl)
+        tokens = {t for t in self._tokens_by_user.get(user.username, ()) if t in self._entries}
+        tokens.add(token)
+        self._tokens_by_user[user.username] = tokens
+
+    def revoke(self, token: str):
+        self._entries.pop(token)
+
+    def invalidate_user(self, username: str):
+        for token in self._tokens_by_user.pop(username, ()):
+            self._entries.pop(token)
+
+    def clear(self):
+        self._entries.clear()
+        self._tokens_by_user.clear()
+
+    def stats(self) -> dict:
+        return {
+            "namespace": "token",
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self._entries.evictions,
+            "size": len(self._entries),
+        }
+
+
+class RespError(Exception):
+    pass
+
+
+# Minimal client for the Redis serialization protocol (RESP), enough to share a
+# cache between worker processes through Redis or the local stand-in started
+# with `python -m server.cache`.
+class RespBackend(CacheBackend):
+    shared = True
+
+    def __init__(self, host: str = "localhost", port: int = 6379, db: int = 0):
+        self.host = host
+        self.port = port
+        self.db = db
+        self._lock = asyncio.Lock()
+        self._reader = None
+        self._writer = None
+
+    async def _connect(self):
+        self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        if self.db:
+            await self._roundtrip("SELECT", self.db)
+
+    async def _roundtrip(self, *args):
+        self._writer.write(encode_command(*args))
+        await self._writer.drain()
+        return await read_reply(self._reader)
+
+    async def execute(self, *args):
+        return (await self.pipeline(args))[0]
+
+    # Send several commands in one write and read their replies in order, so
+    # they cost a single round trip.
+    async def pipeline(self, *commands) -> list:
+        async with self._lock:
+            if self._writer is None:
+                await self._connect()
+            try:
+                self._writer.write(b"".join(encode_command(*args) for args in commands))
+                await self._writer.drain()
+                return [await read_reply(self._reader) for _ in commands]
+            except BaseException:
+                # A reply may be left half read; start over on a new connection.
+                self._writer.close()
+                self._writer = None
+                raise
+
+    async def get(self, key):
+        value = await self.execute("GET", key)
+        if value is None:
+            return None
+        return json.loads(value)
+
+    async def set(self, key, value, ttl: float = None):
+        if ttl:
+            await self.execute("SET", key, json.dumps(value), "PX", int(ttl * 1000))
+        else:
+            await self.execute("SET", key, json.dumps(value))
+
+    async def delete(self, *keys):
+        if keys:
+            await self.execute("DEL", *keys)
+
+    async def incr(self, key) -> int:
+        return await self.execute("INCR", key)
+
+
+def encode_command(*args) -> bytes:
+    out = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        if not isinstance(arg, bytes):
+            arg = str(arg).encode()
+        out.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+    return b"".join(out)
+
+
+def encode_reply(value) -> bytes:
+    if value is None:
+        return b"$-1\r\n"
+    if isinstance(value, RespError):
+        return b"-ERR %s\r\n" % str(value).encode()
+    if isinstance(value, bool):
+        return b"+OK\r\n" if value else b"$-1\r\n"
+    if isinstance(value, int):
+        return b":%d\r\n" % value
+    if isinstance(value, str):
+        value = value.encode()
+    return b"$%d\r\n%s\r\n" % (len(value), value)
+
+
+async def read_reply(reader):
+    line = await reader.readuntil(b"\r\n")
+    kind, rest = line[:1], line[1:-2]
+    if kind == b"+":
+        return rest.decode()
+    if kind == b"-":
+        raise RespError(rest.decode())
+    if kind == b":":
+        return int(rest)
+    if kind == b"$":
+        length = int(rest)
+        if length < 0:
+            return None
+        data = await reader.readexactly(length + 2)
+        return data[:-2]
+    if kind == b"*":
+        length = int(rest)
+        if length < 0:
+            return None
+        return [await read_reply(reader) for _ in range(length)]
+    raise RespError("Unexpected reply: {!r}".format(line))
+
+
+def backend_from_url(url: str, maxsize: int = 10000) -> CacheBackend:
+    parsed = urlparse(url)
+    if parsed.scheme == "memory":
+        return MemoryBackend(maxsize)
+    if parsed.scheme == "redis":
+        db = int(parsed.path.lstrip("/") or 0)
+        return RespBackend(parsed.hostname or "localhost", parsed.port or 6379, db)
+    raise ValueError("Unsupported cache backend: {}".format(url))
+
+
+# Read-through cache in front of an async loader. Concurrent misses on the same
+# key share one load, and a key invalidated while its load is in flight is not
+# written back, so a write never gets overwritten by the value it replaced.
+# Callers that shared a load get a copy each.
+#
+# A backend that is down never fails a request: reads go to the loader, and a
+# key whose invalidation didn't reach the backend is neither read from nor
+# written to it by this process until a retried delete gets through (or, with
+# a `ttl`, until the entry the backend holds has expired anyway).
+BACKEND_ERRORS = (OSError, RespError, asyncio.IncompleteReadError)
+
+
+class ReadThroughCache:
+    def __init__(self, backend: CacheBackend, namespace: str, ttl: float = None, maxsize: int = 10000):
+        self.backend = backend
+        self.namespace = namespace
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.errors = 0
+        self._inflight = {}
+        self._unsettled = LRUCache(maxsize, ttl)
+        # Added to the backend's generation for every bump() that failed.
+        self._bumped = 0
+
+    def _key(self, key) -> str:
+        return "{}:{}".format(self.namespace, key)
+
+    async def get_or_load(self, key, loader):
+        key = self._key(key)
+        value = None
+        if await self._settle(key):
+            try:
+                value = await self.backend.get(key)
+            except BACKEND_ERRORS:
+                self.errors += 1
+        if value is not None:
+            self.hits += 1
+            return value
+        self.misses += 1
+
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+            return copy.deepcopy(await asyncio.shield(task))
+        # The load runs as a task of its own: a caller that goes away, the
+        # first one included, must not cancel it for the others.
+        task = self._inflight[key] = asyncio.ensure_future(self._load(key, loader))
+        # Mark a failure retrieved, in case every caller went away.
+        task.add_done_callback(lambda task: task.cancelled() or task.exception())
+        return await asyncio.shield(task)
+
+    async def _load(self, key, loader):
+        try:
+            value = await loader()
+        finally:
+            # invalidate() drops the key from _inflight; the value is stale then.
+            stale = self._inflight.get(key) is not asyncio.current_task()
+            if not stale:
+                del self._inflight[key]
+        if value is not None and not stale and await self._settle(key):
+            try:
+                await self.backend.set(key, value, self.ttl)
+            except BACKEND_ERRORS:
+                self.errors += 1
+        return value
+
+    # Whether the backend can be used for `key`: true unless its invalidation
+    # failed and retrying it fails again.
+    async def _settle(self, key) -> bool:
+        if self._unsettled.get(key) is None:
+            return True
+        try:
+            await self.backend.delete(key)
+        except BACKEND_ERRORS:
+            self.errors += 1
+            return False
+        self._unsettled.pop(key)
+        return True
+
+    async def invalidate(self, *keys):
+        keys = [self._key(key) for key in keys]
+        for key in keys:
+            self._inflight.pop(key, None)
+        try:
+            await self.backend.delete(*keys)
+        except BACKEND_ERRORS as exc:
+            self.errors += 1
+            logger.warning("Could not invalidate %s in the %s cache: %s", keys, self.namespace, exc)
+            for key in keys:
+                self._unsettled.set(key, True)
+
+    # Keys built from `generation()` go stale all at once when `bump()` is
+    # called, which is how whole groups (e.g. listing pages) are invalidated.
+    async def generation(self) -> int:
+        try:
+            return (await self.backend.get(self._key("generation")) or 0) + self._bumped
+        except BACKEND_ERRORS:
+            self.errors += 1
+            return self._bumped
+
+    async def bump(self):
+        try:
+            await self.backend.incr(self._key("generation"))
+        except BACKEND_ERRORS as exc:
+            # Other workers keep the old generation until the entries expire,
+            # but this one moves on.
+            self.errors += 1
+            self._bumped += 1
+            logger.warning("Could not bump the %s cache generation: %s", self.namespace, exc)
+
+    def stats(self) -> dict:
+        return {
+            "namespace": self.namespace,
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.backend.evictions,
+            "errors": self.errors,
+            "size": self.backend.size,
+        }
+
+
+# Local stand-in for a Redis server, speaking the subset of RESP used by
+# RespBackend. Lets several uvicorn workers on one host share a cache without
+# installing Redis:  python -m server.cache --port 6380 --maxsize 100000
+class RespServer:
+    def __init__(self, maxsize: int):
+        self.entries = LRUCache(maxsize)
+        self.counters = {}
+        self.expires = {}
+
+    # Counters given a PEXPIRE are dropped once it passes; expired ones are
+    # swept whenever as many counters as were live after the last sweep have
+    # been created since.
+    def counter(self, key):
+        expires_at = self.expires.get(key)
+        if expires_at is not None and expires_at <= time.monotonic():
+            del self.expires[key]
+            del self.counters[key]
+        return self.counters.get(key)
+
+    def sweep(self):
+        now = time.monotonic()
+        for key in [key for key, expires_at in self.expires.items() if expires_at <= now]:
+            del self.expires[key]
+            del self.counters[key]
+        self.next_sweep = 2 * len(self.counters) + 1000
+
+    next_sweep = 1000
+
+    def command(self, args):
+        name = args[0].decode().upper()
+        if name == "PING":
+            return "PONG"
+        if name == "SELECT":
+            return True
+        if name == "GET":
+            key = args[1]
+            if self.counter(key) is not None:
+                return str(self.counters[key])
+            return self.entries.get(key)
+        if name == "SET":
+            ttl = None
+            if len(args) == 5 and args[3].upper() == b"PX":
+                ttl = int(args[4]) / 1000
+            self.entries.set(args[1], args[2], ttl)
+            return True
+        if name == "DEL":
+            removed = 0
+            for key in args[1:]:
+                self.expires.pop(key, None)
+                removed += self.entries.pop(key) is not None or self.counters.pop(key, None) is not None
+            return removed
+        if name == "INCR":
+            value = self.counter(args[1])
+            if value is None and len(self.counters) >= self.next_sweep:
+                self.sweep()
+            self.counters[args[1]] = (value or 0) + 1
+            return self.counters[args[1]]
+        if name == "PEXPIRE":
+            if self.counter(args[1]) is None:
+                return 0
+            self.expires[args[1]] = time.monotonic() + int(args[2]) / 1000
+            return 1
+        if name == "DBSIZE":
+            return len(self.entries) + len(self.counters)
+        return RespError("unknown command '{}'".format(name))
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                args = await read_reply(reader)
+                writer.write(encode_reply(self.command(args)))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host: str, port: int):
+        server = await asyncio.start_server(self.handle, host, port)
+        async with server:
+            await server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local Redis-protocol cache server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6379)
+    parser.add_argument("--maxsize", type=int, default=100000)
+    args = parser.parse_args()
+    asyncio.run(RespServer(args.maxsize).serve(args.host, args.port))
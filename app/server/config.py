@@ -0,0 +1,145 @@
+import os
+
+# Deployment settings, read from the environment with development defaults.
+
+
+def env_int(name: str, default: int) -> int:
+    return int(os.environ.get(name, default))
+
+
+def env_float(name: str, default: float) -> float:
+    return float(os.environ.get(name, default))
+
+
+# "rate/burst": `rate` requests per second on average, bursts of `burst`.
+def env_rule(name: str, default: str) -> tuple:
+    rate, _, burst = os.environ.get(name, default).partition("/")
+    return float(rate), int(burst or max(1, float(rate)))
+
+
+# MongoDB client. Pool sizes are per worker process; MONGO_COMPRESSORS is a
+# comma separated list such as "zstd,snappy,zlib" (zstd and snappy need the
+# zstandard / python-snappy packages, unavailable ones are skipped).
+MONGO_DETAILS = os.environ.get("MONGO_DETAILS", "mongodb://localhost:27017")
+MONGO_DATABASE = os.environ.get("MONGO_DATABASE", "Store")
+MONGO_MAX_POOL_SIZE = env_int("MONGO_MAX_POOL_SIZE", 100)
+MONGO_MIN_POOL_SIZE = env_int("MONGO_MIN_POOL_SIZE", 10)
+MONGO_WAIT_QUEUE_TIMEOUT_MS = env_int("MONGO_WAIT_QUEUE_TIMEOUT_MS", 2000)
+MONGO_SERVER_SELECTION_TIMEOUT_MS = env_int("MONGO_SERVER_SELECTION_TIMEOUT_MS", 5000)
+MONGO_COMPRESSORS = os.environ.get("MONGO_COMPRESSORS", "")
+MONGO_READ_PREFERENCE = os.environ.get("MONGO_READ_PREFERENCE", "primary")
+# Connections opened at startup so the first requests don't pay for them.
+MONGO_PREWARM_CONNECTIONS = env_int("MONGO_PREWARM_CONNECTIONS", MONGO_MIN_POOL_SIZE)
+
+# Product cache (see server/cache.py). "memory://" keeps it per worker,
+# "redis://host:port" shares it between workers.
+PRODUCT_CACHE_URL = os.environ.get("PRODUCT_CACHE_URL", "memory://")
+PRODUCT_CACHE_SIZE = env_int("PRODUCT_CACHE_SIZE", 10000)
+PRODUCT_CACHE_TTL = env_float("PRODUCT_CACHE_TTL", 300)
+# Cache-Control on product reads. The default lets only the client keep a copy
+# and revalidate it with its ETag; behind a CDN or caching proxy use e.g.
+# "public, max-age=30, stale-while-revalidate=60".
+CATALOG_CACHE_CONTROL = os.environ.get("CATALOG_CACHE_CONTROL", "private, no-cache")
+
+# Users resolved for authenticated requests are kept this long per worker, so a
+# disabled or deleted user can keep a fresh token working for up to the TTL.
+USER_CACHE_SIZE = env_int("USER_CACHE_SIZE", 10000)
+USER_CACHE_TTL = env_float("USER_CACHE_TTL", 30)
+
+# Password hashing pool (see server/passwords.py).
+HASH_WORKERS = env_int("HASH_WORKERS", max(1, (os.cpu_count() or 2) // 2))
+HASH_MAX_PENDING = env_int("HASH_MAX_PENDING", HASH_WORKERS * 8)
+HASH_QUEUE_TIMEOUT = env_float("HASH_QUEUE_TIMEOUT", 2.0)
+
+# Request metrics (see server/metrics.py). MongoDB commands slower than this
+# are logged with their collection and filter fields; 0 disables the log.
+METRICS_SLOW_QUERY_MS = env_float("METRICS_SLOW_QUERY_MS", 100)
+
+# Production server (app/serve.py). Every worker is a separate process with its
+# own MongoDB pool and hashing threads, so MONGO_MAX_POOL_SIZE and HASH_WORKERS
+# are multiplied by WEB_CONCURRENCY.
+HOST = os.environ.get("HOST", "0.0.0.0")
+PORT = env_int("PORT", 8000)
+WEB_CONCURRENCY = env_int("WEB_CONCURRENCY", os.cpu_count() or 1)
+KEEPALIVE_TIMEOUT = env_int("KEEPALIVE_TIMEOUT", 5)
+BACKLOG = env_int("BACKLOG", 2048)
+# Seconds a worker gets after SIGTERM to finish in-flight requests.
+GRACEFUL_TIMEOUT = env_int("GRACEFUL_TIMEOUT", 30)
+# Import the app once in the master so workers fork with it loaded.
+PRELOAD = os.environ.get("PRELOAD", "1").lower() not in ("0", "false", "no")
+# Recycle a worker after this many requests (plus up to 10% jitter); 0 never.
+MAX_REQUESTS = env_int("MAX_REQUESTS", 0)
+
+# Rate limits per client (user, or IP address before login), as "rate/burst"
+# (see server/ratelimit.py). RATE_LIMIT_URL is "memory://" for limits per
+# worker or "redis://host:port" to share them between workers.
+RATE_LIMIT_URL = os.environ.get("RATE_LIMIT_URL", "memory://")
+RATE_LIMIT_DEFAULT = env_rule("RATE_LIMIT_DEFAULT", "50/100")
+RATE_LIMIT_LOGIN = env_rule("RATE_LIMIT_LOGIN", "1/5")
+RATE_LIMIT_LISTING = env_rule("RATE_LIMIT_LISTING", "10/20")
+RATE_LIMIT_BULK = env_rule("RATE_LIMIT_BULK", "1/5")
+
+# Adaptive concurrency limit per worker: requests beyond it queue for at most
+# CONCURRENCY_QUEUE_TIMEOUT seconds (CONCURRENCY_MAX_QUEUE at a time) and are
+# shed with a 503 after that. The limit shrinks while requests take longer
+# than CONCURRENCY_TARGET_LATENCY seconds and grows back when they don't.
+CONCURRENCY_INITIAL = env_int("CONCURRENCY_INITIAL", 100)
+CONCURRENCY_MIN = env_int("CONCURRENCY_MIN", 10)
+CONCURRENCY_MAX = env_int("CONCURRENCY_MAX", 1000)
+CONCURRENCY_TARGET_LATENCY = env_float("CONCURRENCY_TARGET_LATENCY", 0.5)
+CONCURRENCY_QUEUE_TIMEOUT = env_float("CONCURRENCY_QUEUE_TIMEOUT", 1.0)
+CONCURRENCY_MAX_QUEUE = env_int("CONCURRENCY_MAX_QUEUE", 200)
+
+# Change feed (see server/events.py). EVENTS_SOURCE is "changestream" (replica
+# sets and sharded clusters), "journal" (a capped collection of
+# EVENTS_JOURNAL_BYTES the writes append to, for standalone dev instances) or
+# "auto" to pick by what the server supports. Each worker keeps the last
+# EVENTS_BUFFER_SIZE events for reconnecting subscribers; a subscriber more
+# than EVENTS_QUEUE_SIZE events behind is disconnected and resumes from its
+# last event id. Streams end after EVENTS_MAX_STREAM_SECONDS (clients
+# reconnect) so they don't hold a worker's shutdown for GRACEFUL_TIMEOUT.
+EVENTS_SOURCE = os.environ.get("EVENTS_SOURCE", "auto")
+EVENTS_BUFFER_SIZE = env_int("EVENTS_BUFFER_SIZE", 10000)
+EVENTS_QUEUE_SIZE = env_int("EVENTS_QUEUE_SIZE", 1000)
+EVENTS_HEARTBEAT = env_float("EVENTS_HEARTBEAT", 15)
+EVENTS_MAX_STREAM_SECONDS = env_float("EVENTS_MAX_STREAM_SECONDS", 300)
+EVENTS_JOURNAL_BYTES = env_int("EVENTS_JOURNAL_BYTES", 64 * 1024 * 1024)
+EVENTS_POLL_INTERVAL = env_float("EVENTS_POLL_INTERVAL", 1.0)
+
+# Background jobs (see server/jobs.py). Every web worker runs JOBS_WORKERS jobs
+# at a time; set it to 0 to run them only in `python -m server.jobs`, which
+# uses JOBS_RUNNER_WORKERS. A claimed job is leased for JOBS_LEASE seconds (its
+# time limit); a worker that dies mid-job leaves it to be picked up again once
+# the lease runs out. Failed attempts are retried after
+# JOBS_BACKOFF_BASE * 2^(attempt - 1) seconds (at most JOBS_BACKOFF_MAX, with
+# jitter) until JOBS_MAX_ATTEMPTS; finished jobs are kept JOBS_RETENTION
+# seconds.
+JOBS_WORKERS = env_int("JOBS_WORKERS", 4)
+JOBS_RUNNER_WORKERS = env_int("JOBS_RUNNER_WORKERS", 16)
+JOBS_POLL_INTERVAL = env_float("JOBS_POLL_INTERVAL", 1.0)
+JOBS_LEASE = env_float("JOBS_LEASE", 60)
+JOBS_MAX_ATTEMPTS = env_int("JOBS_MAX_ATTEMPTS", 5)
+JOBS_BACKOFF_BASE = env_float("JOBS_BACKOFF_BASE", 2.0)
+JOBS_BACKOFF_MAX = env_float("JOBS_BACKOFF_MAX", 300)
+JOBS_RETENTION = env_int("JOBS_RETENTION", 7 * 24 * 3600)
+JOBS_SHUTDOWN_TIMEOUT = env_float("JOBS_SHUTDOWN_TIMEOUT", 10)
+
+# Archival (see archive_baskets in server/database.py). Delivered baskets not
+# updated for ARCHIVE_AFTER_DAYS days move from basket_collection to the
+# basket_archive collection, stored with ARCHIVE_COMPRESSOR, in batches of
+# ARCHIVE_BATCH_SIZE run as a background job every ARCHIVE_INTERVAL seconds
+# (0 disables it). Each basket is removed from basket_collection with a delete
+# of its own, ARCHIVE_CONCURRENCY of them in flight at a time.
+ARCHIVE_AFTER_DAYS = env_float("ARCHIVE_AFTER_DAYS", 30)
+ARCHIVE_INTERVAL = env_float("ARCHIVE_INTERVAL", 3600)
+ARCHIVE_BATCH_SIZE = env_int("ARCHIVE_BATCH_SIZE", 1000)
+ARCHIVE_CONCURRENCY = env_int("ARCHIVE_CONCURRENCY", 8)
+ARCHIVE_COMPRESSOR = os.environ.get("ARCHIVE_COMPRESSOR", "zstd")
+
+# Analytics line totals (see tally_baskets in server/database.py). A background
+# job every TALLY_INTERVAL seconds (0 disables it) adds the baskets written
+# since the last one, TALLY_BATCH_SIZE at a time, with TALLY_CONCURRENCY basket
+# writes in flight; bulk deletes run that many deletes at a time.
+TALLY_INTERVAL = env_float("TALLY_INTERVAL", 10)
+TALLY_BATCH_SIZE = env_int("TALLY_BATCH_SIZE", 1000)
+TALLY_CONCURRENCY = env_int("TALLY_CONCURRENCY", 8)
@@ -1,15 +1,97 @@
+import asyncio
+import base64
+import json
+import logging
+import os
+import re
+import socket
+import time
+from datetime import datetime, timedelta
+
+from bson.errors import InvalidId
 from bson.objectid import ObjectId
+from bson.timestamp import Timestamp
 import motor.motor_asyncio
+from pymongo import ReplaceOne, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError
+
+from server import config
+from server.cache import MemoryBackend, ReadThroughCache, backend_from_url
+from server.metrics import command_metrics
+from server.passwords import get_password_hash
+from server.pool import PoolMetrics
+from server.responses import raw_document
+from server.search import search_index
+
+logger = logging.getLogger(__name__)
+
+# Delivered baskets past ARCHIVE_AFTER_DAYS (see archive_baskets), and what
+# the reports need from them, added up as they are archived.
+ARCHIVE_COLLECTION = "basket_archive"
+ARCHIVE_TOTALS_COLLECTION = "basket_archive_totals"
+# The same for the baskets still in basket_collection (see tally_baskets).
+LINE_TOTALS_COLLECTION = "basket_line_totals"
+
+# Listing endpoints return pages of at most this many documents.
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# The client and collections are created by connect() when the application
+# starts (after any worker fork) and closed by disconnect() on shutdown.
+client = None
+database = None
+user_collection = None
+product_collection = None
+basket_collection = None
+job_collection = None
+archive_collection = None
+
+pool_metrics = PoolMetrics()
+
+product_cache = ReadThroughCache(
+    backend_from_url(config.PRODUCT_CACHE_URL, config.PRODUCT_CACHE_SIZE),
+    namespace="product",
+    ttl=config.PRODUCT_CACHE_TTL,
+)
+
+user_cache = ReadThroughCache(MemoryBackend(config.USER_CACHE_SIZE), namespace="user", ttl=config.USER_CACHE_TTL)
+
+
+def connect():
+    global client, database, user_collection, product_collection, basket_collection, job_collection, archive_collection
+    options = {
+        "maxPoolSize": config.MONGO_MAX_POOL_SIZE,
+        "minPoolSize": config.MONGO_MIN_POOL_SIZE,
+        "waitQueueTimeoutMS": config.MONGO_WAIT_QUEUE_TIMEOUT_MS,
+        "serverSelectionTimeoutMS": config.MONGO_SERVER_SELECTION_TIMEOUT_MS,
+        "readPreference": config.MONGO_READ_PREFERENCE,
+        "event_listeners": [pool_metrics, command_metrics],
+    }
+    if config.MONGO_COMPRESSORS:
+        options["compressors"] = config.MONGO_COMPRESSORS
+    client = motor.motor_asyncio.AsyncIOMotorClient(config.MONGO_DETAILS, **options)
+    database = client.get_database(config.MONGO_DATABASE)
+    user_collection = database.get_collection("users_collection")
+    product_collection = database.get_collection("product_collection")
+    basket_collection = database.get_collection("basket_collection")
+    job_collection = database.get_collection("job_collection")
+    archive_collection = database.get_collection(ARCHIVE_COLLECTION)
+
 
-MONGO_DETAILS = "mongodb://localhost:27017"
+# Open `connections` pool connections up front: concurrent pings each check
+# out their own connection, so the first requests find them ready.
+async def prewarm(connections: int = config.MONGO_PREWARM_CONNECTIONS):
+    await asyncio.gather(*(database.command("ping") for _ in range(max(1, connections))))
 
-client = motor.motor_asyncio.AsyncIOMotorClient(MONGO_DETAILS)
 
-database = client.Store
+def disconnect():
+    global client
+    if client is not None:
+        client.close()
+        client = None
 
-user_collection = database.get_collection("users_collection")
-product_collection = database.get_collection("product_collection")
-basket_collection = database.get_collection("basket_collection")
+
+USER_FIELDS = ("username", "first_name", "last_name", "email", "national_id", "disabled")
 
 
 def user_helper(user) -> dict:
@@ -19,29 +101,319 @@ def user_helper(user) -> dict:
         "first_name": user["first_name"],
         "last_name": user["last_name"],
         "email": user["email"],
-        "password": user["password"],
-        "national_id":user["national_id"]
+        "national_id":user["national_id"],
+        "disabled": user.get("disabled", False),
     }
 
-# Retrieve all users present in the database
 
-async def retrieve_users():
+# Keyset pagination: documents are walked in sort order with `_id` as the
+# tie-breaker and `after` is the cursor of the last document of the previous
+# page, so each page is an index range scan no matter how deep into the
+# collection it is. `sort` is a field name, prefixed with "-" for descending.
+def sort_spec(sort: str = None):
+    if not sort:
+        return "_id", 1
+    if sort.startswith("-"):
+        return sort[1:], -1
+    return sort, 1
+
+
+# In the default `_id` order the cursor is the plain id. For other orders the
+# sort value travels in the cursor too, so the next page can seek past it
+# without reading the previous document again.
+def encode_cursor(document: dict, sort: str = None) -> str:
+    field, _ = sort_spec(sort)
+    if field == "_id":
+        return document["id"]
+    raw = json.dumps([document.get(field), document["id"]], default=str)
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(after: str, sort: str = None):
+    field, _ = sort_spec(sort)
+    try:
+        if field == "_id":
+            return None, ObjectId(after)
+        value, id = json.loads(base64.urlsafe_b64decode(after.encode()))
+        return value, ObjectId(id)
+    except (ValueError, TypeError, InvalidId):
+        raise ValueError("Invalid cursor: {}".format(after))
+
+
+# Documents whose sort field is null or missing (older ones may lack
+# created_at/updated_at) sort before every value, so they come first in
+# ascending order and last in descending order. A range condition never
+# matches null, so the boundary between the two gets branches of its own.
+def keyset_query(query: dict, sort: str = None, after: str = None) -> dict:
+    if not after:
+        return query
+    field, direction = sort_spec(sort)
+    value, id = decode_cursor(after, sort)
+    op = "$gt" if direction > 0 else "$lt"
+    if field == "_id":
+        keyset = {"_id": {op: id}}
+    elif value is None and direction > 0:
+        keyset = {"$or": [{field: None, "_id": {op: id}}, {field: {"$ne": None}}]}
+    elif value is None:
+        keyset = {field: None, "_id": {op: id}}
+    elif direction > 0:
+        keyset = {"$or": [{field: {op: value}}, {field: value, "_id": {op: id}}]}
+    else:
+        keyset = {"$or": [{field: {op: value}}, {field: value, "_id": {op: id}}, {field: None}]}
+    if query:
+        return {"$and": [query, keyset]}
+    return keyset
+
+
+# Fields a listing returns: the requested ones (all when `fields` is None)
+# plus the sort field, which the next cursor is built from.
+def listing_fields(all_fields: tuple, fields: tuple = None, sort: str = None) -> tuple:
+    if not fields:
+        return all_fields
+    field, _ = sort_spec(sort)
+    if field != "_id" and field not in fields:
+        return tuple(fields) + (field,)
+    return tuple(fields)
+
+
+def sort_order(sort: str = None) -> list:
+    field, direction = sort_spec(sort)
+    if field == "_id":
+        return [("_id", direction)]
+    return [(field, direction), ("_id", direction)]
+
+
+def listing_cursor(collection, query: dict = None, sort: str = None, after: str = None, limit: int = 0,
+                   fields: tuple = None):
+    order = sort_order(sort)
+    projection = dict.fromkeys(fields, 1) if fields else None
+    return collection.find(keyset_query(query or {}, sort, after), projection).sort(order).limit(limit)
+
+
+# A page as the driver returns it, converted in place by raw_document() rather
+# than rebuilt by a helper. The projection keeps the output to the listed
+# fields; unlike the helpers, a field a document lacks is left out, not null.
+async def raw_listing(collection, query: dict = None, sort: str = None, after: str = None, limit: int = 0,
+                      fields: tuple = None) -> list:
+    documents = await listing_cursor(collection, query, sort, after, limit, fields).to_list(limit or None)
+    for document in documents:
+        raw_document(document)
+    return documents
+
+
+# Bulk writes are sent unordered in as few batches as the driver allows. Each
+# returns one result per input item, {"id": ..., "error": None} on success or
+# with the reason the item was not written.
+def bulk_errors(exc: BulkWriteError) -> dict:
+    return {error["index"]: error["errmsg"] for error in exc.details["writeErrors"]}
+
+
+async def bulk_insert(collection, documents: list) -> list:
+    if not documents:
+        return []
+    errors = {}
+    try:
+        await collection.insert_many(documents, ordered=False)
+    except BulkWriteError as exc:
+        errors = bulk_errors(exc)
+    # insert_many assigns `_id` to every document before sending it.
+    return [{"id": str(document["_id"]), "error": errors.get(index)} for index, document in enumerate(documents)]
+
+
+async def bulk_update(collection, updates: list, make_update=lambda data: {"$set": data}) -> list:
+    results = [{"id": id, "error": None} for id, _ in updates]
+    operations, object_ids, positions = [], [], []
+    for index, (id, data) in enumerate(updates):
+        if not ObjectId.is_valid(id):
+            results[index]["error"] = "invalid id"
+        elif not data:
+            results[index]["error"] = "empty update"
+        else:
+            operations.append(UpdateOne({"_id": ObjectId(id)}, make_update(data)))
+            object_ids.append(ObjectId(id))
+            positions.append(index)
+    if not operations:
+        return results
+    existing = await existing_ids(collection, object_ids)
+    errors = {}
+    try:
+        await collection.bulk_write(operations, ordered=False)
+    except BulkWriteError as exc:
+        errors = bulk_errors(exc)
+    for op_index, index in enumerate(positions):
+        if op_index in errors:
+            results[index]["error"] = errors[op_index]
+        elif object_ids[op_index] not in existing:
+            results[index]["error"] = "not found"
+    return results
+
+
+async def bulk_delete(collection, ids: list) -> list:
+    results = [{"id": id, "error": None if ObjectId.is_valid(id) else "invalid id"} for id in ids]
+    object_ids = [ObjectId(id) for id in ids if ObjectId.is_valid(id)]
+    if not object_ids:
+        return results
+    existing = await existing_ids(collection, object_ids)
+    await collection.delete_many({"_id": {"$in": object_ids}})
+    for result in results:
+        if result["error"] is None and ObjectId(result["id"]) not in existing:
+            result["error"] = "not found"
+    return results
+
+
+# One `$in` query telling which of the given ids exist, so bulk results can
+# report missing documents without a lookup per item.
+async def existing_ids(collection, object_ids: list) -> set:
+    found = set()
+    async for document in collection.find({"_id": {"$in": object_ids}}, {"_id": 1}):
+        found.add(document["_id"])
+    return found
+
+
+def written_ids(results: list) -> list:
+    return [result["id"] for result in results if result["error"] is None]
+
+
+# Change journal (see server/events.py). A standalone mongod has no change
+# streams, so there every product and basket write also appends one entry per
+# written document to a capped collection that the change feed tails. The
+# server replaces the empty `ts` with a unique, increasing timestamp. Entries
+# name the process that wrote them (see origin()). Entries are best effort: a
+# write whose entry fails is logged and not retried.
+JOURNAL_COLLECTION = "change_journal"
+journal_enabled = False
+
+
+# This process, as "host:pid"; read on every call, workers fork after import.
+def origin() -> str:
+    return "{}:{}".format(socket.gethostname(), os.getpid())
+
+
+async def journal(collection: str, operation: str, ids: list):
+    if not journal_enabled or not ids:
+        return
+    entries = [
+        {"ts": Timestamp(0, 0), "collection": collection, "operation": operation, "id": id, "origin": origin()}
+        for id in ids
+    ]
+    try:
+        await database[JOURNAL_COLLECTION].insert_many(entries)
+    except PyMongoError as exc:
+        logger.warning("Could not journal %s of %d %s(s): %s", operation, len(ids), collection, exc)
+
+
+# Coalesces single-document lookups: every id asked for in the same event loop
+# tick is fetched with one `$in` query, and each id only once. Nothing is kept
+# past its batch, so one loader serves all requests without going stale.
+# Malformed ids load as None, like missing documents.
+class BatchLoader:
+    def __init__(self, collection: str):
+        self.collection = collection
+        self.batches = 0
+        self.loads = 0
+        self._pending = {}
+
+    async def load(self, id: str):
+        if not ObjectId.is_valid(id):
+            return None
+        self.loads += 1
+        future = self._pending.get(id)
+        if future is None:
+            loop = asyncio.get_event_loop()
+            if not self._pending:
+                loop.call_soon(self._dispatch)
+            future = self._pending[id] = loop.create_future()
+        # One caller going away must not cancel the lookup for the others.
+        return await asyncio.shield(future)
+
+    def _dispatch(self):
+        pending, self._pending = self._pending, {}
+        self.batches += 1
+        asyncio.ensure_future(self._fetch(pending))
+
+    async def _fetch(self, pending: dict):
+        try:
+            documents = {}
+            query = {"_id": {"$in": [ObjectId(id) for id in pending]}}
+            async for document in database[self.collection].find(query):
+                documents[str(document["_id"])] = document
+        except Exception as exc:
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(exc)
+                    # Mark it retrieved, callers that went away never will.
+                    future.exception()
+            return
+        for id, future in pending.items():
+            if not future.done():
+                future.set_result(documents.get(id))
+
+    def stats(self) -> dict:
+        return {"collection": self.collection, "loads": self.loads, "batches": self.batches}
+
+
+user_loader = BatchLoader("users_collection")
+product_loader = BatchLoader("product_collection")
+basket_loader = BatchLoader("basket_collection")
+archive_loader = BatchLoader(ARCHIVE_COLLECTION)
+
+
+# Multi-get: the documents for `ids` in their order, looked up concurrently so
+# the loaders fetch them in one batch. Ids that are malformed or match nothing
+# get {"id": ..., "error": ...} in their place.
+async def retrieve_many(retrieve, ids: list) -> list:
+    unique = list(dict.fromkeys(id for id in ids if ObjectId.is_valid(id)))
+    found = dict(zip(unique, await asyncio.gather(*(retrieve(id) for id in unique))))
+    results = []
+    for id in ids:
+        if not ObjectId.is_valid(id):
+            results.append({"id": id, "error": "invalid id"})
+        elif found[id] is None:
+            results.append({"id": id, "error": "not found"})
+        else:
+            results.append({**found[id], "error": None})
+    return results
+
+
+# Retrieve a page of users present in the database
+
+async def retrieve_users(limit: int = DEFAULT_PAGE_SIZE, after: str = None, raw: bool = False):
+    if raw:
+        return await raw_listing(user_collection, None, None, after, limit, USER_FIELDS)
     users = []
-    async for user in user_collection.find():
+    async for user in listing_cursor(user_collection, after=after, limit=limit):
         users.append(user_helper(user))
     return users
 
 
-# Add a new user into to the database
+# Yield users one by one as the cursor produces them, for streamed responses
+async def stream_users(after: str = None, limit: int = 0):
+    async for user in listing_cursor(user_collection, after=after, limit=limit):
+        yield user_helper(user)
+
+
+# Passwords are only ever stored as bcrypt hashes, under `hashed_password`.
+async def hash_password_field(data: dict) -> dict:
+    if "password" in data:
+        data["hashed_password"] = await get_password_hash(data.pop("password"))
+    return data
+
+
+# Add a new user into to the database. Usernames and emails are unique
+# indexes, so a taken one is rejected by the insert itself (returns None).
 async def add_user(user_data: dict) -> dict:
-    user = await user_collection.insert_one(user_data)
-    new_user = await user_collection.find_one({"_id": user.inserted_id})
-    return user_helper(new_user)
+    await hash_password_field(user_data)
+    user_data.setdefault("disabled", False)
+    try:
+        user = await user_collection.insert_one(user_data)
+    except DuplicateKeyError:
+        return None
+    return user_helper({**user_data, "_id": user.inserted_id})
 
 
 # Retrieve a user with a matching ID
 async def retrieve_user(id: str) -> dict:
-    user = await user_collection.find_one({"_id": ObjectId(id)})
+    user = await user_loader.load(id)
     if user:
         return user_helper(user)
 
@@ -51,53 +423,159 @@ async def update_user(id: str, data: dict):
     # Return false if an empty request body is sent.
     if len(data) < 1:
         return False
-    user = await user_collection.find_one({"_id": ObjectId(id)})
-    if user:
-        updated_user = await user_collection.update_one(
-            {"_id": ObjectId(id)}, {"$set": data}
-        )
-        if updated_user:
-            return True
-        return False
+    await hash_password_field(data)
+    previous = await user_collection.find_one_and_update(
+        {"_id": ObjectId(id)}, {"$set": data}, return_document=ReturnDocument.BEFORE
+    )
+    if previous:
+        await user_cache.invalidate(previous["username"], data.get("username", previous["username"]))
+        return user_helper({**previous, **data})
+    return False
 
 
-# Delete a user from the database
-async def delete_user(id: str):
-    user = await user_collection.find_one({"_id": ObjectId(id)})
-    if user:
-        await user_collection.delete_one({"_id": ObjectId(id)})
-        return True
+# What authentication needs of a user, by username (the username_unique index).
+# `password` is only there on users stored before passwords were hashed.
+AUTH_FIELDS = ("username", "email", "first_name", "last_name", "disabled", "hashed_password", "password")
+
 
+async def retrieve_auth_user(username: str) -> dict:
+    return await user_collection.find_one({"username": username}, dict.fromkeys(AUTH_FIELDS, 1))
 
-def product_helper(product) -> dict:
+
+# The user behind an authenticated request, without any password fields.
+# Cached for USER_CACHE_TTL seconds; a missing user is not cached.
+async def retrieve_active_user(username: str) -> dict:
+    async def load():
+        user = await user_collection.find_one({"username": username}, dict.fromkeys(AUTH_FIELDS[:5], 1))
+        if user:
+            return auth_user_helper(user)
+
+    return await user_cache.get_or_load(username, load)
+
+
+def auth_user_helper(user) -> dict:
+    names = [user.get("first_name"), user.get("last_name")]
     return {
-        "id": str(product["_id"]),
-        "name": product["name"],
-        "description": product["description"],
-        "price": product["price"],
+        "username": user["username"],
+        "email": user.get("email"),
+        "full_name": " ".join(name for name in names if name) or None,
+        "disabled": user.get("disabled", False),
     }
 
-# Retrieve all products present in the database
 
-async def retrieve_products():
-    products = []
-    async for product in product_collection.find():
-        products.append(product_helper(product))
-    return products
+# Replace a user's stored password with a new hash, dropping any plaintext.
+async def store_password_hash(username: str, hashed_password: str):
+    await user_collection.update_one(
+        {"username": username}, {"$set": {"hashed_password": hashed_password}, "$unset": {"password": ""}}
+    )
+
+
+# Delete a user from the database, returning the username it had so that
+# cached logins can be revoked
+async def delete_user(id: str):
+    deleted = await user_collection.find_one_and_delete({"_id": ObjectId(id)}, {"username": 1})
+    if deleted:
+        await user_cache.invalidate(deleted["username"])
+        return deleted
+    return False
+
+
+# Products and baskets carry a server-maintained `updated_at` and a `version`
+# that every write increments. Baskets use the version for optimistic
+# concurrency (If-Match on the item routes), product reads for their ETags.
+# Timestamps are stored as ISO strings, like jsonable_encoder writes them.
+def now() -> str:
+    return datetime.utcnow().isoformat()
+
+
+def stamp_new(document: dict) -> dict:
+    document["updated_at"] = now()
+    document["version"] = 1
+    return document
+
+
+def versioned_write(data: dict = None, **operators) -> dict:
+    update = {"$set": {**(data or {}), "updated_at": now()}, "$inc": {"version": 1}}
+    for operator, fields in operators.items():
+        update.setdefault("$" + operator, {}).update(fields)
+    return update
+
+
+PRODUCT_FIELDS = ("name", "description", "price", "updated_at", "version")
+PRODUCT_SORT_FIELDS = ("name", "price")
+
+
+def product_helper(product, fields: tuple = PRODUCT_FIELDS) -> dict:
+    helper = {"id": str(product["_id"])}
+    for field in fields:
+        helper[field] = product.get(field)
+    return helper
+
+
+# Filter for product listings: an inclusive price range and/or a name prefix.
+# An anchored, case-sensitive prefix regex is answered from the name index.
+def product_query(min_price: float = None, max_price: float = None, name_prefix: str = None) -> dict:
+    query = {}
+    if min_price is not None or max_price is not None:
+        query["price"] = {}
+        if min_price is not None:
+            query["price"]["$gte"] = min_price
+        if max_price is not None:
+            query["price"]["$lte"] = max_price
+    if name_prefix:
+        query["name"] = {"$regex": "^" + re.escape(name_prefix)}
+    return query
+
+# Retrieve a page of products present in the database
+
+async def retrieve_products(limit: int = DEFAULT_PAGE_SIZE, after: str = None, query: dict = None,
+                            sort: str = None, fields: tuple = None, raw: bool = False):
+    fields = listing_fields(PRODUCT_FIELDS, fields, sort)
+    # Page ETags are built from the versions, so they are always read (the
+    # route drops them again when `fields` leaves them out).
+    if "version" not in fields:
+        fields += ("version",)
+
+    async def load():
+        if raw:
+            return await raw_listing(product_collection, query, sort, after, limit, fields)
+        products = []
+        async for product in listing_cursor(product_collection, query, sort, after, limit, fields):
+            products.append(product_helper(product, fields))
+        return products
+
+    generation = await product_cache.generation()
+    key = json.dumps([generation, after, limit, query, sort, fields, raw], default=str, sort_keys=True)
+    return await product_cache.get_or_load("page:" + key, load)
+
+
+# Yield products one by one as the cursor produces them, for streamed responses
+async def stream_products(after: str = None, limit: int = 0, query: dict = None, sort: str = None,
+                          fields: tuple = None):
+    fields = listing_fields(PRODUCT_FIELDS, fields, sort)
+    async for product in listing_cursor(product_collection, query, sort, after, limit, fields):
+        yield product_helper(product, fields)
 
 
 # Add a new product into to the database
 async def add_product(product_data: dict) -> dict:
-    product = await product_collection.insert_one(product_data)
-    new_product = await product_collection.find_one({"_id": product.inserted_id})
-    return product_helper(new_product)
+    product = await product_collection.insert_one(stamp_new(product_data))
+    await product_cache.bump()
+    search_index.add(str(product.inserted_id), product_data)
+    await journal("product", "insert", [str(product.inserted_id)])
+    return product_helper({**product_data, "_id": product.inserted_id})
 
 
 # Retrieve a product with a matching ID
 async def retrieve_product(id: str) -> dict:
-    product = await product_collection.find_one({"_id": ObjectId(id)})
-    if product:
-        return product_helper(product)
+    async def load():
+        product = await product_loader.load(id)
+        if product:
+            return product_helper(product)
+
+    if not ObjectId.is_valid(id):
+        return None
+    return await product_cache.get_or_load(id, load)
 
 
 # Update a product with a matching ID
@@ -105,53 +583,211 @@ async def update_product(id: str, data: dict):
     # Return false if an empty request body is sent.
     if len(data) < 1:
         return False
-    product = await product_collection.find_one({"_id": ObjectId(id)})
-    if product:
-        updated_product = await product_collection.update_one(
-            {"_id": ObjectId(id)}, {"$set": data}
-        )
-        if updated_product:
-            return True
-        return False
+    updated_product = await product_collection.find_one_and_update(
+        {"_id": ObjectId(id)}, versioned_write(data), return_document=ReturnDocument.AFTER
+    )
+    await invalidate_product(id)
+    if updated_product:
+        search_index.add(id, updated_product)
+        await journal("product", "update", [id])
+        return product_helper(updated_product)
+    return False
 
 
 # Delete a product from the database
 async def delete_product(id: str):
-    product = await product_collection.find_one({"_id": ObjectId(id)})
-    if product:
-        await product_collection.delete_one({"_id": ObjectId(id)})
-        return True
+    deleted = await product_collection.delete_one({"_id": ObjectId(id)})
+    await invalidate_product(id)
+    search_index.remove(id)
+    if deleted.deleted_count:
+        await journal("product", "delete", [id])
+    return deleted.deleted_count > 0
 
-def basket_helper(basket) -> dict:
-    return {
-        "id": str(basket["_id"]),
-        "items": basket["items"],
-        "created_at": basket["created_at"],
-        "updated_at": basket["updated_at"],
-        "status": basket["status"],
+
+# Drop products and every cached listing page after they were written
+async def invalidate_product(*ids: str):
+    await product_cache.invalidate(*ids)
+    await product_cache.bump()
+
+
+async def add_products_bulk(documents: list) -> list:
+    documents = [stamp_new(document) for document in documents]
+    results = await bulk_insert(product_collection, documents)
+    await product_cache.bump()
+    for document, result in zip(documents, results):
+        if result["error"] is None:
+            search_index.add(result["id"], document)
+    await journal("product", "insert", written_ids(results))
+    return results
+
+
+async def update_products_bulk(updates: list) -> list:
+    results = await bulk_update(product_collection, updates, versioned_write)
+    await invalidate_product(*(id for id, _ in updates))
+    await reindex_products(written_ids(results))
+    await journal("product", "update", written_ids(results))
+    return results
+
+
+async def delete_products_bulk(ids: list) -> list:
+    results = await bulk_delete(product_collection, ids)
+    await invalidate_product(*ids)
+    for result in results:
+        if result["error"] is None:
+            search_index.remove(result["id"])
+    await journal("product", "delete", written_ids(results))
+    return results
+
+
+# Search index maintenance (see server/search.py). Bulk updates only send the
+# changed fields, so the products are read back, with one `$in` query.
+SEARCH_FIELDS = {"name": 1, "description": 1}
+
+
+async def reindex_products(ids: list):
+    if not ids:
+        return
+    async for product in product_collection.find({"_id": {"$in": [ObjectId(id) for id in ids]}}, SEARCH_FIELDS):
+        search_index.add(str(product["_id"]), product)
+
+
+# Index the whole catalog; products written meanwhile are indexed by their
+# writes and skipped here.
+async def build_search_index(batch_size: int = 1000):
+    search_index.start_build()
+    try:
+        read = 0
+        async for product in product_collection.find({}, SEARCH_FIELDS, batch_size=batch_size):
+            search_index.build_add(str(product["_id"]), product)
+            read += 1
+            if read % batch_size == 0:
+                # Let requests run between batches.
+                await asyncio.sleep(0)
+        for _ in search_index.warm():
+            await asyncio.sleep(0)
+    except BaseException:
+        search_index.abort_build()
+        raise
+    search_index.finish_build()
+
+BASKET_FIELDS = ("items", "created_at", "updated_at", "status", "version")
+BASKET_SORT_FIELDS = ("created_at", "updated_at", "status")
+
+
+def basket_helper(basket, fields: tuple = BASKET_FIELDS) -> dict:
+    helper = {"id": str(basket["_id"])}
+    for field in fields:
+        helper[field] = basket.get(field)
+    return helper
+
+
+# Filter for basket listings: a status and/or a created_at window (inclusive
+# start, exclusive end). Timestamps are stored the way jsonable_encoder writes
+# them, as ISO 8601 strings, which order the same way as the datetimes.
+def basket_query(status: str = None, created_after=None, created_before=None) -> dict:
+    query = {}
+    if status:
+        query["status"] = status
+    if created_after is not None or created_before is not None:
+        query["created_at"] = {}
+        if created_after is not None:
+            query["created_at"]["$gte"] = created_after.isoformat()
+        if created_before is not None:
+            query["created_at"]["$lt"] = created_before.isoformat()
+    return query
+
+# Attach the referenced product to every line item of the given baskets with
+# one `$in` query for all of them, however many items they hold. Lines whose
+# product no longer exists get "product": None; legacy untyped items are left
+# as they are.
+async def hydrate_baskets(baskets: list) -> list:
+    product_ids = {
+        item["product_id"]
+        for basket in baskets
+        for item in basket.get("items") or ()
+        if isinstance(item, dict) and ObjectId.is_valid(item.get("product_id") or "")
     }
+    products = {}
+    if product_ids:
+        query = {"_id": {"$in": [ObjectId(id) for id in product_ids]}}
+        async for product in product_collection.find(query):
+            products[str(product["_id"])] = product_helper(product)
+    hydrated = []
+    for basket in baskets:
+        items = basket.get("items")
+        if items is not None:
+            items = [
+                {**item, "product": products.get(item.get("product_id"))} if isinstance(item, dict) else item
+                for item in items
+            ]
+            basket = {**basket, "items": items}
+        hydrated.append(basket)
+    return hydrated
+
 
-# Retrieve all baskets present in the database
+# Hydrate a stream of baskets a batch at a time, one product query per batch.
+async def hydrate_basket_stream(baskets, batch_size: int = 100):
+    batch = []
+    async for basket in baskets:
+        batch.append(basket)
+        if len(batch) >= batch_size:
+            for hydrated in await hydrate_baskets(batch):
+                yield hydrated
+            batch = []
+    if batch:
+        for hydrated in await hydrate_baskets(batch):
+            yield hydrated
 
-async def retrieve_baskets():
+
+# Retrieve a page of baskets present in the database
+
+async def retrieve_baskets(limit: int = DEFAULT_PAGE_SIZE, after: str = None, query: dict = None,
+                           sort: str = None, fields: tuple = None, raw: bool = False):
+    fields = listing_fields(BASKET_FIELDS, fields, sort)
+    if raw:
+        return await raw_listing(basket_collection, query, sort, after, limit, fields)
     baskets = []
-    async for basket in basket_collection.find():
-        baskets.append(basket_helper(basket))
+    async for basket in listing_cursor(basket_collection, query, sort, after, limit, fields):
+        baskets.append(basket_helper(basket, fields))
     return baskets
 
 
+# Yield baskets one by one as the cursor produces them, for streamed responses
+async def stream_baskets(after: str = None, limit: int = 0, query: dict = None, sort: str = None,
+                         fields: tuple = None):
+    fields = listing_fields(BASKET_FIELDS, fields, sort)
+    async for basket in listing_cursor(basket_collection, query, sort, after, limit, fields):
+        yield basket_helper(basket, fields)
+
+
+def stamp_new_basket(basket_data: dict) -> dict:
+    basket_data["created_at"] = basket_data.get("created_at") or now()
+    return stamp_new(basket_data)
+
+
+class VersionConflict(Exception):
+    pass
+
+
 # Add a new basket into to the database
 async def add_basket(basket_data: dict) -> dict:
-    basket = await basket_collection.insert_one(basket_data)
-    new_basket = await basket_collection.find_one({"_id": basket.inserted_id})
-    return basket_helper(new_basket)
+    basket = await basket_collection.insert_one(stamp_new_basket(basket_data))
+    await journal("basket", "insert", [str(basket.inserted_id)])
+    return basket_helper({**basket_data, "_id": basket.inserted_id})
 
 
-# Retrieve a basket with a matching ID
+# Retrieve a basket with a matching ID, from the archive once it has been
+# archived. Only a miss on basket_collection looks there, so a found basket
+# still costs one round trip and a missing one two. Archived baskets come back
+# with "archived": True and are read-only: updates, item changes and deletes
+# only look at basket_collection and answer 404 for them.
 async def retrieve_basket(id: str) -> dict:
-    basket = await basket_collection.find_one({"_id": ObjectId(id)})
+    basket = await basket_loader.load(id)
     if basket:
         return basket_helper(basket)
+    basket = await archive_loader.load(id)
+    if basket:
+        return {**basket_helper(basket), "archived": True}
 
 
 # Update a basket with a matching ID
@@ -159,19 +795,478 @@ async def update_basket(id: str, data: dict):
     # Return false if an empty request body is sent.
     if len(data) < 1:
         return False
-    basket = await basket_collection.find_one({"_id": ObjectId(id)})
-    if basket:
-        updated_basket = await basket_collection.update_one(
-            {"_id": ObjectId(id)}, {"$set": data}
-        )
-        if updated_basket:
-            return True
-        return False
+    updated_basket = await basket_collection.find_one_and_update(
+        {"_id": ObjectId(id)}, versioned_write(data), return_document=ReturnDocument.AFTER
+    )
+    if updated_basket:
+        await journal("basket", "update", [id])
+        return basket_helper(updated_basket)
+    return False
 
 
-# Delete a basket from the database
+# Delete a basket from the database, and what it added to the line totals
 async def delete_basket(id: str):
-    basket = await basket_collection.find_one({"_id": ObjectId(id)})
+    deleted = await basket_collection.find_one_and_delete({"_id": ObjectId(id)}, projection={"tally": 1})
+    if deleted:
+        await journal("basket", "delete", [id])
+        await untally([deleted])
+    return deleted is not None
+
+
+# Line item operations. Each one is a single atomic update touching only the
+# affected line, and returns the basket's new version and updated_at plus the
+# line as it is now (None once removed). With `expected_version` the write only
+# applies to that version of the basket and raises VersionConflict otherwise;
+# None is returned when the basket (or for PATCH/DELETE, the line) is missing.
+def item_filter(id: str, expected_version: int = None, **conditions) -> dict:
+    query = {"_id": ObjectId(id), **conditions}
+    if expected_version is not None:
+        # Baskets written before versioning have no `version` field yet.
+        query["version"] = expected_version or None
+    return query
+
+
+def item_result(id: str, basket: dict, product_id: str) -> dict:
+    items = basket.get("items") or []
+    return {
+        "id": id,
+        "version": basket.get("version"),
+        "updated_at": basket.get("updated_at"),
+        "item": next((item for item in items if item.get("product_id") == product_id), None),
+    }
+
+
+async def item_update(id: str, query: dict, update: dict, product_id: str, project_item: bool = True):
+    projection = {"version": 1, "updated_at": 1}
+    if project_item:
+        projection["items.$"] = 1
+    basket = await basket_collection.find_one_and_update(
+        query, update, projection=projection, return_document=ReturnDocument.AFTER
+    )
     if basket:
-        await basket_collection.delete_one({"_id": ObjectId(id)})
-        return True
+        await journal("basket", "update", [id])
+        return item_result(id, basket, product_id)
+
+
+async def explain_miss(id: str, expected_version: int = None):
+    basket = await basket_collection.find_one({"_id": ObjectId(id)}, {"version": 1})
+    if basket is not None and expected_version is not None and (basket.get("version") or 0) != expected_version:
+        raise VersionConflict(basket.get("version") or 0)
+    return basket is not None
+
+
+# Add `quantity` of a product: bump the existing line, or push a new one.
+async def add_basket_item(id: str, product_id: str, quantity: int, expected_version: int = None):
+    for _ in range(3):
+        result = await item_update(
+            id,
+            item_filter(id, expected_version, **{"items.product_id": product_id}),
+            versioned_write(inc={"items.$.quantity": quantity}),
+            product_id,
+        )
+        if result:
+            return result
+        result = await item_update(
+            id,
+            item_filter(id, expected_version, **{"items.product_id": {"$ne": product_id}}),
+            versioned_write(push={"items": {"product_id": product_id, "quantity": quantity}}),
+            product_id,
+            project_item=False,
+        )
+        if result:
+            result["item"] = {"product_id": product_id, "quantity": quantity}
+            return result
+        if not await explain_miss(id, expected_version):
+            return None
+        # The line was added or removed concurrently between the two
+        # attempts; try again against the new state.
+    return None
+
+
+# Set a line's quantity; zero removes the line.
+async def set_basket_item_quantity(id: str, product_id: str, quantity: int, expected_version: int = None):
+    if quantity == 0:
+        return await remove_basket_item(id, product_id, expected_version)
+    result = await item_update(
+        id,
+        item_filter(id, expected_version, **{"items.product_id": product_id}),
+        versioned_write({"items.$.quantity": quantity}),
+        product_id,
+    )
+    if result is None:
+        await explain_miss(id, expected_version)
+    return result
+
+
+async def remove_basket_item(id: str, product_id: str, expected_version: int = None):
+    result = await item_update(
+        id,
+        item_filter(id, expected_version, **{"items.product_id": product_id}),
+        versioned_write(pull={"items": {"product_id": product_id}}),
+        product_id,
+        project_item=False,
+    )
+    if result is None:
+        await explain_miss(id, expected_version)
+        return None
+    result["item"] = None
+    return result
+
+
+async def add_baskets_bulk(documents: list) -> list:
+    results = await bulk_insert(basket_collection, [stamp_new_basket(document) for document in documents])
+    await journal("basket", "insert", written_ids(results))
+    return results
+
+
+async def update_baskets_bulk(updates: list) -> list:
+    results = await bulk_update(basket_collection, updates, versioned_write)
+    await journal("basket", "update", written_ids(results))
+    return results
+
+
+# Each basket is deleted on its own, TALLY_CONCURRENCY at a time, to learn
+# what it added to the line totals at the moment it went.
+async def delete_baskets_bulk(ids: list) -> list:
+    results = [{"id": id, "error": None if ObjectId.is_valid(id) else "invalid id"} for id in ids]
+    slots = asyncio.Semaphore(config.TALLY_CONCURRENCY)
+
+    async def delete(result):
+        async with slots:
+            return await basket_collection.find_one_and_delete({"_id": ObjectId(result["id"])}, projection={"tally": 1})
+
+    valid = [result for result in results if result["error"] is None]
+    deleted = await asyncio.gather(*(delete(result) for result in valid))
+    for result, basket in zip(valid, deleted):
+        if basket is None:
+            result["error"] = "not found"
+    await journal("basket", "delete", written_ids(results))
+    await untally([basket for basket in deleted if basket is not None])
+    return results
+
+
+# A basket's line items as (product_id, quantity): lines without a product
+# reference are skipped, and a quantity that is not a number counts as 0.
+def basket_lines(basket: dict) -> tuple:
+    items = basket.get("items")
+    if not isinstance(items, list):
+        return ()
+    return tuple(
+        (item["product_id"], item.get("quantity") if is_number(item.get("quantity")) else 0)
+        for item in items
+        if isinstance(item, dict) and isinstance(item.get("product_id"), str)
+    )
+
+
+def is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+# "YYYY-MM-DD" of a basket's created_at (an ISO string, or a BSON date in older
+# documents), None without one.
+def basket_day(basket: dict):
+    created_at = basket.get("created_at")
+    if isinstance(created_at, datetime):
+        return created_at.date().isoformat()
+    if isinstance(created_at, str) and created_at:
+        return created_at[:10]
+    return None
+
+
+# Move one batch of the delivered baskets last updated before `before` (an
+# ISO timestamp, as `updated_at` is stored) to the archive, oldest first, and
+# return how many were read and the ids of those moved. Copies go in first, so
+# a basket is always in one collection or the other; the originals are then
+# deleted one by one at the version and tally copied, and only the copies
+# whose delete matched are kept. A basket written, tallied or deleted by anyone
+# else in between loses its copy. Leaving basket_collection shows up as a delete in the change
+# feed.
+#
+# Every pass marks its copies with a `fold` id of its own and only ever drops
+# copies carrying it, so two passes never undo each other; a basket another
+# pass already copied is left to that one. Once moved, the baskets are added
+# to the archive totals under the same id, which makes adding them again a
+# no-op, and the mark is cleared. A pass interrupted halfway leaves marked
+# copies behind for recover_archive_passes().
+async def archive_baskets(before: str, batch_size: int):
+    baskets = await basket_collection.find({"status": "delivered", "updated_at": {"$lt": before}}).sort(
+        [("updated_at", 1), ("_id", 1)]).limit(batch_size).to_list(batch_size)
+    if not baskets:
+        return 0, []
+    fold = ObjectId()
+    copied = baskets
+    try:
+        await archive_collection.insert_many([{**basket, "fold": fold} for basket in baskets], ordered=False)
+    except BulkWriteError as exc:
+        if any(error["code"] != 11000 for error in exc.details["writeErrors"]):
+            raise
+        taken = [baskets[error["index"]] for error in exc.details["writeErrors"]]
+        # Unmarked copies of baskets still here were left by a pass from before
+        # passes marked theirs; this one takes them over.
+        await archive_collection.bulk_write([
+            ReplaceOne({"_id": basket["_id"], "fold": {"$exists": False}}, {**basket, "fold": fold}) for basket in taken
+        ], ordered=False)
+        query = {"_id": {"$in": [basket["_id"] for basket in taken]}, "fold": fold}
+        mine = {copy["_id"] async for copy in archive_collection.find(query, {"_id": 1})}
+        others = {basket["_id"] for basket in taken} - mine
+        copied = [basket for basket in baskets if basket["_id"] not in others]
+    # A bulk delete only reports how many matched, not which.
+    slots = asyncio.Semaphore(config.ARCHIVE_CONCURRENCY)
+
+    async def move(basket):
+        async with slots:
+            deleted = await basket_collection.delete_one(
+                {"_id": basket["_id"], "version": basket.get("version"), **tally_filter(basket)})
+        return deleted.deleted_count > 0
+
+    moved = await asyncio.gather(*(move(basket) for basket in copied))
+    missed = [basket["_id"] for basket, deleted in zip(copied, moved) if not deleted]
+    if missed:
+        await archive_collection.delete_many({"_id": {"$in": missed}, "fold": fold})
+    archived = [basket for basket, deleted in zip(copied, moved) if deleted]
+    await fold_archived(fold, archived)
+    ids = [str(basket["_id"]) for basket in archived]
+    await journal("basket", "delete", ids)
+    return len(baskets), ids
+
+
+# Add archived baskets to the archive totals (per product, per day and in
+# all) under their pass's `fold` id,
+# take what they added to the line totals back out under the same id, then
+# clear their mark. Each totals document remembers the last ARCHIVE_FOLDS_KEPT
+# ids added to it; adding one again matches nothing, and its upsert fails on
+# the existing `_id`.
+ARCHIVE_FOLDS_KEPT = 100
+
+
+async def fold_archived(fold: ObjectId, baskets: list):
+    if not baskets:
+        return
+    products, days = {}, {}
+    for basket in baskets:
+        for product_id, quantity in basket_lines(basket):
+            row = products.setdefault(product_id, [0, 0])
+            row[0] += quantity
+            row[1] += 1
+        day = basket_day(basket)
+        if day:
+            days[day] = days.get(day, 0) + 1
+    operations = [
+        UpdateOne({"_id": "product:" + product_id, "folds": {"$ne": fold}}, {
+            "$setOnInsert": {"kind": "product", "product_id": product_id},
+            "$inc": {"quantity": quantity, "lines": lines},
+            "$push": {"folds": {"$each": [fold], "$slice": -ARCHIVE_FOLDS_KEPT}},
+        }, upsert=True)
+        for product_id, (quantity, lines) in products.items()
+    ] + [
+        UpdateOne({"_id": "day:" + day, "folds": {"$ne": fold}}, {
+            "$setOnInsert": {"kind": "day", "day": day},
+            "$inc": {"baskets": count},
+            "$push": {"folds": {"$each": [fold], "$slice": -ARCHIVE_FOLDS_KEPT}},
+        }, upsert=True)
+        for day, count in days.items()
+    ] + [
+        UpdateOne({"_id": "baskets", "folds": {"$ne": fold}}, {
+            "$setOnInsert": {"kind": "baskets"},
+            "$inc": {"baskets": len(baskets)},
+            "$push": {"folds": {"$each": [fold], "$slice": -ARCHIVE_FOLDS_KEPT}},
+        }, upsert=True)
+    ]
+    if operations:
+        try:
+            await database[ARCHIVE_TOTALS_COLLECTION].bulk_write(operations, ordered=False)
+        except BulkWriteError as exc:
+            if any(error["code"] != 11000 for error in exc.details["writeErrors"]):
+                raise
+    await add_line_totals(fold, tally_totals(baskets, -1))
+    await archive_collection.update_many(
+        {"_id": {"$in": [basket["_id"] for basket in baskets]}, "fold": fold}, {"$unset": {"fold": ""}})
+
+
+# Finish the passes that were interrupted at least `older_than` seconds ago
+# (well past the time a pass may take). A copy whose basket is still in
+# basket_collection was never moved and is dropped; the others were, and are
+# added to the totals. Returns how many copies were dropped and added.
+async def recover_archive_passes(older_than: float):
+    cutoff = ObjectId.from_datetime(datetime.utcnow() - timedelta(seconds=older_than))
+    copies = await archive_collection.find({"fold": {"$lt": cutoff}}).to_list(None)
+    if not copies:
+        return 0, 0
+    kept = await existing_ids(basket_collection, [copy["_id"] for copy in copies])
+    if kept:
+        await archive_collection.delete_many({"_id": {"$in": list(kept)}, "fold": {"$lt": cutoff}})
+    passes = {}
+    for copy in copies:
+        if copy["_id"] not in kept:
+            passes.setdefault(copy["fold"], []).append(copy)
+    for fold, baskets in passes.items():
+        await fold_archived(fold, baskets)
+    return len(kept), len(copies) - len(kept)
+
+
+# Quantity and line count per (status, product_id) over basket_collection,
+# kept in LINE_TOTALS_COLLECTION as one document per pair, so reports read a
+# few small documents instead of the baskets. Every basket records what it
+# added to them in its `tally`: the id of the pass that added it, and the
+# version, status and lines it was added at. A pass reads the baskets updated
+# since the last one (from the updated_at index) and adds, for each whose
+# tally is behind its version, the difference. Deletes, archiving included,
+# take a basket's tally back out, and only delete the tally they read.
+#
+# A pass first stores what it is about to do, then moves the tallies forward,
+# each only from the one it read, notes which moved, adds those under its id
+# (like the archive folds) and drops its record. Two passes never move the
+# same tally, and a pass interrupted halfway is finished by
+# recover_tally_passes(). Baskets written more than CLOCK_SKEW seconds before
+# the newest one a pass saw, by a worker with a slower clock, are missed.
+CLOCK_SKEW = 5
+
+
+def tally_filter(basket: dict) -> dict:
+    return tally_id_filter((basket.get("tally") or {}).get("id"))
+
+
+def tally_id_filter(id: ObjectId = None) -> dict:
+    if id is None:
+        return {"tally": {"$exists": False}}
+    return {"tally.id": id}
+
+
+def tally_totals(baskets: list, sign: int = 1) -> dict:
+    totals = {}
+    for basket in baskets:
+        tally = basket.get("tally")
+        if tally is not None:
+            add_lines(totals, tally["status"], tally["lines"], sign)
+    return totals
+
+
+def add_lines(totals: dict, status, lines, sign: int):
+    for product_id, quantity in lines:
+        row = totals.setdefault((status, product_id), [0, 0])
+        row[0] += sign * quantity
+        row[1] += sign
+
+
+async def add_line_totals(id: ObjectId, totals: dict):
+    operations = [
+        UpdateOne({"_id": "line:{}:{}".format(status, product_id), "passes": {"$ne": id}}, {
+            "$setOnInsert": {"kind": "line", "status": status, "product_id": product_id},
+            "$inc": {"quantity": quantity, "lines": lines},
+            "$push": {"passes": {"$each": [id], "$slice": -ARCHIVE_FOLDS_KEPT}},
+        }, upsert=True)
+        for (status, product_id), (quantity, lines) in totals.items()
+        if quantity or lines
+    ]
+    if not operations:
+        return
+    try:
+        await database[LINE_TOTALS_COLLECTION].bulk_write(operations, ordered=False)
+    except BulkWriteError as exc:
+        if any(error["code"] != 11000 for error in exc.details["writeErrors"]):
+            raise
+
+
+# Deleted baskets, as read by the delete. Best effort, like the journal: a
+# failure is logged and the totals keep the baskets.
+async def untally(baskets: list):
+    try:
+        await add_line_totals(ObjectId(), tally_totals(baskets, -1))
+    except PyMongoError as exc:
+        logger.warning("Could not take %d deleted basket(s) out of the line totals: %s", len(baskets), exc)
+
+
+def rewind(timestamp: str, seconds: float) -> str:
+    try:
+        return (datetime.fromisoformat(timestamp) - timedelta(seconds=seconds)).isoformat()
+    except ValueError:
+        return timestamp
+
+
+# Tally the baskets updated since the last pass, `batch_size` at a time, until
+# none are left or `deadline` (time.monotonic()) passes. Returns how many were
+# read and tallied, and whether any may be left.
+async def tally_baskets(batch_size: int, deadline: float):
+    totals = database[LINE_TOTALS_COLLECTION]
+    mark = await totals.find_one({"_id": "mark"})
+    query = {"updated_at": {"$gte": rewind(mark["updated_at"], CLOCK_SKEW)}} if mark else {}
+    fields = ("status", "items.product_id", "items.quantity", "updated_at", "version", "tally")
+    read, tallied, after, newest = 0, 0, None, None
+    while True:
+        baskets = await listing_cursor(
+            basket_collection, query, "updated_at", after, batch_size, fields).to_list(batch_size)
+        if not baskets:
+            break
+        read += len(baskets)
+        tallied += await tally_batch(baskets)
+        last = baskets[-1]
+        after = encode_cursor({"id": str(last["_id"]), "updated_at": last.get("updated_at")}, "updated_at")
+        if isinstance(last.get("updated_at"), str):
+            newest = last["updated_at"]
+        if len(baskets) < batch_size or time.monotonic() > deadline:
+            break
+    if newest is not None:
+        await totals.update_one({"_id": "mark"}, {"$max": {"updated_at": newest}, "$set": {"kind": "mark"}},
+                                upsert=True)
+    return read, tallied, len(baskets) == batch_size
+
+
+async def tally_batch(baskets: list) -> int:
+    pass_id = ObjectId()
+    entries = []
+    for basket in baskets:
+        tally = basket.get("tally")
+        if tally is not None and tally.get("version") == basket.get("version"):
+            continue
+        entries.append({
+            "_id": basket["_id"],
+            "from": tally["id"] if tally else None,
+            "old": {"status": tally["status"], "lines": tally["lines"]} if tally else None,
+            "tally": {"id": pass_id, "version": basket.get("version"), "status": basket.get("status"),
+                      "lines": [list(line) for line in basket_lines(basket)]},
+        })
+    if not entries:
+        return 0
+    totals = database[LINE_TOTALS_COLLECTION]
+    await totals.insert_one({"_id": pass_id, "kind": "pass", "entries": entries})
+    slots = asyncio.Semaphore(config.TALLY_CONCURRENCY)
+
+    async def move(entry):
+        async with slots:
+            moved = await basket_collection.update_one(
+                {"_id": entry["_id"], **tally_id_filter(entry["from"])}, {"$set": {"tally": entry["tally"]}})
+        return moved.modified_count > 0
+
+    moved = await asyncio.gather(*(move(entry) for entry in entries))
+    applied = [entry for entry, done in zip(entries, moved) if done]
+    await totals.update_one({"_id": pass_id}, {"$set": {"applied": [entry["_id"] for entry in applied]}})
+    await finish_tally_pass(pass_id, applied)
+    return len(applied)
+
+
+async def finish_tally_pass(pass_id: ObjectId, applied: list):
+    totals = {}
+    for entry in applied:
+        if entry["old"] is not None:
+            add_lines(totals, entry["old"]["status"], entry["old"]["lines"], -1)
+        add_lines(totals, entry["tally"]["status"], entry["tally"]["lines"], 1)
+    await add_line_totals(pass_id, totals)
+    await database[LINE_TOTALS_COLLECTION].delete_one({"_id": pass_id})
+
+
+# Finish the tally passes interrupted at least `older_than` seconds ago. One
+# that did not get to note which tallies it moved finds them by its id, in
+# basket_collection or the archive; a basket deleted since is taken as not
+# moved. Returns how many passes were finished.
+async def recover_tally_passes(older_than: float) -> int:
+    cutoff = ObjectId.from_datetime(datetime.utcnow() - timedelta(seconds=older_than))
+    passes = await database[LINE_TOTALS_COLLECTION].find({"kind": "pass", "_id": {"$lt": cutoff}}).to_list(None)
+    for record in passes:
+        applied = record.get("applied")
+        if applied is None:
+            query = {"_id": {"$in": [entry["_id"] for entry in record["entries"]]}, "tally.id": record["_id"]}
+            applied = [basket["_id"] async for basket in basket_collection.find(query, {"_id": 1})]
+            applied += [basket["_id"] async for basket in archive_collection.find(query, {"_id": 1})]
+        applied = set(applied)
+        await finish_tally_pass(record["_id"], [entry for entry in record["entries"] if entry["_id"] in applied])
+    return len(passes)
@@ -0,0 +1,391 @@
+import asyncio
+import json
+import logging
+import re
+import time
+from collections import deque
+
+from bson.timestamp import Timestamp
+from pymongo import CursorType
+from pymongo.errors import CollectionInvalid, OperationFailure, PyMongoError
+
+from server import config, database
+from server.responses import default
+from server.search import search_index
+
+logger = logging.getLogger(__name__)
+
+# Collections the feed follows, by the name their events carry.
+COLLECTIONS = {"product_collection": "product", "basket_collection": "basket"}
+OPERATIONS = ["insert", "update", "replace", "delete"]
+
+# Change stream events are cut down to what subscribers get plus the fields
+# the search index needs. The `_id` (the resume token) is kept.
+CHANGE_PROJECTION = {
+    "operationType": 1, "ns": 1, "documentKey": 1, "fullDocument.name": 1, "fullDocument.description": 1,
+    "fullDocument.version": 1, "fullDocument.updated_at": 1,
+}
+
+# A change stream can't resume from this token (InvalidResumeToken,
+# ChangeStreamFatalError, ChangeStreamHistoryLost).
+RESUME_ERRORS = (260, 280, 286)
+
+# Every event has a token, and tokens sort in the order the events happened:
+# change stream tokens are the server's hex encoded resume tokens, journal
+# tokens the hex encoded timestamp of their entry.
+CHANGE_TOKEN = re.compile(r"[0-9A-F]+")
+JOURNAL_TOKEN = re.compile(r"j[0-9a-f]{16}")
+
+
+class CannotResume(Exception):
+    pass
+
+
+def journal_token(ts: Timestamp) -> str:
+    return "j{:08x}{:08x}".format(ts.time, ts.inc)
+
+
+def journal_timestamp(token: str) -> Timestamp:
+    return Timestamp(int(token[1:9], 16), int(token[9:], 16))
+
+
+# Sources are async generators of (token, event, document) from just after
+# `after` (or from now). `document` holds the fields CHANGE_PROJECTION keeps,
+# when the source has them; the journal only has the `origin` of the write.
+# Whenever a source has caught up it yields (token, None, None), the token
+# being where it is at.
+async def change_stream(after: str = None):
+    options = {"full_document": "updateLookup"}
+    if after is not None:
+        # start_after, unlike resume_after, also gets past an invalidate.
+        options["start_after"] = {"_data": after}
+    pipeline = [
+        {"$match": {"ns.coll": {"$in": list(COLLECTIONS)}, "operationType": {"$in": OPERATIONS}}},
+        {"$project": CHANGE_PROJECTION},
+    ]
+    try:
+        async with database.database.watch(pipeline, **options) as stream:
+            while stream.alive:
+                change = await stream.try_next()
+                if change is None:
+                    if stream.resume_token:
+                        yield stream.resume_token["_data"], None, None
+                    continue
+                if change["operationType"] not in OPERATIONS:
+                    # An invalidate or drop; nothing to publish, but move past it.
+                    yield change["_id"]["_data"], None, None
+                    continue
+                document = change.get("fullDocument")
+                yield change["_id"]["_data"], {
+                    "collection": COLLECTIONS[change["ns"]["coll"]],
+                    "operation": "update" if change["operationType"] == "replace" else change["operationType"],
+                    "id": str(change["documentKey"]["_id"]),
+                    "version": (document or {}).get("version"),
+                    "updated_at": (document or {}).get("updated_at"),
+                }, document
+    except OperationFailure as exc:
+        if after is not None and exc.code in RESUME_ERRORS:
+            raise CannotResume(str(exc)) from exc
+        raise
+
+
+# Tails the change journal (see database.journal). A tailable cursor dies when
+# it finds nothing to start from, so an idle journal is polled every
+# EVENTS_POLL_INTERVAL seconds.
+async def journal_source(after: str = None):
+    collection = database.database[database.JOURNAL_COLLECTION]
+    if after is not None:
+        ts = journal_timestamp(after)
+        # The capped collection drops its oldest entries first; if the one the
+        # token names is gone, so may be the ones after it.
+        if ts != Timestamp(0, 0) and await collection.find_one({"ts": ts}, {"_id": 1}) is None:
+            raise CannotResume("journal entry {} is no longer kept".format(after))
+    else:
+        newest = await collection.find_one({}, {"ts": 1}, sort=[("$natural", -1)])
+        ts = newest["ts"] if newest else Timestamp(0, 0)
+    while True:
+        cursor = collection.find({"ts": {"$gt": ts}}, cursor_type=CursorType.TAILABLE_AWAIT)
+        while True:
+            async for entry in cursor:
+                ts = entry["ts"]
+                yield journal_token(ts), {
+                    "collection": entry["collection"],
+                    "operation": entry["operation"],
+                    "id": entry["id"],
+                    "version": None,
+                    "updated_at": None,
+                }, {"origin": entry.get("origin")}
+            yield journal_token(ts), None, None
+            if not cursor.alive:
+                break
+        await asyncio.sleep(config.EVENTS_POLL_INTERVAL)
+
+
+async def detect_source() -> str:
+    if config.EVENTS_SOURCE != "auto":
+        return config.EVENTS_SOURCE
+    reply = await database.database.command("isMaster")
+    # Change streams need a replica set (setName) or mongos (isdbgrid).
+    return "changestream" if "setName" in reply or reply.get("msg") == "isdbgrid" else "journal"
+
+
+# Pick the source and, for the journal, create it and have this process's
+# writes append to it. Every process that writes products or baskets calls it.
+async def prepare_source() -> str:
+    mode = await detect_source()
+    if mode == "journal":
+        try:
+            await database.database.create_collection(
+                database.JOURNAL_COLLECTION, capped=True, size=config.EVENTS_JOURNAL_BYTES)
+        except CollectionInvalid:
+            pass
+        database.journal_enabled = True
+    return mode
+
+
+class Subscription:
+    def __init__(self, collections: tuple = None):
+        self.collections = collections
+        self.queue = asyncio.Queue(config.EVENTS_QUEUE_SIZE)
+        self.closed = False
+
+    def wants(self, event: dict) -> bool:
+        return not self.collections or event["collection"] in self.collections
+
+
+# One per worker: reads the source, keeps the latest events in a ring buffer
+# and hands each one to every subscriber and to the in-process listeners.
+# Listeners run in a task of their own and get lists of (event, document)
+# pairs, everything that arrived since their last call, so a slow listener
+# neither holds up subscribers nor costs a round trip per event.
+class ChangeFeed:
+    def __init__(self, buffer_size: int):
+        self.mode = None
+        self.buffer = deque(maxlen=buffer_size)
+        # Token of the newest event no longer buffered (or of where the feed
+        # started): the buffer holds every event after it.
+        self.floor = None
+        self.subscribers = set()
+        self.listeners = []
+        self.task = None
+        self.pending = []
+        self.arrived = asyncio.Event()
+        self.dispatcher = None
+        self.published = 0
+        self.disconnected = 0
+        self.errors = 0
+        self.dispatches = 0
+
+    @property
+    def running(self) -> bool:
+        return self.task is not None and not self.task.done() and self.floor is not None
+
+    def head(self) -> str:
+        return self.buffer[-1][0] if self.buffer else self.floor
+
+    async def start(self):
+        if self.task is None:
+            self.mode = await prepare_source()
+            self.task = asyncio.ensure_future(self.run())
+            self.dispatcher = asyncio.ensure_future(self.dispatch())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        if self.dispatcher is not None:
+            self.dispatcher.cancel()
+            self.dispatcher = None
+        for subscription in list(self.subscribers):
+            self.close(subscription)
+
+    def source(self, after: str = None):
+        return change_stream(after) if self.mode == "changestream" else journal_source(after)
+
+    async def run(self):
+        after = None
+        while True:
+            try:
+                async for token, event, document in self.source(after):
+                    after = token
+                    if event is None:
+                        if not self.buffer:
+                            self.floor = token
+                        continue
+                    self.publish(token, event)
+                    if self.listeners:
+                        self.pending.append((event, document))
+                        self.arrived.set()
+            except CannotResume as exc:
+                # Fell further behind than the source keeps; what happened
+                # meanwhile is lost, to this feed and whoever resumes from it.
+                logger.error("Change feed lost its position, continuing from now: %s", exc)
+                after = None
+                self.buffer.clear()
+                self.floor = None
+            except PyMongoError as exc:
+                self.errors += 1
+                logger.warning("Change feed interrupted, resuming: %s", exc)
+                await asyncio.sleep(config.EVENTS_POLL_INTERVAL)
+
+    def publish(self, token: str, event: dict):
+        if len(self.buffer) == self.buffer.maxlen:
+            self.floor = self.buffer[0][0]
+        self.buffer.append((token, event))
+        self.published += 1
+        for subscription in list(self.subscribers):
+            if not subscription.wants(event):
+                continue
+            try:
+                subscription.queue.put_nowait((token, event))
+            except asyncio.QueueFull:
+                # Too far behind; it gets what is queued and then has to
+                # reconnect from its last event.
+                self.disconnected += 1
+                self.close(subscription)
+
+    async def dispatch(self):
+        while True:
+            await self.arrived.wait()
+            self.arrived.clear()
+            changes, self.pending = self.pending, []
+            self.dispatches += 1
+            for listener in self.listeners:
+                try:
+                    await listener(changes)
+                except Exception:
+                    logger.exception("Change feed listener failed on %d events", len(changes))
+
+    def close(self, subscription: Subscription):
+        self.subscribers.discard(subscription)
+        subscription.closed = True
+        try:
+            subscription.queue.put_nowait(None)
+        except asyncio.QueueFull:
+            pass
+
+    # Events after the one with token `after` (or from now), in order and each
+    # once, as ("change", token, event). A token that can't be resumed from
+    # gives a ("reset", token, reason) and events from now on; the consumer
+    # should reload what it follows and continue from that token. With a
+    # `heartbeat`, ("idle", None, None) comes after that many quiet seconds.
+    async def events(self, after: str = None, collections: tuple = None, heartbeat: float = None):
+        subscription = Subscription(collections)
+        # Taken together, with no await in between, so nothing falls between
+        # the buffered events and the queued ones.
+        floor, backlog = self.floor, list(self.buffer)
+        self.subscribers.add(subscription)
+        try:
+            last = None
+            if after is not None:
+                pattern = CHANGE_TOKEN if self.mode == "changestream" else JOURNAL_TOKEN
+                if not pattern.fullmatch(after):
+                    yield "reset", self.head(), {"reason": "unknown event id"}
+                elif floor is None or after >= floor:
+                    last = after
+                else:
+                    try:
+                        async for token, event in self.catch_up(after, floor):
+                            if subscription.wants(event):
+                                yield "change", token, event
+                        last = floor
+                    except CannotResume as exc:
+                        yield "reset", self.head(), {"reason": str(exc)}
+            if last is not None:
+                for token, event in backlog:
+                    if token > last and subscription.wants(event):
+                        last = token
+                        yield "change", token, event
+            while True:
+                try:
+                    item = await asyncio.wait_for(subscription.queue.get(), heartbeat)
+                except asyncio.TimeoutError:
+                    if subscription.closed:
+                        return
+                    yield "idle", None, None
+                    continue
+                if item is None:
+                    return
+                token, event = item
+                if last is None or token > last:
+                    last = token
+                    yield "change", token, event
+        finally:
+            self.subscribers.discard(subscription)
+
+    # Events older than the buffer, read from the source with a cursor of their
+    # own, up to and including `until`.
+    async def catch_up(self, after: str, until: str):
+        source = self.source(after)
+        try:
+            async for token, event, _ in source:
+                if event is None or token > until:
+                    return
+                yield token, event
+        finally:
+            await source.aclose()
+
+    def stats(self) -> dict:
+        return {
+            "mode": self.mode,
+            "running": self.running,
+            "position": self.head(),
+            "buffered": len(self.buffer),
+            "published": self.published,
+            "pending": len(self.pending),
+            "dispatches": self.dispatches,
+            "subscribers": len(self.subscribers),
+            "disconnected": self.disconnected,
+            "errors": self.errors,
+        }
+
+
+change_feed = ChangeFeed(config.EVENTS_BUFFER_SIZE)
+
+
+# Keeps this worker's caches and search index in step with writes made by
+# every other worker and process. The writer has already invalidated its own
+# cache and, if the product cache is shared, everyone's, so only a per-process
+# cache is invalidated here, once for each batch of changes. Products the
+# journal names are read back, with at most one query per batch, unless this
+# process wrote them; a product deleted since is simply not found.
+async def invalidate_caches(changes: list):
+    ids, reindex, here = {}, {}, database.origin()
+    for event, document in changes:
+        if event["collection"] != "product" or (document or {}).get("origin") == here:
+            continue
+        ids[event["id"]] = True
+        if event["operation"] == "delete":
+            search_index.remove(event["id"])
+        elif document is None or "origin" in document:
+            reindex[event["id"]] = True
+        else:
+            search_index.add(event["id"], document)
+    if ids and not database.product_cache.backend.shared:
+        await database.invalidate_product(*ids)
+    await database.reindex_products(list(reindex))
+
+
+change_feed.listeners.append(invalidate_caches)
+
+
+# Server-Sent Events: each change as `id: <token>` / `event: change` with the
+# event as JSON, a `reset` when the client's Last-Event-ID can't be resumed
+# from, and a comment every EVENTS_HEARTBEAT seconds to keep proxies from
+# closing an idle stream.
+async def sse_stream(after: str = None, collections: tuple = None):
+    deadline = time.monotonic() + config.EVENTS_MAX_STREAM_SECONDS
+    yield "retry: 1000\n\n"
+    events = change_feed.events(after, collections, config.EVENTS_HEARTBEAT)
+    try:
+        async for kind, token, data in events:
+            if kind == "idle":
+                yield ": keepalive\n\n"
+            else:
+                yield "id: {}\nevent: {}\ndata: {}\n\n".format(token or "", kind, json.dumps(data, default=default))
+            if time.monotonic() > deadline:
+                return
+    except PyMongoError as exc:
+        logger.warning("Change stream for a subscriber failed: %s", exc)
+    finally:
+        await events.aclose()
@@ -0,0 +1,200 @@
+import asyncio
+import logging
+import sys
+from datetime import datetime
+
+from bson.objectid import ObjectId
+from pymongo import ASCENDING, IndexModel
+from pymongo.errors import CollectionInvalid, OperationFailure
+
+from server import config, database
+
+logger = logging.getLogger(__name__)
+
+# Indexes every collection must have, by collection name. ensure_indexes()
+# creates whatever is missing at startup; creating an index that already exists
+# with the same definition is a no-op, so this is safe on every boot.
+INDEXES = {
+    "users_collection": [
+        IndexModel([("username", ASCENDING)], name="username_unique", unique=True),
+        IndexModel([("email", ASCENDING)], name="email_unique", unique=True),
+        IndexModel([("national_id", ASCENDING)], name="national_id"),
+    ],
+    # Listings sort on (field, _id), so sortable fields are indexed together
+    # with `_id` to serve both the filter and the keyset seek without a sort.
+    "product_collection": [
+        IndexModel([("name", ASCENDING), ("_id", ASCENDING)], name="name_id"),
+        IndexModel([("price", ASCENDING), ("_id", ASCENDING)], name="price_id"),
+    ],
+    "basket_collection": [
+        IndexModel([("status", ASCENDING), ("created_at", ASCENDING), ("_id", ASCENDING)], name="status_created_at_id"),
+        # Finds the delivered baskets due for the archive, oldest first.
+        IndexModel([("status", ASCENDING), ("updated_at", ASCENDING), ("_id", ASCENDING)], name="status_updated_at_id"),
+        IndexModel([("created_at", ASCENDING), ("_id", ASCENDING)], name="created_at_id"),
+        IndexModel([("updated_at", ASCENDING), ("_id", ASCENDING)], name="updated_at_id"),
+    ],
+    # Claims look for due jobs by status and run_at (see server/jobs.py);
+    # finished jobs expire JOBS_RETENTION seconds after they finished.
+    "job_collection": [
+        IndexModel([("status", ASCENDING), ("run_at", ASCENDING)], name="status_run_at"),
+        IndexModel([("status", ASCENDING), ("_id", ASCENDING)], name="status_id"),
+        IndexModel([("key", ASCENDING)], name="key_unique", unique=True,
+                   partialFilterExpression={"key": {"$type": "string"}}),
+        IndexModel([("finished_at", ASCENDING)], name="finished_at_ttl", expireAfterSeconds=config.JOBS_RETENTION),
+    ],
+    # Only copies of an archive pass that has not finished carry a `fold`.
+    database.ARCHIVE_COLLECTION: [
+        IndexModel([("fold", ASCENDING)], name="fold", partialFilterExpression={"fold": {"$exists": True}}),
+    ],
+    database.ARCHIVE_TOTALS_COLLECTION: [
+        IndexModel([("kind", ASCENDING)], name="kind"),
+    ],
+    database.LINE_TOTALS_COLLECTION: [
+        IndexModel([("kind", ASCENDING)], name="kind"),
+    ],
+}
+
+# Collections created with options before anything else creates them. The
+# archive is written once and rarely read, so it is stored with a stronger
+# compressor than the server's default. The options are best-effort: when the
+# server (e.g. built without ARCHIVE_COMPRESSOR) or the driver rejects them,
+# the collection is created with the defaults instead.
+COLLECTION_OPTIONS = {
+    database.ARCHIVE_COLLECTION: {
+        "storageEngine": {"wiredTiger": {"configString": "block_compressor={}".format(config.ARCHIVE_COMPRESSOR)}},
+    },
+}
+
+
+SAMPLE_ID = "000000000000000000000000"
+SAMPLE_DATE = datetime(2020, 1, 1)
+
+
+def sample_cursor(sort: str = None) -> str:
+    field, _ = database.sort_spec(sort)
+    return database.encode_cursor({"id": SAMPLE_ID, field: "2020-01-01T00:00:00"}, sort)
+
+
+# Every query shape the data layer issues, as (collection, label, filter, sort)
+# with `sort` in the listing syntax ("price", "-created_at", None for _id).
+# check_query_plans() explains each one and reports any that scan a collection.
+QUERY_SHAPES = [
+    ("users_collection", "by id", {"_id": ObjectId(SAMPLE_ID)}, None),
+    ("users_collection", "by ids", {"_id": {"$in": [ObjectId(SAMPLE_ID)]}}, None),
+    ("users_collection", "page", {}, None),
+    ("users_collection", "page after", database.keyset_query({}, None, SAMPLE_ID), None),
+    ("users_collection", "by username", {"username": "johndoe"}, None),
+    ("users_collection", "by email", {"email": "johndoe@example.com"}, None),
+    ("users_collection", "by national_id", {"national_id": "0020022381"}, None),
+    ("product_collection", "by id", {"_id": ObjectId(SAMPLE_ID)}, None),
+    ("product_collection", "by ids", {"_id": {"$in": [ObjectId(SAMPLE_ID)]}}, None),
+    ("product_collection", "page", {}, None),
+    ("product_collection", "page after", database.keyset_query({}, None, SAMPLE_ID), None),
+    ("product_collection", "by name prefix", database.product_query(name_prefix="Apa"), "name"),
+    ("product_collection", "by price range", database.product_query(10, 100), "price"),
+    ("product_collection", "by price range, page after",
+     database.keyset_query(database.product_query(10, 100), "-price", sample_cursor("-price")), "-price"),
+    ("basket_collection", "by id", {"_id": ObjectId(SAMPLE_ID)}, None),
+    ("basket_collection", "by ids", {"_id": {"$in": [ObjectId(SAMPLE_ID)]}}, None),
+    ("basket_collection", "page", {}, None),
+    ("basket_collection", "page after", database.keyset_query({}, None, SAMPLE_ID), None),
+    ("basket_collection", "by status", database.basket_query("received"), "created_at"),
+    ("basket_collection", "by created_at window",
+     database.basket_query(None, SAMPLE_DATE, datetime(2020, 2, 1)), "-created_at"),
+    ("basket_collection", "by updated_at", {}, "-updated_at"),
+    ("basket_collection", "updated since", {"updated_at": {"$gte": "2020-01-01"}}, "updated_at"),
+    ("basket_collection", "due for the archive", {"status": "delivered", "updated_at": {"$lt": "2020-01-01"}},
+     "updated_at"),
+    ("basket_archive", "by id", {"_id": ObjectId(SAMPLE_ID)}, None),
+    ("basket_archive", "by ids", {"_id": {"$in": [ObjectId(SAMPLE_ID)]}}, None),
+    ("basket_archive", "interrupted passes", {"fold": {"$lt": ObjectId(SAMPLE_ID)}}, "fold"),
+    ("basket_archive_totals", "by kind", {"kind": "product"}, None),
+    ("basket_line_totals", "by kind", {"kind": "line"}, None),
+    ("basket_line_totals", "interrupted passes", {"kind": "pass", "_id": {"$lt": ObjectId(SAMPLE_ID)}}, None),
+    ("job_collection", "by id", {"_id": ObjectId(SAMPLE_ID)}, None),
+    ("job_collection", "due", {"status": {"$in": ["queued", "running"]}, "run_at": {"$lte": SAMPLE_DATE},
+                               "type": {"$in": ["basket.processing"]}}, "run_at"),
+    ("job_collection", "by key", {"key": "basket:{}:processing".format(SAMPLE_ID)}, None),
+    ("job_collection", "by status", {"status": "failed"}, None),
+]
+
+
+async def ensure_collections():
+    existing = set(await database.database.list_collection_names())
+    for name, options in COLLECTION_OPTIONS.items():
+        if name not in existing:
+            try:
+                await database.database.create_collection(name, **options)
+            except CollectionInvalid:
+                pass
+            except (OperationFailure, NotImplementedError) as exc:
+                # NotImplementedError: backends such as mongomock that take
+                # no storage options.
+                logger.error("Could not create %s with %s, using the defaults: %s", name, options, exc)
+
+
+# Unique indexes are what keep usernames, emails and job keys from repeating
+# (add_user answers 409 on the duplicate key error), so a worker without them
+# must not become ready: their failure, typically duplicates that have to be
+# cleaned up by hand, is raised once every index has been tried, and prepare()
+# keeps retrying. The others only serve queries and are best-effort.
+async def ensure_indexes():
+    await ensure_collections()
+    failures = []
+    for name, indexes in INDEXES.items():
+        collection = database.database.get_collection(name)
+        unique = [index for index in indexes if index.document.get("unique")]
+        other = [index for index in indexes if not index.document.get("unique")]
+        if other:
+            try:
+                await collection.create_indexes(other)
+            except OperationFailure as exc:
+                logger.error("Could not create indexes on %s: %s", name, exc)
+        if unique:
+            try:
+                await collection.create_indexes(unique)
+            except OperationFailure as exc:
+                logger.critical("Could not create unique indexes on %s: %s", name, exc)
+                failures.append("{}: {}".format(name, exc))
+    if failures:
+        raise OperationFailure("Unique indexes missing, " + "; ".join(failures))
+
+
+def plan_stages(plan: dict):
+    yield plan.get("stage")
+    for key in ("inputStage", "queryPlan"):
+        if key in plan:
+            yield from plan_stages(plan[key])
+    for child in plan.get("inputStages", []):
+        yield from plan_stages(child)
+
+
+# Explain every query shape and return the ones whose winning plan contains a
+# COLLSCAN stage, as (collection, label, stages).
+async def check_query_plans() -> list:
+    failures = []
+    for name, label, query, sort in QUERY_SHAPES:
+        cursor = database.database.get_collection(name).find(query).sort(database.sort_order(sort))
+        explanation = await cursor.explain()
+        stages = list(plan_stages(explanation["queryPlanner"]["winningPlan"]))
+        logger.info("%s %s: %s", name, label, " <- ".join(stage for stage in stages if stage))
+        if "COLLSCAN" in stages:
+            failures.append((name, label, stages))
+    return failures
+
+
+async def main() -> int:
+    database.connect()
+    await ensure_indexes()
+    failures = await check_query_plans()
+    for name, label, stages in failures:
+        print("COLLSCAN: {} {} ({})".format(name, label, " <- ".join(s for s in stages if s)))
+    print("{} of {} query shapes use an index".format(len(QUERY_SHAPES) - len(failures), len(QUERY_SHAPES)))
+    return 1 if failures else 0
+
+
+# python -m server.indexes  (from app/) ensures the indexes and fails on any
+# query shape that would scan a whole collection.
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(asyncio.get_event_loop().run_until_complete(main()))
@@ -0,0 +1,429 @@
+import asyncio
+import logging
+import os
+import random
+import signal
+import socket
+import time
+from datetime import datetime, timedelta
+from typing import Callable, NamedTuple
+
+from bson.objectid import ObjectId
+from pymongo import ASCENDING, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError
+
+from server import config, database
+from server.events import prepare_source
+from server.indexes import ensure_indexes
+
+logger = logging.getLogger(__name__)
+
+# Jobs live in job_collection and move from queued to running to succeeded or
+# failed. A claim sets a running job's `run_at` to the end of its lease, so a
+# job whose worker died is due again, and claimed again, once that passes;
+# handlers therefore have to be safe to run more than once. `attempts` counts
+# claims and doubles as a fencing token: a worker only records the outcome of
+# the attempt it claimed.
+STATUSES = ("queued", "running", "succeeded", "failed")
+JOB_FIELDS = ("type", "payload", "key", "status", "attempts", "max_attempts", "run_at", "created_at", "updated_at",
+              "finished_at", "last_error", "result")
+
+# The lease outlasts the time limit, so a job is always given up on before
+# someone else may claim it.
+LEASE_MARGIN = 5
+
+
+class Handler(NamedTuple):
+    run: Callable
+    concurrency: int
+
+
+HANDLERS = {}
+# Job types queued every so many seconds, by type.
+SCHEDULE = {}
+
+
+# Register `func(payload)` to run jobs of `type`; what it returns is stored as
+# the job's result. At most `concurrency` jobs of the type run at a time per
+# process (0: only the pool's own limit applies).
+def job_handler(type: str, concurrency: int = 0):
+    def register(func):
+        HANDLERS[type] = Handler(func, concurrency)
+        return func
+    return register
+
+
+# Queue a job of `type` every `interval` seconds (see JobPool.schedule).
+def periodic_job(type: str, interval: float):
+    if interval > 0:
+        SCHEDULE[type] = interval
+
+
+# Raised by a handler for a job that would fail again however often it is
+# retried.
+class PermanentError(Exception):
+    pass
+
+
+def job_helper(job) -> dict:
+    helper = {"id": str(job["_id"])}
+    for field in JOB_FIELDS:
+        helper[field] = job.get(field)
+    return helper
+
+
+def new_job(type: str, payload: dict, key: str = None, delay: float = 0) -> dict:
+    now = datetime.utcnow()
+    job = {
+        "type": type,
+        "payload": payload,
+        "status": "queued",
+        "attempts": 0,
+        "max_attempts": config.JOBS_MAX_ATTEMPTS,
+        "run_at": now + timedelta(seconds=delay),
+        "created_at": now,
+        "updated_at": now,
+    }
+    if key is not None:
+        job["key"] = key
+    return job
+
+
+# Queue a job, due after `delay` seconds. With an idempotency `key` only the
+# first job queued under it is kept, and later calls return that one.
+async def enqueue(type: str, payload: dict, key: str = None, delay: float = 0) -> dict:
+    job = new_job(type, payload, key, delay)
+    if key is None:
+        await database.job_collection.insert_one(job)
+    else:
+        try:
+            job = await database.job_collection.find_one_and_update(
+                {"key": key}, {"$setOnInsert": job}, upsert=True, return_document=ReturnDocument.AFTER)
+        except DuplicateKeyError:
+            # A concurrent upsert of the same key inserted it first.
+            job = await database.job_collection.find_one({"key": key})
+    job_pool.wake()
+    return job_helper(job)
+
+
+# Queue (type, payload, key) jobs in one round trip; returns how many were new.
+async def enqueue_many(jobs: list) -> int:
+    if not jobs:
+        return 0
+    operations = [
+        UpdateOne({"key": key}, {"$setOnInsert": new_job(type, payload, key)}, upsert=True)
+        for type, payload, key in jobs
+    ]
+    try:
+        queued = (await database.job_collection.bulk_write(operations, ordered=False)).upserted_count
+    except BulkWriteError as exc:
+        if any(error["code"] != 11000 for error in exc.details["writeErrors"]):
+            raise
+        queued = exc.details["nUpserted"]
+    if queued:
+        job_pool.wake()
+    return queued
+
+
+async def retrieve_job(id: str) -> dict:
+    job = await database.job_collection.find_one({"_id": ObjectId(id)})
+    if job:
+        return job_helper(job)
+
+
+async def retrieve_jobs(limit: int, after: str = None, status: str = None) -> list:
+    query = {"status": status} if status else {}
+    return [job_helper(job) async for job in database.listing_cursor(database.job_collection, query, None, after, limit)]
+
+
+async def status_counts() -> dict:
+    counts = await asyncio.gather(*(database.job_collection.count_documents({"status": status}) for status in STATUSES))
+    return dict(zip(STATUSES, counts))
+
+
+# Queue a failed job again, with a fresh set of attempts. Returns None if there
+# is no such job, False if it has not failed.
+async def retry_job(id: str):
+    now = datetime.utcnow()
+    job = await database.job_collection.find_one_and_update(
+        {"_id": ObjectId(id), "status": "failed"},
+        {"$set": {"status": "queued", "attempts": 0, "run_at": now, "updated_at": now}, "$unset": {"finished_at": ""}},
+        return_document=ReturnDocument.AFTER,
+    )
+    if job is None:
+        return None if await database.job_collection.find_one({"_id": ObjectId(id)}, {"_id": 1}) is None else False
+    job_pool.wake()
+    return job_helper(job)
+
+
+# The oldest due job of one of `types`, marked running and leased to `worker`.
+async def claim(types: list, worker: str):
+    now = datetime.utcnow()
+    return await database.job_collection.find_one_and_update(
+        {"status": {"$in": ["queued", "running"]}, "run_at": {"$lte": now}, "type": {"$in": types}},
+        {
+            "$set": {"status": "running", "run_at": now + timedelta(seconds=config.JOBS_LEASE + LEASE_MARGIN),
+                     "worker": worker, "updated_at": now},
+            "$inc": {"attempts": 1},
+        },
+        sort=[("run_at", ASCENDING)],
+        return_document=ReturnDocument.AFTER,
+    )
+
+
+def backoff(attempts: int) -> float:
+    delay = min(config.JOBS_BACKOFF_MAX, config.JOBS_BACKOFF_BASE * 2 ** (attempts - 1))
+    return delay * random.uniform(0.5, 1)
+
+
+async def finish(job: dict, update: dict) -> bool:
+    result = await database.job_collection.update_one(
+        {"_id": job["_id"], "status": "running", "attempts": job["attempts"]}, update)
+    return result.modified_count > 0
+
+
+# Claims due jobs and runs up to `workers` of them at a time, waking up when a
+# job is queued in this process and every JOBS_POLL_INTERVAL seconds for those
+# queued elsewhere.
+class JobPool:
+    def __init__(self):
+        self.workers = 0
+        self.name = None
+        self.running = {}
+        self.by_type = {}
+        self.claimed = 0
+        self.succeeded = 0
+        self.retried = 0
+        self.failed = 0
+        self._task = None
+        self._scheduler = None
+        self._wakeup = None
+
+    def start(self, workers: int):
+        if self._task is None and workers > 0:
+            self.workers = workers
+            self.name = "{}:{}".format(socket.gethostname(), os.getpid())
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.ensure_future(self.run())
+            if SCHEDULE:
+                self._scheduler = asyncio.ensure_future(self.schedule())
+
+    # Stop claiming and give running jobs `timeout` seconds to finish; the rest
+    # are cancelled and run again elsewhere once their lease is up.
+    async def stop(self, timeout: float):
+        if self._task is None:
+            return
+        self._task.cancel()
+        self._task = None
+        if self._scheduler is not None:
+            self._scheduler.cancel()
+            self._scheduler = None
+        if self.running:
+            _, pending = await asyncio.wait(list(self.running), timeout=timeout)
+            for task in pending:
+                task.cancel()
+
+    def wake(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def available_types(self) -> list:
+        if len(self.running) >= self.workers:
+            return []
+        return [job_type for job_type, handler in HANDLERS.items()
+                if not handler.concurrency or self.by_type.get(job_type, 0) < handler.concurrency]
+
+    async def run(self):
+        while True:
+            # Cleared before claiming, so a job queued meanwhile is not slept on.
+            self._wakeup.clear()
+            job = None
+            types = self.available_types()
+            if types:
+                try:
+                    job = await claim(types, self.name)
+                except PyMongoError as exc:
+                    logger.warning("Claiming a job failed: %s", exc)
+            if job is None:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), config.JOBS_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            self.claimed += 1
+            self.by_type[job["type"]] = self.by_type.get(job["type"], 0) + 1
+            task = asyncio.ensure_future(self.execute(job))
+            self.running[task] = job["type"]
+            task.add_done_callback(self.finished)
+
+    # Every pool queues the scheduled jobs, but with the number of the current
+    # interval as idempotency key only one job per interval is kept.
+    async def schedule(self):
+        while True:
+            for job_type, interval in SCHEDULE.items():
+                try:
+                    await enqueue(job_type, {}, key="{}:{}".format(job_type, int(time.time() // interval)))
+                except PyMongoError as exc:
+                    logger.warning("Scheduling %s failed: %s", job_type, exc)
+            await asyncio.sleep(min(60, *SCHEDULE.values()))
+
+    def finished(self, task):
+        self.by_type[self.running.pop(task)] -= 1
+        self.wake()
+
+    async def execute(self, job: dict):
+        try:
+            if job["attempts"] > job["max_attempts"]:
+                # Only after workers died running it, each time past its lease.
+                raise PermanentError("abandoned after {} attempts".format(job["max_attempts"]))
+            result = await asyncio.wait_for(HANDLERS[job["type"]].run(job["payload"]), config.JOBS_LEASE)
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            now = datetime.utcnow()
+            error = "{}: {}".format(type(exc).__name__, str(exc) or "timed out")
+            if isinstance(exc, PermanentError) or job["attempts"] >= job["max_attempts"]:
+                logger.error("Job %s (%s) failed: %s", job["_id"], job["type"], error)
+                self.failed += 1
+                update = {"status": "failed", "last_error": error, "finished_at": now, "updated_at": now}
+            else:
+                delay = backoff(job["attempts"])
+                logger.warning("Job %s (%s) failed, retrying in %.1fs: %s", job["_id"], job["type"], delay, error)
+                self.retried += 1
+                update = {"status": "queued", "last_error": error, "run_at": now + timedelta(seconds=delay),
+                          "updated_at": now}
+        else:
+            now = datetime.utcnow()
+            self.succeeded += 1
+            update = {"status": "succeeded", "result": result, "finished_at": now, "updated_at": now}
+        try:
+            if not await finish(job, {"$set": update}):
+                logger.warning("Job %s was claimed again before attempt %d finished", job["_id"], job["attempts"])
+        except PyMongoError as exc:
+            # The lease runs out and the job is run again.
+            logger.warning("Recording the outcome of job %s failed: %s", job["_id"], exc)
+
+    def stats(self) -> dict:
+        return {
+            "worker": self.name,
+            "workers": self.workers,
+            "running": dict(self.by_type),
+            "claimed": self.claimed,
+            "succeeded": self.succeeded,
+            "retried": self.retried,
+            "failed": self.failed,
+        }
+
+
+job_pool = JobPool()
+
+
+# Basket status changes. Each status a basket reaches queues its
+# "basket.<status>" job once (the basket id and status are the idempotency
+# key), if that status has a handler. Queueing failures are logged, the write
+# that changed the status has happened either way.
+async def basket_status_changed(changes: list):
+    jobs = [
+        ("basket." + status, {"basket_id": id}, "basket:{}:{}".format(id, status))
+        for id, status in changes
+        if "basket." + status in HANDLERS
+    ]
+    try:
+        await enqueue_many(jobs)
+    except PyMongoError as exc:
+        logger.error("Could not queue jobs for %d basket status change(s): %s", len(jobs), exc)
+
+
+# Item count and amount of a basket, and which of its products no longer
+# exist: checked when it goes into processing and recorded again once
+# delivered. Only reads, so it is safe to repeat. Lines from before items were
+# typed that lack a product id or a numeric quantity are counted as skipped;
+# retrying would not make them valid.
+@job_handler("basket.processing")
+@job_handler("basket.delivered")
+async def basket_totals(payload: dict) -> dict:
+    id = payload.get("basket_id")
+    if not ObjectId.is_valid(id):
+        raise PermanentError("invalid basket id")
+    basket = await database.retrieve_basket(id)
+    if basket is None:
+        raise PermanentError("basket not found")
+    items = basket.get("items") or []
+    if not isinstance(items, list):
+        raise PermanentError("basket items are not a list")
+    lines = [
+        item for item in items
+        if isinstance(item, dict) and isinstance(item.get("product_id"), str) and database.is_number(item.get("quantity"))
+    ]
+    products = await database.retrieve_many(database.retrieve_product, [item["product_id"] for item in lines])
+    amount, missing = 0.0, []
+    for item, product in zip(lines, products):
+        if product["error"] is None:
+            amount += (product.get("price") if database.is_number(product.get("price")) else 0) * item["quantity"]
+        else:
+            missing.append(item["product_id"])
+    return {
+        "items": sum(item["quantity"] for item in lines),
+        "amount": round(amount, 2),
+        "missing": missing,
+        "skipped": len(items) - len(lines),
+    }
+
+
+# Move delivered baskets to the archive, for up to half the job's time limit;
+# a follow-up job carries on with whatever is left. Passes cut short by a
+# worker dying or the time limit are finished first: no pass runs longer than
+# the time limit, so any marked twice that long ago was interrupted.
+@job_handler("basket.archive", concurrency=1)
+async def archive_baskets(payload: dict) -> dict:
+    dropped, recovered = await database.recover_archive_passes(2 * config.JOBS_LEASE)
+    before = (datetime.utcnow() - timedelta(days=config.ARCHIVE_AFTER_DAYS)).isoformat()
+    deadline = time.monotonic() + config.JOBS_LEASE / 2
+    archived = 0
+    while time.monotonic() < deadline:
+        read, ids = await database.archive_baskets(before, config.ARCHIVE_BATCH_SIZE)
+        archived += len(ids)
+        if read < config.ARCHIVE_BATCH_SIZE:
+            return {"archived": archived, "recovered": recovered, "dropped": dropped, "more": False}
+    await enqueue("basket.archive", {})
+    return {"archived": archived, "recovered": recovered, "dropped": dropped, "more": True}
+
+
+periodic_job("basket.archive", config.ARCHIVE_INTERVAL)
+
+
+# Bring the analytics line totals up to date, for up to half the job's time
+# limit, the same way; interrupted passes are finished first.
+@job_handler("basket.tally", concurrency=1)
+async def tally_baskets(payload: dict) -> dict:
+    recovered = await database.recover_tally_passes(2 * config.JOBS_LEASE)
+    read, tallied, more = await database.tally_baskets(
+        config.TALLY_BATCH_SIZE, time.monotonic() + config.JOBS_LEASE / 2)
+    if more:
+        await enqueue("basket.tally", {})
+    return {"read": read, "tallied": tallied, "recovered": recovered, "more": more}
+
+
+periodic_job("basket.tally", config.TALLY_INTERVAL)
+
+
+async def main():
+    database.connect()
+    await ensure_indexes()
+    # Jobs write baskets (the archive deletes them), which the journal must see.
+    await prepare_source()
+    job_pool.start(config.JOBS_RUNNER_WORKERS)
+    stopping = asyncio.Event()
+    loop = asyncio.get_event_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stopping.set)
+    await stopping.wait()
+    await job_pool.stop(config.JOBS_SHUTDOWN_TIMEOUT)
+    database.disconnect()
+
+
+# python -m server.jobs  (from app/) runs jobs without serving requests, next
+# to the web workers or, with JOBS_WORKERS=0 there, instead of them.
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.get_event_loop().run_until_complete(main())
@@ -0,0 +1,254 @@
+import contextvars
+import logging
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from pymongo import monitoring
+
+from server import config
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+SLOW_QUERY_MS = config.METRICS_SLOW_QUERY_MS
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def lines(self, name: str, labels: str) -> list:
+        lines, cumulative = [], 0
+        for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            cumulative += count
+            lines.append('{}_bucket{{{}le="{}"}} {}'.format(name, labels, bound, cumulative))
+        lines.append("{}_sum{{{}}} {}".format(name, labels.rstrip(","), self.sum))
+        lines.append("{}_count{{{}}} {}".format(name, labels.rstrip(","), self.count))
+        return lines
+
+
+# What one request spent, filled in by the middleware, the command listener and
+# phase(). Motor runs pymongo on executor threads with a copy of the caller's
+# context, so command events see the request that issued them.
+class RequestStats:
+    __slots__ = ("commands", "mongo_seconds", "phases")
+
+    def __init__(self):
+        self.commands = 0
+        self.mongo_seconds = 0.0
+        self.phases = {}
+
+
+current_request = contextvars.ContextVar("current_request", default=None)
+
+
+# Time a named part of the request (e.g. "auth"); reported per route and in
+# the Server-Timing header.
+@contextmanager
+def phase(name: str):
+    stats = current_request.get()
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        if stats is not None:
+            stats.phases[name] = stats.phases.get(name, 0.0) + time.perf_counter() - started
+
+
+# Per-route series are keyed by the route's path template, never the raw path,
+# so ids in URLs don't create a series each. Everything here is updated from
+# the event loop except the command series, which take `lock`.
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.latency = {}
+        self.sizes = {}
+        self.route_commands = {}
+        self.route_phases = {}
+        self.command_latency = {}
+        self.slow_commands = 0
+
+    def observe_request(self, method: str, route: str, status: int, seconds: float, size: int,
+                        stats: RequestStats):
+        key = (method, route, status)
+        histogram = self.latency.get(key)
+        if histogram is None:
+            histogram = self.latency[key] = Histogram(LATENCY_BUCKETS)
+        histogram.observe(seconds)
+        histogram = self.sizes.get((method, route))
+        if histogram is None:
+            histogram = self.sizes[(method, route)] = Histogram(SIZE_BUCKETS)
+        histogram.observe(size)
+        totals = self.route_commands.setdefault((method, route), [0, 0.0])
+        totals[0] += stats.commands
+        totals[1] += stats.mongo_seconds
+        for name, elapsed in stats.phases.items():
+            key = (method, route, name)
+            self.route_phases[key] = self.route_phases.get(key, 0.0) + elapsed
+
+    def observe_command(self, command: str, seconds: float):
+        with self.lock:
+            histogram = self.command_latency.get(command)
+            if histogram is None:
+                histogram = self.command_latency[command] = Histogram(LATENCY_BUCKETS)
+            histogram.observe(seconds)
+
+    def render(self, pools: dict = None) -> str:
+        lines = [
+            "# HELP http_requests_in_flight Requests currently being served.",
+            "# TYPE http_requests_in_flight gauge",
+            "http_requests_in_flight {}".format(self.in_flight),
+            "# HELP http_request_duration_seconds Request latency by route.",
+            "# TYPE http_request_duration_seconds histogram",
+        ]
+        for (method, route, status), histogram in sorted(self.latency.items()):
+            labels = 'method="{}",route="{}",status="{}",'.format(method, route, status)
+            lines.extend(histogram.lines("http_request_duration_seconds", labels))
+        lines += [
+            "# HELP http_response_size_bytes Response body size by route.",
+            "# TYPE http_response_size_bytes histogram",
+        ]
+        for (method, route), histogram in sorted(self.sizes.items()):
+            lines.extend(histogram.lines("http_response_size_bytes", 'method="{}",route="{}",'.format(method, route)))
+        lines += [
+            "# HELP http_request_mongo_commands_total MongoDB commands issued while serving the route.",
+            "# TYPE http_request_mongo_commands_total counter",
+        ]
+        for (method, route), (commands, _) in sorted(self.route_commands.items()):
+            lines.append('http_request_mongo_commands_total{{method="{}",route="{}"}} {}'.format(method, route, commands))
+        lines += [
+            "# HELP http_request_mongo_seconds_total Time spent in MongoDB commands while serving the route.",
+            "# TYPE http_request_mongo_seconds_total counter",
+        ]
+        for (method, route), (_, seconds) in sorted(self.route_commands.items()):
+            lines.append('http_request_mongo_seconds_total{{method="{}",route="{}"}} {}'.format(method, route, seconds))
+        lines += [
+            "# HELP http_request_phase_seconds_total Time spent in named request phases.",
+            "# TYPE http_request_phase_seconds_total counter",
+        ]
+        for (method, route, name), seconds in sorted(self.route_phases.items()):
+            lines.append('http_request_phase_seconds_total{{method="{}",route="{}",phase="{}"}} {}'.format(
+                method, route, name, seconds))
+        with self.lock:
+            commands = sorted(self.command_latency.items())
+            lines += [
+                "# HELP mongo_command_duration_seconds MongoDB command latency by command.",
+                "# TYPE mongo_command_duration_seconds histogram",
+            ]
+            for command, histogram in commands:
+                lines.extend(histogram.lines("mongo_command_duration_seconds", 'command="{}",'.format(command)))
+            lines += [
+                "# HELP mongo_slow_commands_total Commands slower than METRICS_SLOW_QUERY_MS.",
+                "# TYPE mongo_slow_commands_total counter",
+                "mongo_slow_commands_total {}".format(self.slow_commands),
+            ]
+        if pools:
+            lines += ["# TYPE mongo_pool_connections gauge", "# TYPE mongo_pool_checked_out gauge"]
+            for address, pool in sorted(pools.items()):
+                lines.append('mongo_pool_connections{{address="{}"}} {}'.format(address, pool["open"]))
+                lines.append('mongo_pool_checked_out{{address="{}"}} {}'.format(address, pool["checked_out"]))
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+# Counts every command against the request that issued it and logs the slow
+# ones with the shape of their filter (field names only, no values).
+class CommandMetrics(monitoring.CommandListener):
+    def __init__(self):
+        self._pending = {}
+
+    def started(self, event):
+        if SLOW_QUERY_MS:
+            command = event.command
+            target = command.get(event.command_name)
+            query = command.get("filter") or command.get("q") or {}
+            self._pending[event.request_id] = (target, sorted(query) if isinstance(query, dict) else None)
+
+    def succeeded(self, event):
+        self._finish(event)
+
+    def failed(self, event):
+        self._finish(event)
+
+    def _finish(self, event):
+        seconds = event.duration_micros / 1e6
+        detail = self._pending.pop(event.request_id, None)
+        stats = current_request.get()
+        if stats is not None:
+            stats.commands += 1
+            stats.mongo_seconds += seconds
+        registry.observe_command(event.command_name, seconds)
+        if SLOW_QUERY_MS and seconds * 1000 >= SLOW_QUERY_MS:
+            with registry.lock:
+                registry.slow_commands += 1
+            target, fields = detail or (None, None)
+            logger.warning("slow %s on %s (%.1f ms) filter fields %s", event.command_name, target, seconds * 1000, fields)
+
+
+command_metrics = CommandMetrics()
+
+
+# Pure ASGI middleware, so it adds no task or body buffering to a request:
+# a timestamp, a contextvar and a few dict updates when the response ends.
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+        self.routes = None
+
+    def route(self, scope) -> str:
+        endpoint = scope.get("endpoint")
+        if endpoint is None:
+            return "unmatched"
+        if self.routes is None:
+            self.routes = {}
+            for route in scope["app"].routes:
+                self.routes.setdefault(getattr(route, "endpoint", None), getattr(route, "path", None))
+        return self.routes.get(endpoint) or "unmatched"
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        stats = RequestStats()
+        token = current_request.set(stats)
+        started = time.perf_counter()
+        status, size = 500, 0
+        registry.in_flight += 1
+
+        async def send_with_metrics(message):
+            nonlocal status, size
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                timing = "app;dur={:.1f}, db;dur={:.1f};desc=\"{} commands\"".format(
+                    (time.perf_counter() - started) * 1000, stats.mongo_seconds * 1000, stats.commands)
+                for name, elapsed in stats.phases.items():
+                    timing += ", {};dur={:.1f}".format(name, elapsed * 1000)
+                message = dict(message, headers=list(message.get("headers", [])) + [
+                    (b"server-timing", timing.encode("latin-1"))])
+            elif message["type"] == "http.response.body":
+                size += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_metrics)
+        finally:
+            registry.in_flight -= 1
+            registry.observe_request(scope["method"], self.route(scope), status, time.perf_counter() - started,
+                                     size, stats)
+            current_request.reset(token)
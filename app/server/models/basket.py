@@ -3,7 +3,8 @@ from dataclasses import field
 from datetime import datetime
 from .product import ProductSchema
 from typing import Optional, List, Dict
-from pydantic import BaseModel, EmailStr, Field
+from bson.objectid import ObjectId
+from pydantic import BaseModel, EmailStr, Field, validator
 from enum import Enum
 
 
@@ -15,8 +16,28 @@ class Count():
     count: int
 
 
+# A basket line references a product by id; the product itself is resolved
+# when the basket is read (see hydrate_baskets in server/database.py).
+class BasketItem(BaseModel):
+    product_id: str = Field(...)
+    quantity: int = Field(1, gt=0)
+
+    @validator("product_id")
+    def product_id_is_object_id(cls, value):
+        if not ObjectId.is_valid(value):
+            raise ValueError("product_id must be a 24 character hex ObjectId")
+        return value
+
+
+class UpdateBasketItemModel(BaseModel):
+    quantity: int = Field(..., ge=0)
+
+    class Config:
+        schema_extra = {"example": {"quantity": 3}}
+
+
 class BasketSchema(BaseModel):
-    items: List
+    items: List[BasketItem]
     created_at: Optional[datetime] = None
     updated_at: Optional[datetime] = None
     status : Status
@@ -25,7 +46,7 @@ class BasketSchema(BaseModel):
     class Config:
         schema_extra = {
             "example": {
-                "items": ["apache"],
+                "items": [{"product_id": "62f1c9e5a7b4c3d2e1f00a01", "quantity": 2}],
                 "created_at": "2017-06-01 12:22",
                 "updated_at": "2017-06-05 12:22",
                 "status": "processing",
@@ -34,7 +55,7 @@ class BasketSchema(BaseModel):
 
 
 class UpdateBasketModel(BaseModel):
-    items: Optional[List]
+    items: Optional[List[BasketItem]]
     created_at : Optional[datetime]
     updated_at : Optional[datetime]
     status : Optional[str]
@@ -42,7 +63,7 @@ class UpdateBasketModel(BaseModel):
     class Config:
         schema_extra = {
             "example": {
-                "items": ["apache"],
+                "items": [{"product_id": "62f1c9e5a7b4c3d2e1f00a01", "quantity": 2}],
                 "created_at": "2017-06-01 12:22",
                 "updated_at": "2017-06-05 12:22",
                 "status": "processing",
@@ -50,6 +71,10 @@ class UpdateBasketModel(BaseModel):
         }
 
 
+class BulkUpdateBasketModel(UpdateBasketModel):
+    id: str = Field(...)
+
+
 def ResponseModel(data, message):
     return {
         "data": [data],
@@ -58,5 +83,15 @@ def ResponseModel(data, message):
     }
 
 
+# `next_after` is the cursor for the following page, or None on the last one.
+def PageResponseModel(data, message, next_after):
+    return {
+        "data": [data],
+        "code": 200,
+        "message": message,
+        "next_after": next_after,
+    }
+
+
 def ErrorResponseModel(error, code, message):
     return {"error": error, "code": code, "message": message}
\ No newline at end of file
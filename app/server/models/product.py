@@ -36,6 +36,10 @@ class UpdateProductModel(BaseModel):
         }
 
 
+class BulkUpdateProductModel(UpdateProductModel):
+    id: str = Field(...)
+
+
 def ResponseModel(data, message):
     return {
         "data": [data],
@@ -0,0 +1,70 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from fastapi import HTTPException, status
+from passlib.context import CryptContext
+
+from server import config
+
+# bcrypt releases the GIL while it hashes, so running it on a small thread pool
+# keeps the event loop free. HASH_WORKERS caps how many cores logins may use,
+# at most HASH_MAX_PENDING calls may wait for a worker, and none waits longer
+# than HASH_QUEUE_TIMEOUT seconds; past either limit the caller gets a 503.
+HASH_WORKERS = config.HASH_WORKERS
+HASH_MAX_PENDING = config.HASH_MAX_PENDING
+HASH_QUEUE_TIMEOUT = config.HASH_QUEUE_TIMEOUT
+HASH_RETRY_AFTER = 1
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+executor = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix="bcrypt")
+
+stats = {"completed": 0, "rejected": 0, "timed_out": 0, "pending": 0}
+
+_slots = None
+
+
+def overloaded():
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Too many concurrent logins, retry later",
+        headers={"Retry-After": str(HASH_RETRY_AFTER)},
+    )
+
+
+async def run_bounded(fn, *args):
+    global _slots
+    if _slots is None:
+        _slots = asyncio.Semaphore(HASH_WORKERS)
+    if stats["pending"] >= HASH_MAX_PENDING:
+        stats["rejected"] += 1
+        raise overloaded()
+    stats["pending"] += 1
+    try:
+        try:
+            await asyncio.wait_for(_slots.acquire(), HASH_QUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            stats["timed_out"] += 1
+            raise overloaded()
+        try:
+            result = await asyncio.get_event_loop().run_in_executor(executor, fn, *args)
+        finally:
+            _slots.release()
+    finally:
+        stats["pending"] -= 1
+    stats["completed"] += 1
+    return result
+
+
+async def verify_password(plain_password, hashed_password):
+    return await run_bounded(pwd_context.verify, plain_password, hashed_password)
+
+
+async def get_password_hash(password):
+    return await run_bounded(pwd_context.hash, password)
+
+
+# Verify a password and, when the stored hash uses outdated settings, also
+# return a fresh hash to store in its place (None otherwise).
+async def verify_and_update(plain_password, hashed_password):
+    return await run_bounded(pwd_context.verify_and_update, plain_password, hashed_password)
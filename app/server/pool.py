@@ -0,0 +1,98 @@
+import threading
+import time
+from collections import deque
+
+from pymongo import monitoring
+
+
+# Connection pool statistics from pymongo's CMAP events. Pymongo emits them on
+# the executor threads Motor runs it on, so a check-out's start and end are seen
+# by the same thread and the wait is measured with a thread-local timestamp.
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    def __init__(self, samples: int = 1000):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._waits = deque(maxlen=samples)
+        self.pools = {}
+
+    def _pool(self, address):
+        key = "{}:{}".format(*address)
+        pool = self.pools.get(key)
+        if pool is None:
+            pool = self.pools[key] = {
+                "open": 0,
+                "checked_out": 0,
+                "max_checked_out": 0,
+                "check_outs": 0,
+                "check_out_failures": {},
+                "wait_ms_total": 0.0,
+                "wait_ms_max": 0.0,
+                "cleared": 0,
+            }
+        return pool
+
+    def pool_created(self, event):
+        with self._lock:
+            self._pool(event.address)
+
+    def pool_cleared(self, event):
+        with self._lock:
+            self._pool(event.address)["cleared"] += 1
+
+    def pool_closed(self, event):
+        with self._lock:
+            self.pools.pop("{}:{}".format(*event.address), None)
+
+    def connection_created(self, event):
+        with self._lock:
+            self._pool(event.address)["open"] += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        with self._lock:
+            self._pool(event.address)["open"] -= 1
+
+    def connection_check_out_started(self, event):
+        self._local.started = time.perf_counter()
+
+    def connection_check_out_failed(self, event):
+        self._record_wait()
+        with self._lock:
+            failures = self._pool(event.address)["check_out_failures"]
+            failures[event.reason] = failures.get(event.reason, 0) + 1
+
+    def connection_checked_out(self, event):
+        wait_ms = self._record_wait()
+        with self._lock:
+            pool = self._pool(event.address)
+            pool["check_outs"] += 1
+            pool["checked_out"] += 1
+            pool["max_checked_out"] = max(pool["max_checked_out"], pool["checked_out"])
+            pool["wait_ms_total"] += wait_ms
+            pool["wait_ms_max"] = max(pool["wait_ms_max"], wait_ms)
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self._pool(event.address)["checked_out"] -= 1
+
+    def _record_wait(self) -> float:
+        started = getattr(self._local, "started", None)
+        if started is None:
+            return 0.0
+        self._local.started = None
+        wait_ms = (time.perf_counter() - started) * 1000
+        self._waits.append(wait_ms)
+        return wait_ms
+
+    def stats(self) -> dict:
+        with self._lock:
+            waits = sorted(self._waits)
+            pools = {address: dict(pool, check_out_failures=dict(pool["check_out_failures"]))
+                     for address, pool in self.pools.items()}
+        recent = {}
+        if waits:
+            for name, q in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99)):
+                recent["wait_ms_" + name] = round(waits[min(len(waits) - 1, int(q * len(waits)))], 3)
+        return {"pools": pools, "recent_waits": dict(recent, samples=len(waits))}
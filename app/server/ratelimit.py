@@ -0,0 +1,215 @@
+import asyncio
+import json
+import logging
+import math
+import time
+from typing import NamedTuple
+from urllib.parse import urlparse
+
+from server.cache import LRUCache, RespBackend
+
+logger = logging.getLogger(__name__)
+
+
+# `rate` requests per second on average, with bursts of up to `burst`.
+class Rule(NamedTuple):
+    rate: float
+    burst: int
+
+
+# Per-process token buckets. Exact, but every worker counts on its own, so with
+# N workers a client can get up to N times the rate.
+class MemoryLimitBackend:
+    def __init__(self, maxsize: int = 100000):
+        self._buckets = LRUCache(maxsize)
+
+    async def take(self, key: str, rule: Rule) -> float:
+        now = time.monotonic()
+        tokens, updated = self._buckets.get(key, (rule.burst, now))
+        tokens = min(rule.burst, tokens + (now - updated) * rule.rate)
+        if tokens >= 1:
+            self._buckets.set(key, (tokens - 1, now), rule.burst / rule.rate)
+            return 0.0
+        self._buckets.set(key, (tokens, now), rule.burst / rule.rate)
+        return (1 - tokens) / rule.rate
+
+
+# Shared between workers through Redis or the RESP server in server/cache.py.
+# An atomic token bucket needs a server-side script, so this approximates one
+# with a sliding window of burst / rate seconds: the current window's count
+# plus the previous window's, weighted by how much of it still overlaps, may
+# not exceed `burst`. All three commands go out in one round trip.
+class RespLimitBackend:
+    def __init__(self, resp: RespBackend):
+        self.resp = resp
+
+    async def take(self, key: str, rule: Rule) -> float:
+        window = rule.burst / rule.rate
+        now = time.time()
+        index, elapsed = divmod(now, window)
+        current = "ratelimit:{}:{}".format(key, int(index))
+        previous = "ratelimit:{}:{}".format(key, int(index) - 1)
+        count, _, before = await self.resp.pipeline(
+            ("INCR", current), ("PEXPIRE", current, int(window * 2000)), ("GET", previous))
+        before = int(before or 0)
+        weight = 1 - elapsed / window
+        if count + before * weight <= rule.burst:
+            return 0.0
+        if before:
+            # Wait until the previous window has slid far enough out.
+            return max(0.0, (count + before * weight - rule.burst) / (before / window))
+        return window - elapsed
+
+
+def limit_backend_from_url(url: str):
+    parsed = urlparse(url)
+    if parsed.scheme == "memory":
+        return MemoryLimitBackend()
+    if parsed.scheme == "redis":
+        db = int(parsed.path.lstrip("/") or 0)
+        return RespLimitBackend(RespBackend(parsed.hostname or "localhost", parsed.port or 6379, db))
+    raise ValueError("Unsupported rate limit backend: {}".format(url))
+
+
+class RateLimiter:
+    def __init__(self, backend):
+        self.backend = backend
+        self.limited = {}
+        self.errors = 0
+
+    # Seconds until `key` may call again under the rule `name`, 0 if it may
+    # now. A shared backend that cannot be reached lets the request through.
+    async def check(self, name: str, key: str, rule: Rule) -> float:
+        try:
+            retry_after = await self.backend.take("{}:{}".format(name, key), rule)
+        except (OSError, asyncio.IncompleteReadError) as exc:
+            self.errors += 1
+            logger.warning("Rate limit backend unavailable: %s", exc)
+            return 0.0
+        if retry_after:
+            self.limited[name] = self.limited.get(name, 0) + 1
+        return retry_after
+
+    def stats(self) -> dict:
+        return {"limited": dict(self.limited), "errors": self.errors}
+
+
+# Adaptive concurrency limit (AIMD): requests over the limit wait for a slot,
+# and the limit grows by one per `limit` requests that finish under
+# `target_latency` and shrinks by 10% (at most every `target_latency`) when
+# they take longer. Requests that would wait longer than `queue_timeout`, or
+# find `max_queue` already waiting, are shed with a 503.
+class AdaptiveConcurrency:
+    def __init__(self, initial: int, minimum: int, maximum: int, target_latency: float, queue_timeout: float,
+                 max_queue: int):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_latency = target_latency
+        self.queue_timeout = queue_timeout
+        self.max_queue = max_queue
+        self.in_flight = 0
+        self.queued = 0
+        self.shed = 0
+        self._waiters = []
+        self._decreased_at = 0.0
+
+    async def acquire(self) -> bool:
+        if self.in_flight < int(self.limit) and not self.queued:
+            self.in_flight += 1
+            return True
+        if self.queued >= self.max_queue:
+            self.shed += 1
+            return False
+        waiter = asyncio.get_event_loop().create_future()
+        self._waiters.append(waiter)
+        self.queued += 1
+        try:
+            await asyncio.wait_for(waiter, self.queue_timeout)
+            return True
+        except asyncio.TimeoutError:
+            if waiter.done() and not waiter.cancelled():
+                # Handed a slot just as the timeout fired.
+                return True
+            self.shed += 1
+            return False
+        except asyncio.CancelledError:
+            # The client went away; if a slot was already handed over, pass it on.
+            if waiter.done() and not waiter.cancelled():
+                self.in_flight -= 1
+                self._wake()
+            raise
+        finally:
+            self.queued -= 1
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+
+    def release(self, latency: float):
+        if latency > self.target_latency:
+            now = time.monotonic()
+            if now - self._decreased_at > self.target_latency:
+                self.limit = max(self.minimum, self.limit * 0.9)
+                self._decreased_at = now
+        else:
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+        self.in_flight -= 1
+        self._wake()
+
+    # Hand freed slots straight to waiters; the slot moves with the wake-up.
+    def _wake(self):
+        while self._waiters and self.in_flight < int(self.limit):
+            waiter = self._waiters.pop(0)
+            if not waiter.done():
+                waiter.set_result(None)
+                self.in_flight += 1
+
+    def retry_after(self) -> int:
+        return max(1, math.ceil(self.queue_timeout))
+
+    def stats(self) -> dict:
+        return {"limit": round(self.limit, 2), "in_flight": self.in_flight, "queued": self.queued, "shed": self.shed}
+
+
+# Pure ASGI middleware applying an AdaptiveConcurrency to every HTTP request
+# outside `exempt` (health checks and metrics must answer under overload). A
+# request holds its slot until its response starts: a streamed response
+# (exports, ?stream=true listings) then goes on writing without one, and its
+# latency is the time to its first byte, not the length of the stream.
+class LoadShedMiddleware:
+    def __init__(self, app, limiter: AdaptiveConcurrency, exempt: tuple = ()):
+        self.app = app
+        self.limiter = limiter
+        self.exempt = set(exempt)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in self.exempt:
+            await self.app(scope, receive, send)
+            return
+        if not await self.limiter.acquire():
+            body = json.dumps({"detail": "Server is overloaded, retry later"}).encode()
+            await send({
+                "type": "http.response.start",
+                "status": 503,
+                "headers": [
+                    (b"content-type", b"application/json"),
+                    (b"content-length", str(len(body)).encode()),
+                    (b"retry-after", str(self.limiter.retry_after()).encode()),
+                ],
+            })
+            await send({"type": "http.response.body", "body": body})
+            return
+        started = time.perf_counter()
+        held = True
+
+        async def send_releasing(message):
+            nonlocal held
+            if held and message["type"] == "http.response.start":
+                held = False
+                self.limiter.release(time.perf_counter() - started)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_releasing)
+        finally:
+            if held:
+                self.limiter.release(time.perf_counter() - started)
@@ -0,0 +1,79 @@
+import hashlib
+import json
+from datetime import date, datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+
+from bson.objectid import ObjectId
+from starlette.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson is in requirements.txt
+    orjson = None
+
+
+# Types BSON documents carry that JSON has no encoding for. orjson already
+# handles datetime itself and only falls back to this for ObjectId.
+def default(obj):
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    raise TypeError("Object of type {} is not JSON serializable".format(type(obj).__name__))
+
+
+def dumps(content) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content, default=default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(content, default=default, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+# Response class for the `fast=true` listings: the content is encoded in one
+# pass, without jsonable_encoder walking and copying it first.
+class FastJSONResponse(JSONResponse):
+    def render(self, content) -> bytes:
+        return dumps(content)
+
+
+# Turn a document as the driver returns it into its output shape in place:
+# `_id` becomes the string `id`, everything else is left for dumps() to encode.
+def raw_document(document: dict) -> dict:
+    document["id"] = str(document.pop("_id"))
+    return document
+
+
+# HTTP validators. A document's ETag is its id and version, which every write
+# increments; a page's is a digest of the (id, version) pairs on it, so it
+# changes when any product on the page changes or the page's members do.
+def document_etag(document: dict) -> str:
+    return '"{}-{}"'.format(document["id"], document.get("version") or 0)
+
+
+def page_etag(documents: list) -> str:
+    digest = hashlib.sha1()
+    for document in documents:
+        digest.update("{}:{};".format(document["id"], document.get("version") or 0).encode())
+    return '"{}"'.format(digest.hexdigest())
+
+
+# `updated_at` (an ISO string or datetime, UTC) as an HTTP date.
+def http_date(timestamp):
+    if not timestamp:
+        return None
+    if isinstance(timestamp, str):
+        timestamp = datetime.fromisoformat(timestamp)
+    return format_datetime(timestamp.replace(tzinfo=timezone.utc, microsecond=0), usegmt=True)
+
+
+# RFC 7232: If-None-Match (weak comparison) takes precedence; If-Modified-Since
+# is only looked at without it.
+def is_not_modified(if_none_match: str, if_modified_since: str, etag: str, last_modified: str = None) -> bool:
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        return "*" in tags or etag in (tag[2:] if tag.startswith("W/") else tag for tag in tags)
+    if if_modified_since and last_modified:
+        try:
+            return parsedate_to_datetime(last_modified) <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+    return False
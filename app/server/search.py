@@ -0,0 +1,365 @@
+import heapq
+import math
+import re
+import sys
+import unicodedata
+from array import array
+from bisect import bisect_left, insort
+from operator import itemgetter
+
+# In-process full-text index over product names and descriptions, used by
+# GET /product/search. Every worker holds its own copy: it is built from the
+# collection at startup (see database.build_search_index) and kept up to date
+# by the product writes in database.py.
+#
+# Terms map to posting lists of (slot, weighted term frequency) kept in two
+# parallel arrays sorted by slot, about 6 bytes a posting. A product's slot is
+# fixed for as long as the process lives. Ranking is BM25 with a name match
+# counting NAME_WEIGHT times a description match. The vocabulary is also kept
+# sorted, so the last query word completes as a prefix with two bisections, and
+# a word (or prefix) that matches nothing is retried with every spelling one
+# edit away.
+#
+# Common words can match most of the catalog, so results are not found by
+# scoring every match. Each term also gets its postings ordered by score
+# ("impacts"). A query walks the impacts of its words best first, looks each
+# product it meets up in the other words' postings, and stops as soon as no
+# product further down can reach the current top `offset + limit` (Fagin's
+# threshold algorithm), or after MAX_WALK of them with the best found so far.
+# The match count is then estimated from the part walked.
+NAME_WEIGHT = 3
+K1 = 1.2
+B = 0.75
+# Words this short are never corrected, and a word completes or is corrected
+# to at most MAX_EXPANSIONS terms (the most frequent ones).
+MIN_FUZZY_LENGTH = 4
+MAX_EXPANSIONS = 32
+# Matches through a completion or a correction rank below exact ones.
+PREFIX_PENALTY = 0.8
+FUZZY_PENALTY = 0.6
+# Impacts are kept while the term sees writes: products added to it since are
+# merged in from a side list, removed ones skipped. They are rebuilt once that
+# list reaches IMPACT_PENDING entries or the average product length drifts by
+# IMPACT_DRIFT. Terms in WARM_IMPACTS or more products get theirs at startup.
+IMPACT_PENDING = 1024
+IMPACT_DRIFT = 0.1
+WARM_IMPACTS = 64
+# Products looked at per query, at most, beyond `offset + limit`.
+MAX_WALK = 1000
+
+TOKEN = re.compile(r"\w+")
+
+
+def tokenize(text) -> list:
+    if not text:
+        return []
+    text = unicodedata.normalize("NFKD", str(text).lower())
+    return TOKEN.findall("".join(char for char in text if not unicodedata.combining(char)))
+
+
+# A term's postings ordered by impact, the BM25 term-frequency part of the
+# score (idf and the query's weight are constant per term).
+class Impacts:
+    __slots__ = ("scores", "slots", "average", "pending", "_pending_sorted")
+
+    def __init__(self, scores: array, slots: array, average: float):
+        self.scores = scores
+        self.slots = slots
+        self.average = average
+        self.pending = set()
+        self._pending_sorted = None
+
+    def add(self, slot: int):
+        self.pending.add(slot)
+        self._pending_sorted = None
+
+    # (impact, slot) pairs, best first.
+    def stream(self, impact):
+        if not self.pending:
+            return zip(self.scores, self.slots)
+        if self._pending_sorted is None:
+            self._pending_sorted = sorted(
+                ((impact(slot), slot) for slot in self.pending), key=itemgetter(0), reverse=True)
+        return heapq.merge(zip(self.scores, self.slots), self._pending_sorted, key=itemgetter(0), reverse=True)
+
+
+class SearchIndex:
+    def __init__(self):
+        self.ready = False
+        self._ids = []
+        self._slots = {}
+        self._terms = []
+        self._lengths = array("I")
+        self._postings = {}
+        self._impacts = {}
+        self._vocabulary = []
+        self._alphabet = set()
+        self._total_length = 0
+        self._count = 0
+        # Products written while the startup build was reading the collection;
+        # the build must not overwrite them with what its cursor saw earlier.
+        self._building = None
+
+    def __len__(self) -> int:
+        return self._count
+
+    # Index (or re-index) a product from its `name` and `description`.
+    def add(self, id: str, document: dict):
+        if self._building is not None:
+            self._building.add(id)
+        self._add(id, document)
+
+    def remove(self, id: str):
+        if self._building is not None:
+            self._building.add(id)
+        slot = self._slots.get(id)
+        if slot is not None and self._terms[slot] is not None:
+            self._unlink(slot)
+
+    def start_build(self):
+        self._building = set()
+
+    def build_add(self, id: str, document: dict):
+        if id not in self._building:
+            self._add(id, document)
+
+    # Build the impacts of the large terms now rather than in the first queries
+    # using them, yielding after each term.
+    def warm(self):
+        for term in [term for term, (slots, _) in self._postings.items() if len(slots) >= WARM_IMPACTS]:
+            if term in self._postings:
+                self._term_impacts(term, self._total_length / self._count)
+            yield term
+
+    def finish_build(self):
+        self._building = None
+        self.ready = True
+
+    def abort_build(self):
+        self._building = None
+
+    def _add(self, id: str, document: dict):
+        # Interned, so the terms kept per product share one string each.
+        frequencies = {}
+        for term in tokenize(document.get("name")):
+            term = sys.intern(term)
+            frequencies[term] = frequencies.get(term, 0) + NAME_WEIGHT
+        for term in tokenize(document.get("description")):
+            term = sys.intern(term)
+            frequencies[term] = frequencies.get(term, 0) + 1
+        slot = self._slots.get(id)
+        if slot is None:
+            slot = self._slots[id] = len(self._ids)
+            self._ids.append(id)
+            self._terms.append(None)
+            self._lengths.append(0)
+        elif self._terms[slot] is not None:
+            self._unlink(slot)
+        length = sum(frequencies.values())
+        self._lengths[slot] = length
+        for term, frequency in frequencies.items():
+            postings = self._postings.get(term)
+            if postings is None:
+                postings = self._postings[term] = (array("I"), array("H"))
+                insort(self._vocabulary, term)
+                self._alphabet.update(term)
+            slots, weights = postings
+            position = bisect_left(slots, slot)
+            slots.insert(position, slot)
+            weights.insert(position, min(frequency, 0xFFFF))
+            impacts = self._impacts.get(term)
+            if impacts is not None:
+                impacts.add(slot)
+        self._terms[slot] = tuple(frequencies)
+        self._total_length += length
+        self._count += 1
+
+    def _unlink(self, slot: int):
+        for term in self._terms[slot]:
+            slots, weights = self._postings[term]
+            position = bisect_left(slots, slot)
+            del slots[position]
+            del weights[position]
+            if not slots:
+                del self._postings[term]
+                self._impacts.pop(term, None)
+                del self._vocabulary[bisect_left(self._vocabulary, term)]
+        self._terms[slot] = None
+        self._total_length -= self._lengths[slot]
+        self._count -= 1
+
+    def _completions(self, prefix: str) -> list:
+        start = bisect_left(self._vocabulary, prefix)
+        end = bisect_left(self._vocabulary, prefix + "\U0010ffff", start)
+        terms = self._vocabulary[start:end]
+        if len(terms) > MAX_EXPANSIONS:
+            terms = heapq.nlargest(MAX_EXPANSIONS, terms, key=lambda term: len(self._postings[term][0]))
+        return terms
+
+    def _edits(self, word: str) -> set:
+        splits = [(word[:i], word[i:]) for i in range(len(word) + 1)]
+        edits = {left + right[1:] for left, right in splits if right}
+        edits |= {left + right[1] + right[0] + right[2:] for left, right in splits if len(right) > 1}
+        for char in self._alphabet:
+            edits |= {left + char + right[1:] for left, right in splits if right}
+            edits |= {left + char + right for left, right in splits}
+        edits.discard(word)
+        return edits
+
+    # Terms a query word stands for, with the weight a match through each gets.
+    def expand(self, word: str, prefix: bool) -> dict:
+        terms = {}
+        if word in self._postings:
+            terms[word] = 1.0
+        if prefix:
+            for term in self._completions(word):
+                terms.setdefault(term, PREFIX_PENALTY)
+        if terms or len(word) < MIN_FUZZY_LENGTH:
+            return terms
+        for edit in self._edits(word):
+            if prefix:
+                for term in self._completions(edit):
+                    terms.setdefault(term, FUZZY_PENALTY)
+            elif edit in self._postings:
+                terms[edit] = FUZZY_PENALTY
+        if len(terms) > MAX_EXPANSIONS:
+            terms = dict(heapq.nlargest(MAX_EXPANSIONS, terms.items(),
+                                        key=lambda item: len(self._postings[item[0]][0])))
+        return terms
+
+    def _term_impacts(self, term: str, average: float) -> Impacts:
+        impacts = self._impacts.get(term)
+        if impacts is None or len(impacts.pending) >= IMPACT_PENDING or \
+                abs(impacts.average - average) > IMPACT_DRIFT * impacts.average:
+            slots, frequencies = self._postings[term]
+            base, scale, lengths = K1 * (1 - B), K1 * B / average, self._lengths
+            scores = [tf / (tf + base + scale * lengths[slot]) for slot, tf in zip(slots, frequencies)]
+            order = sorted(range(len(scores)), key=scores.__getitem__, reverse=True)
+            impacts = self._impacts[term] = Impacts(
+                array("f", (scores[i] for i in order)), array("I", (slots[i] for i in order)), average)
+        return impacts
+
+    # Product ids matching every word of `query` (the last one also as a
+    # prefix) with their scores, best first; the number of matches; and
+    # whether that number is exact (False when estimated after stopping early).
+    def search(self, query: str, limit: int = 10, offset: int = 0):
+        words = tokenize(query)
+        if not words or not self._count:
+            return [], 0, True
+        per_word = []
+        for index, word in enumerate(words):
+            terms = self.expand(word, prefix=index == len(words) - 1)
+            if not terms:
+                return [], 0, True
+            per_word.append(terms)
+
+        count, average = self._count, self._total_length / self._count
+        base, scale, lengths = K1 * (1 - B), K1 * B / average, self._lengths
+
+        def factor(term: str, weight: float) -> float:
+            frequency = len(self._postings[term][0])
+            return weight * (K1 + 1) * math.log((count - frequency + 0.5) / (frequency + 0.5) + 1)
+
+        def impact(term: str):
+            slots, frequencies = self._postings[term]
+
+            def of(slot: int) -> float:
+                position = bisect_left(slots, slot)
+                if position == len(slots) or slots[position] != slot:
+                    return 0.0
+                tf = frequencies[position]
+                return tf / (tf + base + scale * lengths[slot])
+            return of
+
+        # A word's score on a product: its best matching expansion.
+        def scorer(terms: dict):
+            parts = [(factor(term, weight), impact(term)) for term, weight in terms.items()]
+            if len(parts) == 1:
+                weight, of = parts[0]
+                return lambda slot: weight * of(slot)
+            return lambda slot: max(weight * of(slot) for weight, of in parts)
+
+        # A word's impacts, best first, across all the terms it expands to.
+        def walk(terms: dict):
+            streams = [_scaled(self._term_impacts(term, average).stream(impact(term)), factor(term, weight))
+                       for term, weight in terms.items()]
+            return heapq.merge(*streams, key=itemgetter(0), reverse=True) if len(streams) > 1 else streams[0]
+
+        per_word.sort(key=lambda terms: sum(len(self._postings[term][0]) for term in terms))
+        scorers = [scorer(terms) for terms in per_word]
+        wanted = offset + limit
+        top, seen, matched = [], set(), 0
+
+        def consider(slot: int, scorers: list = scorers):
+            nonlocal matched
+            score = 0.0
+            for word_score in scorers:
+                part = word_score(slot)
+                if not part:
+                    return
+                score += part
+            matched += 1
+            if len(top) < wanted:
+                heapq.heappush(top, (score, slot))
+            elif score > top[0][0]:
+                heapq.heapreplace(top, (score, slot))
+
+        candidates = sum(len(self._postings[term][0]) for term in per_word[0])
+        exhausted = candidates <= (MAX_WALK if len(per_word) > 1 else WARM_IMPACTS)
+        if exhausted:
+            # Few enough products have the rarest word to simply score them all
+            # (for a single word, few enough that walking its impacts would
+            # cost more than that).
+            # They all have it, so the other words are looked up first.
+            order = scorers[1:] + scorers[:1]
+            for term in per_word[0]:
+                for slot in self._postings[term][0]:
+                    if slot not in seen:
+                        seen.add(slot)
+                        consider(slot, order)
+        else:
+            # Walk every word's impacts in turn. A product not seen yet can
+            # score at most the sum of the impacts each walk has reached; once
+            # the top is full and better than that, nothing further down can
+            # enter it. A walk that runs out has shown every product containing
+            # its word, which all matches do, so the result is then complete.
+            # Past MAX_WALK more products than wanted, the best found so far
+            # are returned.
+            walks = [walk(terms) for terms in per_word]
+            reached = [math.inf] * len(walks)
+            while len(seen) < MAX_WALK + wanted:
+                for index, stream in enumerate(walks):
+                    item = next(stream, None)
+                    if item is None:
+                        exhausted = True
+                        break
+                    reached[index], slot = item
+                    if slot not in seen:
+                        seen.add(slot)
+                        # Impacts may still list products removed since.
+                        consider(slot)
+                else:
+                    if len(top) >= wanted and top[0][0] >= sum(reached):
+                        break
+                    continue
+                break
+        total = matched if exhausted else max(matched, round(matched / len(seen) * candidates))
+        top = sorted(top, reverse=True)[offset:]
+        return [(self._ids[slot], score) for score, slot in top], total, exhausted
+
+    def stats(self) -> dict:
+        return {
+            "ready": self.ready,
+            "products": self._count,
+            "terms": len(self._vocabulary),
+            "postings": sum(len(slots) for slots, _ in self._postings.values()),
+            "impacts": len(self._impacts),
+        }
+
+
+def _scaled(stream, factor: float):
+    for value, slot in stream:
+        yield factor * value, slot
+
+
+search_index = SearchIndex()
@@ -0,0 +1,202 @@
+import asyncio
+import codecs
+import csv
+import io
+import json
+import logging
+import time
+from collections import deque
+
+from pydantic import ValidationError
+
+logger = logging.getLogger(__name__)
+
+# Rows are validated and written in batches of this size; one batch is written
+# while the next one is parsed. Export output is flushed in chunks of roughly
+# EXPORT_CHUNK_SIZE bytes. Memory use depends on these sizes only, never on the
+# size of the file or the collection.
+IMPORT_BATCH_SIZE = 1000
+READ_CHUNK_SIZE = 64 * 1024
+EXPORT_CHUNK_SIZE = 64 * 1024
+MAX_ERROR_SAMPLES = 20
+
+# Summaries of the most recent imports and exports, for GET /transfer/stats.
+recent_runs = deque(maxlen=50)
+
+
+def detect_format(format, content_type: str) -> str:
+    if format:
+        return format
+    if content_type and content_type.startswith("text/csv"):
+        return "csv"
+    return "ndjson"
+
+
+async def upload_chunks(upload):
+    while True:
+        chunk = await upload.read(READ_CHUNK_SIZE)
+        if not chunk:
+            break
+        yield chunk
+
+
+# Split a stream of byte chunks into text lines without holding more than one
+# chunk and one partial line.
+async def iter_lines(chunks):
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    pending = ""
+    async for chunk in chunks:
+        pending += decoder.decode(chunk)
+        lines = pending.split("\n")
+        pending = lines.pop()
+        for line in lines:
+            yield line.rstrip("\r")
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        yield pending.rstrip("\r")
+
+
+# CSV records may contain quoted newlines, so lines are joined until the quotes
+# balance before a record is parsed. List/object cells hold JSON.
+async def iter_csv_rows(lines):
+    header = None
+    record = ""
+    async for line in lines:
+        record = record + "\n" + line if record else line
+        if record.count('"') % 2:
+            continue
+        values = next(csv.reader([record]), [])
+        record = ""
+        if header is None:
+            header = values
+            continue
+        if not values:
+            continue
+        yield {key: decode_csv_value(value) for key, value in zip(header, values)}
+
+
+def decode_csv_value(value: str):
+    if value == "":
+        return None
+    if value[:1] in "[{":
+        try:
+            return json.loads(value)
+        except ValueError:
+            return value
+    return value
+
+
+async def iter_ndjson_rows(lines):
+    async for line in lines:
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError as exc:
+            yield exc
+
+
+# Validate rows against `schema` and write them with `insert_many` (one of the
+# database bulk functions) batch by batch. Returns a summary with row, insert
+# and error counts and the throughput in rows per second.
+async def import_documents(chunks, format: str, schema, insert_many, name: str) -> dict:
+    started = time.perf_counter()
+    summary = {"collection": name, "direction": "import", "format": format,
+               "rows": 0, "inserted": 0, "errors": 0, "error_samples": []}
+    lines = iter_lines(chunks)
+    rows = iter_csv_rows(lines) if format == "csv" else iter_ndjson_rows(lines)
+
+    def record_error(row_number, error):
+        summary["errors"] += 1
+        if len(summary["error_samples"]) < MAX_ERROR_SAMPLES:
+            summary["error_samples"].append({"row": row_number, "error": error})
+
+    async def write(batch, batch_rows):
+        results = await insert_many(batch)
+        for row_number, result in zip(batch_rows, results):
+            if result["error"] is None:
+                summary["inserted"] += 1
+            else:
+                record_error(row_number, result["error"])
+
+    batch, batch_rows, writing = [], [], None
+    async for row in rows:
+        summary["rows"] += 1
+        if isinstance(row, Exception):
+            record_error(summary["rows"], "invalid JSON: {}".format(row))
+            continue
+        try:
+            document = schema.parse_obj(row)
+        except ValidationError as exc:
+            record_error(summary["rows"], exc.errors())
+            continue
+        batch.append(json.loads(document.json()))
+        batch_rows.append(summary["rows"])
+        if len(batch) >= IMPORT_BATCH_SIZE:
+            if writing is not None:
+                await writing
+            writing = asyncio.ensure_future(write(batch, batch_rows))
+            batch, batch_rows = [], []
+    if writing is not None:
+        await writing
+    if batch:
+        await write(batch, batch_rows)
+    return finish(summary, started)
+
+
+def finish(summary: dict, started: float) -> dict:
+    elapsed = time.perf_counter() - started
+    summary["seconds"] = round(elapsed, 3)
+    summary["rows_per_sec"] = round(summary["rows"] / elapsed, 1) if elapsed else 0.0
+    recent_runs.append({k: v for k, v in summary.items() if k != "error_samples"})
+    logger.info("%s %s: %d rows in %.3fs (%.1f rows/s), %d errors", summary["direction"],
+                summary["collection"], summary["rows"], elapsed, summary["rows_per_sec"], summary["errors"])
+    return summary
+
+
+def encode_json(document) -> str:
+    return json.dumps(document, default=str) + "\n"
+
+
+def encode_csv(fields):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def encode(document) -> str:
+        writer.writerow(
+            json.dumps(value, default=str) if isinstance(value, (list, dict)) else value
+            for value in (document.get(field) for field in fields)
+        )
+        line = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return line
+
+    return encode
+
+
+# Stream documents from an async iterator (a database stream_* function) as
+# NDJSON or CSV with `fields` as the header row.
+async def export_documents(documents, format: str, fields, name: str):
+    started = time.perf_counter()
+    summary = {"collection": name, "direction": "export", "format": format, "rows": 0, "errors": 0}
+    encode = encode_csv(fields) if format == "csv" else encode_json
+    chunk, size = [], 0
+    if format == "csv":
+        chunk.append(encode(dict(zip(fields, fields))))
+    try:
+        async for document in documents:
+            summary["rows"] += 1
+            line = encode(document)
+            chunk.append(line)
+            size += len(line)
+            if size >= EXPORT_CHUNK_SIZE:
+                yield "".join(chunk)
+                chunk, size = [], 0
+        if chunk:
+            yield "".join(chunk)
+    except Exception:
+        summary["errors"] += 1
+        raise
+    finally:
+        finish(summary, started)
@@ -0,0 +1,50 @@
+import asyncio
+
+import pytest
+from bson.objectid import ObjectId
+from mongomock_motor import AsyncMongoMockClient
+
+from server import analytics, database
+
+
+@pytest.fixture
+def db(monkeypatch):
+    db = AsyncMongoMockClient()["test"]
+    monkeypatch.setattr(database, "database", db)
+    monkeypatch.setattr(database, "basket_collection", db["basket_collection"])
+    monkeypatch.setattr(database, "archive_collection", db[database.ARCHIVE_COLLECTION])
+    return db
+
+
+def test_archived_basket_is_served_read_only(db):
+    hot, archived = ObjectId(), ObjectId()
+    basket = {"items": [], "status": "delivered", "created_at": None, "updated_at": None}
+
+    async def main():
+        await db["basket_collection"].insert_one({"_id": hot, **basket})
+        await db[database.ARCHIVE_COLLECTION].insert_one({"_id": archived, **basket})
+        return (await database.retrieve_basket(str(hot)), await database.retrieve_basket(str(archived)),
+                await database.retrieve_basket(str(ObjectId())), await database.delete_basket(str(archived)))
+
+    found, from_archive, missing, deleted = asyncio.run(main())
+    assert found["id"] == str(hot) and "archived" not in found
+    assert from_archive["id"] == str(archived) and from_archive["archived"] is True
+    assert missing is None
+    assert not deleted
+
+
+# Copies of a pass still in flight sit in the archive while their baskets are
+# still counted as delivered; they must not be counted twice.
+def test_status_counts_archived_baskets_once(db):
+    basket = {"items": [], "status": "delivered", "created_at": "2020-01-01", "updated_at": "2020-01-01"}
+
+    async def main():
+        await db["basket_collection"].insert_many([{**basket} for _ in range(3)])
+        _, moved = await database.archive_baskets("9999", 2)
+        in_flight = await db["basket_collection"].find_one()
+        await db[database.ARCHIVE_COLLECTION].insert_one({**in_flight, "fold": ObjectId()})
+        return moved, await analytics.status_counts()
+
+    moved, counts = asyncio.run(main())
+    assert len(moved) == 2
+    assert counts["delivered"] == 3
@@ -0,0 +1,152 @@
+import asyncio
+
+from server import cache
+from server.cache import LRUCache, MemoryBackend, ReadThroughCache
+
+
+# A backend whose writes fail while `down` is set.
+class FlakyBackend(MemoryBackend):
+    down = False
+
+    async def delete(self, *keys):
+        if self.down:
+            raise ConnectionRefusedError
+        await super().delete(*keys)
+
+    async def incr(self, key) -> int:
+        if self.down:
+            raise ConnectionRefusedError
+        return await super().incr(key)
+
+
+def loader(value, calls: list, gate: asyncio.Event = None):
+    async def load():
+        calls.append(value)
+        if gate is not None:
+            await gate.wait()
+        return dict(value)
+    return load
+
+
+def test_concurrent_misses_share_one_load():
+    cache = ReadThroughCache(MemoryBackend(100), "test")
+    calls = []
+
+    async def main():
+        gate = asyncio.Event()
+        load = loader({"name": "a"}, calls, gate)
+        callers = [asyncio.ensure_future(cache.get_or_load("1", load)) for _ in range(5)]
+        await asyncio.sleep(0)
+        gate.set()
+        values = await asyncio.gather(*callers)
+        return values, await cache.get_or_load("1", load)
+
+    values, cached = asyncio.run(main())
+    assert calls == [{"name": "a"}]
+    assert values == [{"name": "a"}] * 5 and cached == {"name": "a"}
+    assert cache.coalesced == 4 and cache.hits == 1
+    # Every caller gets a value of its own.
+    assert len({id(value) for value in values}) == 5
+
+
+def test_first_caller_going_away_does_not_cancel_the_load():
+    cache = ReadThroughCache(MemoryBackend(100), "test")
+    calls = []
+
+    async def main():
+        gate = asyncio.Event()
+        load = loader({"name": "a"}, calls, gate)
+        first = asyncio.ensure_future(cache.get_or_load("1", load))
+        await asyncio.sleep(0)
+        second = asyncio.ensure_future(cache.get_or_load("1", load))
+        await asyncio.sleep(0)
+        first.cancel()
+        gate.set()
+        return await second
+
+    assert asyncio.run(main()) == {"name": "a"}
+    assert calls == [{"name": "a"}]
+
+
+def test_invalidate_during_a_load_keeps_its_value_out():
+    backend = MemoryBackend(100)
+    cache = ReadThroughCache(backend, "test")
+
+    async def main():
+        gate = asyncio.Event()
+        loading = asyncio.ensure_future(cache.get_or_load("1", loader({"name": "old"}, [], gate)))
+        await asyncio.sleep(0)
+        await cache.invalidate("1")
+        gate.set()
+        stale = await loading
+        return stale, await backend.get("test:1"), await cache.get_or_load("1", loader({"name": "new"}, []))
+
+    stale, stored, fresh = asyncio.run(main())
+    assert stale == {"name": "old"}
+    assert stored is None
+    assert fresh == {"name": "new"}
+
+
+def test_failed_invalidate_bypasses_the_backend_until_it_succeeds():
+    backend = FlakyBackend(100)
+    cache = ReadThroughCache(backend, "test")
+
+    async def main():
+        await cache.get_or_load("1", loader({"name": "old"}, []))
+        backend.down = True
+        await cache.invalidate("1")
+        while_down = await cache.get_or_load("1", loader({"name": "new"}, []))
+        backend.down = False
+        return while_down, await cache.get_or_load("1", loader({"name": "newer"}, []))
+
+    while_down, after = asyncio.run(main())
+    assert while_down == {"name": "new"}
+    assert after == {"name": "newer"}
+    assert cache.errors >= 2
+
+
+def test_failed_bump_still_moves_the_generation():
+    backend = FlakyBackend(100)
+    cache = ReadThroughCache(backend, "test")
+
+    async def main():
+        before = await cache.generation()
+        backend.down = True
+        await cache.bump()
+        backend.down = False
+        return before, await cache.generation()
+
+    before, after = asyncio.run(main())
+    assert after == before + 1
+
+
+def test_cached_values_are_copies():
+    cache = ReadThroughCache(MemoryBackend(100), "test")
+
+    async def main():
+        value = await cache.get_or_load("1", loader({"tags": ["a"]}, []))
+        value["tags"].append("b")
+        return await cache.get_or_load("1", loader({"tags": ["c"]}, []))
+
+    assert asyncio.run(main()) == {"tags": ["a"]}
+
+
+def test_lru_drops_the_least_recently_used_entry():
+    lru = LRUCache(2)
+    lru.set("a", 1)
+    lru.set("b", 2)
+    assert lru.get("a") == 1
+    lru.set("c", 3)
+    assert "b" not in lru and lru.get("a") == 1 and lru.get("c") == 3
+    assert lru.evictions == 1
+
+
+def test_entries_expire_after_their_ttl(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(cache.time, "monotonic", lambda: now[0])
+    lru = LRUCache(10, ttl=5)
+    lru.set("a", 1)
+    lru.set("b", 2, ttl=60)
+    now[0] += 10
+    assert lru.get("a") is None and lru.get("b") == 2
+    assert lru.expirations == 1
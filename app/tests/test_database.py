@@ -0,0 +1,67 @@
+import asyncio
+
+import pytest
+from bson.objectid import ObjectId
+from mongomock_motor import AsyncMongoMockClient
+
+from server import database
+from server.database import BatchLoader
+
+
+@pytest.fixture
+def products(monkeypatch):
+    db = AsyncMongoMockClient()["test"]
+    monkeypatch.setattr(database, "database", db)
+    ids = [ObjectId() for _ in range(5)]
+    asyncio.run(db["product_collection"].insert_many([{"_id": id, "name": str(i)} for i, id in enumerate(ids)]))
+    return [str(id) for id in ids]
+
+
+def test_loads_in_one_tick_share_a_batch(products):
+    loader = BatchLoader("product_collection")
+
+    async def main():
+        return await asyncio.gather(*(loader.load(id) for id in products + products[:2]))
+
+    documents = asyncio.run(main())
+    assert [str(document["_id"]) for document in documents] == products + products[:2]
+    assert loader.batches == 1
+    assert loader.loads == 7
+
+
+def test_missing_and_invalid_ids_load_as_none(products):
+    loader = BatchLoader("product_collection")
+
+    async def main():
+        return await asyncio.gather(loader.load(str(ObjectId())), loader.load("nope"), loader.load(products[0]))
+
+    missing, invalid, found = asyncio.run(main())
+    assert missing is None and invalid is None
+    assert found["name"] == "0"
+    assert loader.batches == 1
+
+
+def test_cancelled_caller_does_not_cancel_the_batch(products):
+    loader = BatchLoader("product_collection")
+
+    async def main():
+        first = asyncio.ensure_future(loader.load(products[0]))
+        second = asyncio.ensure_future(loader.load(products[0]))
+        await asyncio.sleep(0)
+        first.cancel()
+        return await second
+
+    assert asyncio.run(main())["name"] == "0"
+
+
+def test_multi_get_keeps_order_and_reports_misses(products, monkeypatch):
+    loader = BatchLoader("product_collection")
+    monkeypatch.setattr(database, "product_loader", loader)
+    monkeypatch.setattr(database, "product_cache", database.ReadThroughCache(database.MemoryBackend(100), "test"))
+    missing = str(ObjectId())
+    ids = [products[2], "nope", missing, products[0], products[2]]
+    results = asyncio.run(database.retrieve_many(database.retrieve_product, ids))
+    assert [result["id"] for result in results] == ids
+    assert [result["error"] for result in results] == [None, "invalid id", "not found", None, None]
+    assert results[0]["name"] == "2"
+    assert loader.batches == 1 and loader.loads == 3
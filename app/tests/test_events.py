@@ -0,0 +1,78 @@
+import asyncio
+
+import pytest
+from bson.objectid import ObjectId
+from mongomock_motor import AsyncMongoMockClient
+
+from server import database, events
+from server.cache import MemoryBackend, ReadThroughCache
+from server.search import SearchIndex
+
+
+class CountingBackend(MemoryBackend):
+    def __init__(self, shared: bool):
+        super().__init__(100)
+        self.shared = shared
+        self.deleted = []
+
+    async def delete(self, *keys):
+        self.deleted.append(keys)
+        await super().delete(*keys)
+
+
+@pytest.fixture
+def products(monkeypatch):
+    db = AsyncMongoMockClient()["test"]
+    monkeypatch.setattr(database, "product_collection", db["product_collection"])
+    monkeypatch.setattr(events, "search_index", SearchIndex())
+    monkeypatch.setattr(database, "search_index", events.search_index)
+    ids = [ObjectId() for _ in range(3)]
+    asyncio.run(db["product_collection"].insert_many(
+        [{"_id": id, "name": "kettle {}".format(i), "description": ""} for i, id in enumerate(ids)]))
+    return [str(id) for id in ids]
+
+
+def change(id: str, operation: str = "update", document: dict = None):
+    return {"collection": "product", "operation": operation, "id": id}, document
+
+
+def use_backend(monkeypatch, shared: bool) -> CountingBackend:
+    backend = CountingBackend(shared)
+    monkeypatch.setattr(database, "product_cache", ReadThroughCache(backend, "product"))
+    return backend
+
+
+def test_a_batch_costs_one_invalidation_of_a_local_cache(monkeypatch, products):
+    backend = use_backend(monkeypatch, shared=False)
+    other = {"origin": "elsewhere:1"}
+    asyncio.run(events.invalidate_caches([change(id, document=other) for id in products]))
+    assert len(backend.deleted) == 1 and len(backend.deleted[0]) == 3
+    hits, _, _ = events.search_index.search("kettle")
+    assert len(hits) == 3
+
+
+def test_a_shared_cache_is_left_to_the_writer(monkeypatch, products):
+    backend = use_backend(monkeypatch, shared=True)
+    asyncio.run(events.invalidate_caches([change(products[0], document={"origin": "elsewhere:1"})]))
+    assert backend.deleted == []
+    assert len(events.search_index) == 1
+
+
+def test_own_writes_are_skipped(monkeypatch, products):
+    backend = use_backend(monkeypatch, shared=False)
+    reads = []
+    monkeypatch.setattr(database, "reindex_products", lambda ids: reads.append(ids) or asyncio.sleep(0))
+    mine = {"origin": database.origin()}
+    asyncio.run(events.invalidate_caches([change(id, document=mine) for id in products]))
+    assert backend.deleted == [] and reads == [[]]
+
+
+def test_change_stream_documents_are_indexed_without_a_read(monkeypatch, products):
+    use_backend(monkeypatch, shared=True)
+    reads = []
+    monkeypatch.setattr(database, "reindex_products", lambda ids: reads.append(ids) or asyncio.sleep(0))
+    document = {"name": "teapot", "description": ""}
+    asyncio.run(events.invalidate_caches([change(products[0], document=document),
+                                          change(products[1], "delete")]))
+    assert reads == [[]]
+    assert events.search_index.search("teapot")[0][0][0] == products[0]
@@ -0,0 +1,31 @@
+import asyncio
+
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+from pymongo.errors import OperationFailure
+
+from server import database
+from server.indexes import ensure_indexes
+
+
+@pytest.fixture
+def db(monkeypatch):
+    db = AsyncMongoMockClient()["test"]
+    monkeypatch.setattr(database, "database", db)
+    return db
+
+
+def test_ensure_indexes_creates_every_index(db):
+    asyncio.run(ensure_indexes())
+    names = asyncio.run(db["users_collection"].index_information())
+    assert {"username_unique", "email_unique", "national_id"} <= set(names)
+
+
+# Duplicates block the unique username index: the failure is raised so the
+# worker stays unready, after the other indexes have still been created.
+def test_unique_index_failure_is_raised(db):
+    asyncio.run(db["users_collection"].insert_many([{"username": "johndoe"}, {"username": "johndoe"}]))
+    with pytest.raises(OperationFailure, match="users_collection"):
+        asyncio.run(ensure_indexes())
+    assert "national_id" in asyncio.run(db["users_collection"].index_information())
+    assert "name_id" in asyncio.run(db["product_collection"].index_information())
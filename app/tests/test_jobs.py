@@ -0,0 +1,34 @@
+import asyncio
+import signal
+
+import motor.motor_asyncio
+from mongomock_motor import AsyncMongoMockClient
+
+from server import config, jobs
+
+
+# The runner archives baskets, so with the journal as the change source its
+# deletes must be journaled like a web worker's: the source is prepared before
+# any job is leased.
+def test_job_runner_prepares_the_change_source(monkeypatch):
+    calls = []
+
+    async def prepare_source():
+        calls.append("prepare_source")
+        return "journal"
+
+    monkeypatch.setattr(motor.motor_asyncio, "AsyncIOMotorClient", AsyncMongoMockClient)
+    monkeypatch.setattr(jobs, "prepare_source", prepare_source)
+    monkeypatch.setattr(jobs.job_pool, "start", lambda workers: calls.append("start"))
+    monkeypatch.setattr(config, "JOBS_RUNNER_WORKERS", 1)
+
+    async def main():
+        runner = asyncio.ensure_future(jobs.main())
+        while "start" not in calls and not runner.done():
+            await asyncio.sleep(0.01)
+        if not runner.done():
+            signal.raise_signal(signal.SIGTERM)
+        await runner
+
+    asyncio.run(main())
+    assert calls == ["prepare_source", "start"]
@@ -0,0 +1,88 @@
+import asyncio
+import random
+
+import mongomock
+import pytest
+from bson import ObjectId
+from fastapi.testclient import TestClient
+from mongomock_motor import AsyncMongoMockClient
+
+from server import app as app_module, database
+from server.database import decode_cursor, encode_cursor, keyset_query, sort_order
+
+
+@pytest.mark.parametrize("sort, value", [(None, None), ("created_at", "2024-01-02"), ("-price", 3.5),
+                                         ("created_at", None)])
+def test_cursor_round_trip(sort, value):
+    id = ObjectId()
+    after = encode_cursor({"id": str(id), "created_at": value, "price": value}, sort)
+    assert decode_cursor(after, sort) == (None if sort is None else value, id)
+
+
+@pytest.mark.parametrize("sort, after", [(None, "nope"), ("created_at", "bm9wZQ=="), ("created_at", "!!")])
+def test_invalid_cursor(sort, after):
+    with pytest.raises(ValueError):
+        decode_cursor(after, sort)
+    with pytest.raises(ValueError):
+        keyset_query({}, sort, after)
+
+
+def test_keyset_query_without_cursor_is_the_query():
+    assert keyset_query({"status": "received"}, "created_at") == {"status": "received"}
+
+
+# Paging with the cursor of each page's last document must walk the whole
+# collection in sort order, including documents with a null or missing field.
+@pytest.mark.parametrize("sort", [None, "created_at", "-created_at"])
+@pytest.mark.parametrize("size", [1, 3, 7])
+def test_keyset_pages_cover_the_collection(sort, size):
+    rng = random.Random(size)
+    collection = mongomock.MongoClient().db.products
+    documents = []
+    for _ in range(40):
+        document = {"_id": ObjectId()}
+        roll = rng.random()
+        if roll < 0.5:
+            document["created_at"] = "2024-01-0{}".format(rng.randint(1, 4))
+        elif roll < 0.75:
+            document["created_at"] = None
+        documents.append(document)
+    collection.insert_many(documents)
+
+    expected = [document["_id"] for document in collection.find().sort(sort_order(sort))]
+    seen, after = [], None
+    while True:
+        page = list(collection.find(keyset_query({}, sort, after)).sort(sort_order(sort)).limit(size))
+        seen += [document["_id"] for document in page]
+        if len(page) < size:
+            break
+        last = page[-1]
+        after = encode_cursor({"id": str(last["_id"]), "created_at": last.get("created_at")}, sort)
+    assert seen == expected
+
+
+@pytest.fixture
+def client(monkeypatch):
+    db = AsyncMongoMockClient()["test"]
+    monkeypatch.setattr(database, "product_collection", db["product_collection"])
+    monkeypatch.setattr(database, "product_cache", database.ReadThroughCache(database.MemoryBackend(100), "test"))
+    monkeypatch.setitem(app_module.app.dependency_overrides, app_module.get_current_active_user, lambda: None)
+    asyncio.run(db["product_collection"].insert_many(
+        [database.stamp_new({"name": name, "price": 1.0}) for name in ("a", "b")]))
+    return TestClient(app_module.app)
+
+
+# The versions are read for the page ETag either way, but only returned when
+# `fields` asks for them.
+@pytest.mark.parametrize("fast", ["false", "true"])
+def test_listing_returns_the_version_only_when_asked(client, fast):
+    trimmed = client.get("/product", params={"fields": "name", "fast": fast})
+    full = client.get("/product", params={"fields": "name,version", "fast": fast})
+    assert trimmed.status_code == full.status_code == 200
+    products = trimmed.json()["data"]
+    products = products[0] if fast == "false" else products
+    assert [sorted(product) for product in products] == [["id", "name"]] * 2
+    products = full.json()["data"]
+    products = products[0] if fast == "false" else products
+    assert [product["version"] for product in products] == [1, 1]
+    assert trimmed.headers["ETag"] == full.headers["ETag"]
@@ -0,0 +1,100 @@
+import asyncio
+
+import pytest
+
+from server import ratelimit
+from server.ratelimit import AdaptiveConcurrency, LoadShedMiddleware
+
+
+def limiter(**kwargs) -> AdaptiveConcurrency:
+    options = dict(initial=4, minimum=2, maximum=8, target_latency=0.1, queue_timeout=1.0, max_queue=2)
+    options.update(kwargs)
+    return AdaptiveConcurrency(**options)
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def test_limit_grows_by_one_per_limit_fast_requests():
+    concurrency = limiter()
+    for _ in range(4):
+        assert run(concurrency.acquire())
+        concurrency.release(0.01)
+    assert concurrency.limit == pytest.approx(5, abs=0.2)
+    for _ in range(100):
+        run(concurrency.acquire())
+        concurrency.release(0.01)
+    assert concurrency.limit == 8
+    assert concurrency.in_flight == 0
+
+
+def test_limit_shrinks_once_per_target_latency(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(ratelimit.time, "monotonic", lambda: now[0])
+    concurrency = limiter()
+    for _ in range(3):
+        run(concurrency.acquire())
+        concurrency.release(0.5)
+    assert concurrency.limit == pytest.approx(3.6)
+    for _ in range(10):
+        now[0] += 1
+        run(concurrency.acquire())
+        concurrency.release(0.5)
+    assert concurrency.limit == 2
+
+
+def test_full_queue_is_shed_and_a_freed_slot_goes_to_a_waiter():
+    concurrency = limiter(initial=2, max_queue=1)
+
+    async def main():
+        assert await concurrency.acquire() and await concurrency.acquire()
+        waiting = asyncio.ensure_future(concurrency.acquire())
+        await asyncio.sleep(0)
+        shed = await concurrency.acquire()
+        concurrency.release(0.01)
+        return shed, await waiting
+
+    shed, handed = run(main())
+    assert not shed and handed
+    assert concurrency.shed == 1
+    assert concurrency.in_flight == 2 and concurrency.queued == 0
+
+
+def test_waiters_past_the_queue_timeout_are_shed():
+    concurrency = limiter(initial=2, queue_timeout=0.01)
+
+    async def main():
+        await concurrency.acquire()
+        await concurrency.acquire()
+        return await concurrency.acquire()
+
+    assert not run(main())
+    assert concurrency.shed == 1 and concurrency.in_flight == 2
+
+
+def test_middleware_releases_the_slot_when_the_response_starts():
+    concurrency = limiter(initial=2)
+    in_flight = []
+
+    async def app(scope, receive, send):
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        in_flight.append(concurrency.in_flight)
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+    async def send(message):
+        pass
+
+    middleware = LoadShedMiddleware(app, concurrency, exempt=("/ready",))
+    run(middleware({"type": "http", "path": "/product"}, None, send))
+    assert in_flight == [0]
+
+    concurrency.in_flight = 2
+    concurrency.limit = 2
+    sent = []
+
+    async def record(message):
+        sent.append(message)
+
+    run(middleware({"type": "http", "path": "/ready"}, None, record))
+    assert sent[0]["status"] == 200
@@ -0,0 +1,68 @@
+from server.search import SearchIndex, tokenize
+
+
+def index(products: dict) -> SearchIndex:
+    search_index = SearchIndex()
+    for id, document in products.items():
+        search_index.add(id, document)
+    return search_index
+
+
+def ids(search_index: SearchIndex, query: str, **kwargs) -> list:
+    hits, _, _ = search_index.search(query, **kwargs)
+    return [id for id, _ in hits]
+
+
+def test_tokenize_folds_case_and_accents():
+    assert tokenize("Crème BRÛLÉE, x2") == ["creme", "brulee", "x2"]
+    assert tokenize(None) == []
+
+
+def test_name_match_ranks_above_description_match():
+    search_index = index({
+        "description": {"name": "Mug", "description": "A mug for tea"},
+        "name": {"name": "Tea", "description": "Loose leaves"},
+        "other": {"name": "Plate", "description": "Flat"},
+    })
+    assert ids(search_index, "tea") == ["name", "description"]
+
+
+def test_term_frequency_and_length():
+    search_index = index({
+        "once": {"name": "Lamp", "description": "desk lamp with a long cable and a heavy base"},
+        "twice": {"name": "Lamp", "description": "lamp"},
+    })
+    assert ids(search_index, "lamp") == ["twice", "once"]
+
+
+def test_rare_term_outweighs_common_term():
+    products = {str(i): {"name": "Chair", "description": "wooden"} for i in range(20)}
+    products["rare"] = {"name": "Chair", "description": "oak"}
+    products["common"] = {"name": "Table", "description": "wooden wooden"}
+    search_index = index(products)
+    assert ids(search_index, "oak wooden") == []
+    assert ids(search_index, "chair oak") == ["rare"]
+    hits, total, exact = search_index.search("chair", limit=5)
+    assert total == 21 and exact and len(hits) == 5
+
+
+def test_paging_matches_the_full_ranking():
+    # Distinct lengths, so no two scores tie.
+    search_index = index({str(i): {"name": "Cup " * (i % 4 + 1), "description": "filler " * i} for i in range(30)})
+    full = ids(search_index, "cup", limit=30)
+    assert ids(search_index, "cup", limit=10, offset=10) == full[10:20]
+
+
+def test_removed_and_reindexed_products():
+    search_index = index({"1": {"name": "Kettle"}, "2": {"name": "Kettle"}})
+    search_index.remove("1")
+    search_index.add("2", {"name": "Toaster"})
+    assert ids(search_index, "kettle") == []
+    assert ids(search_index, "toaster") == ["2"]
+    assert len(search_index) == 1
+
+
+def test_prefix_of_the_last_word_and_corrections():
+    search_index = index({"1": {"name": "Kettle"}, "2": {"name": "Blender"}})
+    assert ids(search_index, "kett") == ["1"]
+    assert ids(search_index, "blemder") == ["2"]
@@ -0,0 +1,64 @@
+import signal
+import time
+
+import motor.motor_asyncio
+import pytest
+from fastapi.testclient import TestClient
+from mongomock_motor import AsyncMongoMockClient
+
+from server import app as app_module, database
+from server.app import app
+
+
+# A worker that fails to start signals itself; here that must not stop pytest.
+@pytest.fixture
+def signals(monkeypatch):
+    signals = []
+    monkeypatch.setattr(motor.motor_asyncio, "AsyncIOMotorClient", AsyncMongoMockClient)
+    monkeypatch.setattr(app_module.os, "kill", lambda pid, sig: signals.append(sig))
+    monkeypatch.setattr(app.state, "failed", None)
+    return signals
+
+
+@pytest.fixture
+def client(signals):
+    with TestClient(app) as client:
+        yield client
+
+
+async def broken_ensure_indexes():
+    raise TypeError("unexpected option")
+
+
+def wait_ready(client, timeout: float = 10) -> dict:
+    deadline = time.monotonic() + timeout
+    while True:
+        response = client.get("/ready")
+        if response.status_code == 200 or time.monotonic() > deadline:
+            return response
+        time.sleep(0.05)
+
+
+# mongomock takes no storage options, like a server built without the
+# archive's compressor: the app must still come up.
+def test_boots_against_the_mock_backend(client, signals):
+    response = wait_ready(client)
+    assert response.status_code == 200, response.json()
+    assert app.state.failed is None and not signals
+
+    async def collections():
+        return await database.database.list_collection_names()
+
+    assert database.ARCHIVE_COLLECTION in client.portal.call(collections)
+
+
+def test_unexpected_startup_error_stops_the_worker(monkeypatch, signals):
+    exits = []
+    monkeypatch.setattr(app_module, "ensure_indexes", broken_ensure_indexes)
+    monkeypatch.setattr(app_module.os, "_exit", exits.append)
+    with TestClient(app) as client:
+        response = wait_ready(client, timeout=1)
+        assert response.status_code == 503
+        assert response.json()["detail"] == "Startup failed"
+        assert signals == [signal.SIGTERM]
+    assert exits == [app_module.WORKER_BOOT_ERROR]
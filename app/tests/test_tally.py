@@ -0,0 +1,140 @@
+import asyncio
+import time
+
+import pytest
+from bson.objectid import ObjectId
+from mongomock_motor import AsyncMongoMockClient
+
+from server import analytics, database
+
+
+@pytest.fixture
+def db(monkeypatch):
+    db = AsyncMongoMockClient()["test"]
+    monkeypatch.setattr(database, "database", db)
+    monkeypatch.setattr(database, "basket_collection", db["basket_collection"])
+    monkeypatch.setattr(database, "archive_collection", db[database.ARCHIVE_COLLECTION])
+    return db
+
+
+def basket(status: str, *lines, **fields) -> dict:
+    return database.stamp_new_basket({
+        "items": [{"product_id": product_id, "quantity": quantity} for product_id, quantity in lines],
+        "status": status, **fields})
+
+
+async def tally() -> tuple:
+    return await database.tally_baskets(2, time.monotonic() + 10)
+
+
+async def totals() -> dict:
+    return {key: tuple(row) for key, row in (await analytics.line_totals()).items()}
+
+
+def test_totals_follow_inserts_updates_and_deletes(db):
+    async def main():
+        first = await database.add_basket(basket("received", ("a", 2), ("b", 1)))
+        second = await database.add_basket(basket("received", ("a", 3)))
+        # Legacy baskets may lack updated_at and version.
+        await db["basket_collection"].insert_one({"items": [{"product_id": "b", "quantity": 4}, {"quantity": 1}],
+                                                  "status": "delivered"})
+        read, tallied, more = await tally()
+        assert (read, tallied, more) == (3, 3, False)
+        assert await totals() == {("a", "received"): (5, 2), ("b", "received"): (1, 1), ("b", "delivered"): (4, 1)}
+
+        await database.update_basket(first["id"], {"status": "processing"})
+        await database.update_basket(second["id"], {"items": [{"product_id": "a", "quantity": 1}]})
+        _, tallied, _ = await tally()
+        assert tallied == 2
+        assert await totals() == {("a", "processing"): (2, 1), ("b", "processing"): (1, 1), ("a", "received"): (1, 1),
+                                  ("b", "delivered"): (4, 1)}
+
+        # Nothing changed: nothing to add.
+        _, tallied, _ = await tally()
+        assert tallied == 0
+        await database.delete_basket(first["id"])
+        await database.delete_baskets_bulk([second["id"], str(ObjectId())])
+        assert await totals() == {("b", "delivered"): (4, 1)}
+
+    asyncio.run(main())
+
+
+def test_archiving_moves_the_tally_to_the_archive_totals(db):
+    async def main():
+        await database.add_basket(basket("delivered", ("a", 2)))
+        await tally()
+        _, ids = await database.archive_baskets("9999", 10)
+        assert len(ids) == 1
+        assert await totals() == {("a", "delivered"): (2, 1)}
+        rows = await db[database.LINE_TOTALS_COLLECTION].find({"kind": "line"}).to_list(None)
+        assert [(row["quantity"], row["lines"]) for row in rows] == [(0, 0)]
+
+    asyncio.run(main())
+
+
+def test_an_archive_racing_a_tally_pass_keeps_the_basket(db):
+    async def main():
+        created = await database.add_basket(basket("delivered", ("a", 2)))
+        await tally()
+        await database.update_basket(created["id"], {"items": [{"product_id": "a", "quantity": 3}]})
+        stale = await db["basket_collection"].find_one()
+        # The pass moves the tally after the archive read the basket.
+        await database.tally_batch([stale])
+        original = database.basket_collection.find
+
+        def find(query, *args, **kwargs):
+            if "status" in query:
+                return FakeCursor(stale)
+            return original(query, *args, **kwargs)
+
+        database.basket_collection.find = find
+        try:
+            read, ids = await database.archive_baskets("9999", 10)
+        finally:
+            database.basket_collection.find = original
+        assert read == 1 and ids == []
+        assert await totals() == {("a", "delivered"): (3, 1)}
+
+    asyncio.run(main())
+
+
+class FakeCursor:
+    def __init__(self, *documents):
+        self.documents = list(documents)
+
+    def sort(self, *args):
+        return self
+
+    def limit(self, *args):
+        return self
+
+    async def to_list(self, length):
+        return self.documents
+
+
+def test_interrupted_passes_are_finished_once(db):
+    async def main():
+        await database.add_basket(basket("received", ("a", 2)))
+        await database.add_basket(basket("received", ("b", 1)))
+        baskets = await db["basket_collection"].find().to_list(None)
+        # Crash after moving the tallies, before noting which moved.
+        original = database.finish_tally_pass
+
+        async def crash(pass_id, applied):
+            raise RuntimeError("worker died")
+
+        database.finish_tally_pass = crash
+        try:
+            with pytest.raises(RuntimeError):
+                await database.tally_batch(baskets)
+        finally:
+            database.finish_tally_pass = original
+        assert await totals() == {}
+        await db[database.LINE_TOTALS_COLLECTION].update_many({"kind": "pass"}, {"$unset": {"applied": ""}})
+        assert await database.recover_tally_passes(-60) == 1
+        assert await database.recover_tally_passes(-60) == 0
+        assert await totals() == {("a", "received"): (2, 1), ("b", "received"): (1, 1)}
+        _, tallied, _ = await tally()
+        assert tallied == 0
+
+    asyncio.run(main())
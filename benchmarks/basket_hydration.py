@@ -0,0 +1,103 @@
+# Payload size and latency of baskets with 1, 50 and 500 line items.
+#
+# Start the API (cd app && python main.py), create the user with POST /user,
+# then:
+#
+#     python benchmarks/basket_hydration.py --url http://localhost:8000
+#
+# For each basket size it reports the stored document size with embedded
+# product payloads (the old untyped items) against product references, and the
+# latency and response size of
+#   - GET /basket/{id}               references only,
+#   - GET /basket/{id}?expand=true   products resolved with one $in query,
+#   - client-side N+1                GET /basket/{id} plus GET /product/{id}
+#                                    for every line, which expand replaces.
+import argparse
+import asyncio
+import json
+import os
+import sys
+
+import bson
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+from common import HttpClient, summarize, timed  # noqa: E402
+
+SIZES = (1, 50, 500)
+
+
+async def login(client, username, password):
+    status, _, body = await client.request("POST", "/token", form={"username": username, "password": password})
+    if status != 200:
+        raise SystemExit("login failed: {} {}".format(status, body[:200]))
+    return {"Authorization": "Bearer " + json.loads(body)["access_token"]}
+
+
+async def seed(client, headers, size):
+    products = [
+        {"name": "product {}".format(i), "description": "benchmark product " * 8, "price": 1000 + i}
+        for i in range(size)
+    ]
+    _, _, body = await client.request("POST", "/product/bulk", headers=headers, json_body=products)
+    product_ids = [result["id"] for result in json.loads(body)["data"][0]]
+    items = [{"product_id": id, "quantity": 1} for id in product_ids]
+    _, _, body = await client.request(
+        "POST", "/basket", headers=headers, json_body={"items": items, "status": "received"})
+    basket_id = json.loads(body)["data"][0]["id"]
+    embedded = {"items": [dict(product, quantity=1) for product in products], "status": "received"}
+    referenced = {"items": items, "status": "received"}
+    return basket_id, len(bson.encode(embedded)), len(bson.encode(referenced))
+
+
+async def measure(client, headers, path, repeat):
+    latencies, size = [], 0
+    for _ in range(repeat):
+        (status, _, body), elapsed = await timed(client.request("GET", path, headers=headers))
+        latencies.append(elapsed)
+        size = len(body)
+    return summarize(latencies), size
+
+
+async def n_plus_one(client, headers, basket_id, repeat):
+    latencies, size = [], 0
+    for _ in range(repeat):
+        async def fetch():
+            _, _, body = await client.request("GET", "/basket/{}".format(basket_id), headers=headers)
+            total = len(body)
+            for item in json.loads(body)["data"][0]["items"]:
+                _, _, product = await client.request("GET", "/product/{}".format(item["product_id"]), headers=headers)
+                total += len(product)
+            return total
+        size, elapsed = await timed(fetch())
+        latencies.append(elapsed)
+    return summarize(latencies), size
+
+
+async def run(args):
+    client = HttpClient(args.url)
+    headers = await login(client, args.username, args.password)
+    results = []
+    for size in SIZES:
+        basket_id, embedded_bytes, referenced_bytes = await seed(client, headers, size)
+        plain, plain_size = await measure(client, headers, "/basket/{}".format(basket_id), args.repeat)
+        expanded, expanded_size = await measure(client, headers, "/basket/{}?expand=true".format(basket_id), args.repeat)
+        separate, separate_size = await n_plus_one(client, headers, basket_id, max(1, args.repeat // 10))
+        results.append({
+            "items": size,
+            "stored_bytes": {"embedded": embedded_bytes, "referenced": referenced_bytes},
+            "references": dict(plain, response_bytes=plain_size),
+            "expand": dict(expanded, response_bytes=expanded_size),
+            "n_plus_one": dict(separate, response_bytes=separate_size),
+        })
+    await client.close()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--username", default="johndoe")
+    parser.add_argument("--password", default="secret")
+    parser.add_argument("--repeat", type=int, default=50)
+    asyncio.run(run(parser.parse_args()))
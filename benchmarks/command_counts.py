@@ -0,0 +1,91 @@
+# Count the MongoDB commands each data-layer call issues.
+#
+# Every endpoint in server/app.py maps onto one database.py function, so the
+# number of driver commands per call is the number of round trips the endpoint
+# pays. Run against a local mongod (MONGO_DETAILS, see server/config.py):
+#
+#     python benchmarks/command_counts.py
+#
+# The script exits non-zero when a call issues more commands than its budget.
+import asyncio
+import os
+import sys
+from collections import Counter
+
+from pymongo import monitoring
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+
+class CommandCounter(monitoring.CommandListener):
+    def __init__(self):
+        self.commands = Counter()
+
+    def started(self, event):
+        self.commands[event.command_name] += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+counter = CommandCounter()
+# Listeners must be registered before database.connect() builds the client.
+monitoring.register(counter)
+
+from server import database  # noqa: E402
+
+# Every single-document read and write should be one round trip. A basket
+# missing from basket_collection is looked up in the archive as well.
+BUDGET = 1
+GONE_BUDGET = {"basket": 2}
+
+
+async def measure(label, call, budget=BUDGET):
+    counter.commands.clear()
+    result = await call()
+    issued = sum(counter.commands.values())
+    status = "ok" if issued <= budget else "OVER BUDGET"
+    print("{:<24} {:>2} command(s) {:<40} {}".format(label, issued, dict(counter.commands), status))
+    return result, issued <= budget
+
+
+async def run():
+    database.connect()
+    passed = True
+    samples = {
+        "product": {"name": "bench", "description": "command count", "price": 1.0},
+        "basket": {"items": [], "created_at": None, "updated_at": None, "status": "received"},
+        "user": {
+            "username": "bench", "first_name": "b", "last_name": "b",
+            "email": "bench@example.com", "password": "bench", "national_id": "0",
+        },
+    }
+    for name, document in samples.items():
+        add = getattr(database, "add_{}".format(name))
+        update = getattr(database, "update_{}".format(name))
+        delete = getattr(database, "delete_{}".format(name))
+        retrieve = getattr(database, "retrieve_{}".format(name))
+        field = next(iter(document))
+
+        created, ok = await measure("POST /{}".format(name), lambda: add(dict(document)))
+        passed &= ok
+        id = created["id"]
+        _, ok = await measure("GET /{}/{{id}}".format(name), lambda: retrieve(id))
+        passed &= ok
+        _, ok = await measure("PUT /{}/{{id}}".format(name), lambda: update(id, {field: document[field]}))
+        passed &= ok
+        _, ok = await measure("DELETE /{}/{{id}}".format(name), lambda: delete(id))
+        passed &= ok
+        _, ok = await measure("DELETE /{}/{{id}} (gone)".format(name), lambda: delete(id))
+        passed &= ok
+        _, ok = await measure("GET /{}/{{id}} (gone)".format(name), lambda: retrieve(id),
+                              GONE_BUDGET.get(name, BUDGET))
+        passed &= ok
+    return passed
+
+
+if __name__ == "__main__":
+    sys.exit(0 if asyncio.get_event_loop().run_until_complete(run()) else 1)
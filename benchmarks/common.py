@@ -0,0 +1,99 @@
+# Helpers shared by the benchmark scripts: a small keep-alive HTTP/1.1 client on
+# top of asyncio streams (no extra dependencies) and latency summaries.
+import asyncio
+import json
+import time
+from urllib.parse import urlencode, urlparse
+
+
+class HttpClient:
+    def __init__(self, base_url: str):
+        parsed = urlparse(base_url)
+        self.host = parsed.hostname
+        self.port = parsed.port or 80
+        self._reader = None
+        self._writer = None
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    async def request(self, method: str, path: str, headers: dict = None, body: bytes = b"",
+                      json_body=None, form: dict = None):
+        headers = dict(headers or {})
+        if json_body is not None:
+            body = json.dumps(json_body).encode()
+            headers["Content-Type"] = "application/json"
+        elif form is not None:
+            body = urlencode(form).encode()
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        headers.setdefault("Host", "{}:{}".format(self.host, self.port))
+        headers["Content-Length"] = str(len(body))
+        head = "{} {} HTTP/1.1\r\n".format(method, path)
+        head += "".join("{}: {}\r\n".format(k, v) for k, v in headers.items())
+        for attempt in range(2):
+            if self._writer is None:
+                self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+            try:
+                self._writer.write(head.encode() + b"\r\n" + body)
+                await self._writer.drain()
+                return await self._read_response()
+            except (ConnectionError, asyncio.IncompleteReadError):
+                # The server closed an idle keep-alive connection; retry once.
+                await self.close()
+                if attempt:
+                    raise
+
+    async def _read_response(self):
+        status_line = await self._reader.readuntil(b"\r\n")
+        status = int(status_line.split()[1])
+        headers = {}
+        while True:
+            line = await self._reader.readuntil(b"\r\n")
+            if line == b"\r\n":
+                break
+            name, _, value = line.decode().partition(":")
+            headers[name.strip().lower()] = value.strip()
+        if headers.get("transfer-encoding") == "chunked":
+            chunks = []
+            while True:
+                size = int((await self._reader.readuntil(b"\r\n")).strip(), 16)
+                chunk = await self._reader.readexactly(size + 2)
+                if size == 0:
+                    break
+                chunks.append(chunk[:-2])
+            body = b"".join(chunks)
+        else:
+            body = await self._reader.readexactly(int(headers.get("content-length", 0)))
+        if headers.get("connection") == "close":
+            await self.close()
+        return status, headers, body
+
+
+def percentile(samples, q: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, int(round(q / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+# Latencies are in seconds; the summary reports milliseconds.
+def summarize(latencies, elapsed: float = None) -> dict:
+    summary = {
+        "count": len(latencies),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "max_ms": round(max(latencies, default=0) * 1000, 3),
+    }
+    if elapsed:
+        summary["throughput_rps"] = round(len(latencies) / elapsed, 1)
+    return summary
+
+
+async def timed(coro):
+    start = time.perf_counter()
+    result = await coro
+    return result, time.perf_counter() - start
@@ -0,0 +1,368 @@
+# Mixed-workload load test of the whole API, with results kept per commit.
+#
+# The harness boots server.app:app in-process with uvicorn against a local
+# MongoDB stand-in, seeds users, products and baskets through the API, then runs
+# `--clients` virtual users for `--seconds`. Each one logs in, browses and views
+# products, builds baskets item by item and walks them through
+# received -> processing -> delivered:
+#
+#     python benchmarks/harness.py --products 5000 --baskets 2000 --clients 32
+#
+# The backend is a mongod spawned on a temporary dbpath when one is on PATH,
+# otherwise mongomock-motor (pip install -r benchmarks/requirements.txt), which
+# has no network hop and does not support every query, so only compare numbers
+# taken on the same backend. --url skips booting and targets a running server.
+#
+# Throughput and p50/p95/p99 per endpoint are printed and written to
+# benchmarks/results/<commit>[-<label>].json; --compare <file> prints the
+# change against an earlier run.
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+from common import HttpClient, summarize, timed  # noqa: E402
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+APP_DIR = os.path.join(ROOT, "app")
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+USERNAME = "johndoe"
+PASSWORD = "secret"
+SEED_BATCH = 1000
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def git_revision():
+    def git(*args):
+        return subprocess.run(["git", *args], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    return git("rev-parse", "--short", "HEAD") or "unknown", bool(git("status", "--porcelain", "--", "app"))
+
+
+# Backends. Both have to be set up before server.app is imported, since the
+# settings are read from the environment at import time.
+class Mongod:
+    def __init__(self):
+        self.dbpath = tempfile.mkdtemp(prefix="bench-mongod-")
+        self.port = free_port()
+        self.process = subprocess.Popen(
+            ["mongod", "--dbpath", self.dbpath, "--port", str(self.port), "--bind_ip", "127.0.0.1", "--quiet"],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", self.port), timeout=1).close()
+                break
+            except OSError:
+                if self.process.poll() is not None or time.monotonic() > deadline:
+                    raise SystemExit("mongod did not start")
+                time.sleep(0.2)
+        os.environ["MONGO_DETAILS"] = "mongodb://127.0.0.1:{}".format(self.port)
+        os.environ["MONGO_DATABASE"] = "bench"
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait(30)
+        shutil.rmtree(self.dbpath, ignore_errors=True)
+
+
+def use_mongomock():
+    try:
+        import mongomock_motor
+    except ImportError:
+        raise SystemExit("no mongod on PATH and mongomock-motor is not installed "
+                         "(pip install -r benchmarks/requirements.txt)")
+    import motor.motor_asyncio
+    motor.motor_asyncio.AsyncIOMotorClient = mongomock_motor.AsyncMongoMockClient
+
+
+# uvicorn runs on its own thread and event loop, so the load generator does not
+# share a loop with the server (it still shares the GIL; see --url).
+def start_app(port: int):
+    import uvicorn
+    # Every virtual user comes from 127.0.0.1 and may share one account, so
+    # per-client rate limits would measure the limiter; lift them unless set.
+    for name in ("RATE_LIMIT_DEFAULT", "RATE_LIMIT_LOGIN", "RATE_LIMIT_LISTING", "RATE_LIMIT_BULK"):
+        os.environ.setdefault(name, "1000000/1000000")
+    sys.path.insert(0, APP_DIR)
+    from server.app import app
+
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    server.install_signal_handlers = lambda: None
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    deadline = time.monotonic() + 30
+    while not server.started:
+        if not thread.is_alive() or time.monotonic() > deadline:
+            raise SystemExit("the app did not start")
+        time.sleep(0.05)
+    return server, thread
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(Counter)
+
+    async def call(self, client, name: str, method: str, path: str, **kwargs):
+        (status, _, body), elapsed = await timed(client.request(method, path, **kwargs))
+        self.latencies[name].append(elapsed)
+        self.statuses[name][status] += 1
+        return status, body
+
+
+async def login(client, recorder, username: str = USERNAME, password: str = PASSWORD) -> dict:
+    status, body = await recorder.call(
+        client, "POST /token", "POST", "/token", form={"username": username, "password": password})
+    if status != 200:
+        raise SystemExit("login as {} failed: {} {}".format(username, status, body[:200]))
+    return {"Authorization": "Bearer " + json.loads(body)["access_token"]}
+
+
+async def seed_request(client, method: str, path: str, **kwargs):
+    while True:
+        status, headers, body = await client.request(method, path, **kwargs)
+        if status != 429:
+            return status, headers, body
+        await asyncio.sleep(float(headers.get("retry-after", 1)))
+
+
+async def seed(url: str, args, rng) -> dict:
+    client, recorder = HttpClient(url), Recorder()
+    usernames = [USERNAME] + ["user{}".format(i) for i in range(1, args.users)]
+    for i, username in enumerate(usernames):
+        await seed_request(client, "POST", "/user", json_body={
+            "username": username, "first_name": "Bench", "last_name": "User {}".format(i),
+            "email": "{}@example.com".format(username), "password": PASSWORD,
+            "national_id": "{:010d}".format(i),
+        })
+    # Sessions log in as any seeded user the server accepts.
+    usernames = [
+        username for username in usernames
+        if (await seed_request(client, "POST", "/token", form={"username": username, "password": PASSWORD}))[0] == 200
+    ]
+    headers = await login(client, recorder)
+    product_ids = []
+    for start in range(0, args.products, SEED_BATCH):
+        batch = [
+            {"name": "product {:06d}".format(i), "description": "benchmark product", "price": rng.randint(1, 10 ** 6)}
+            for i in range(start, min(args.products, start + SEED_BATCH))
+        ]
+        _, _, body = await seed_request(client, "POST", "/product/bulk", headers=headers, json_body=batch)
+        product_ids += [result["id"] for result in json.loads(body)["data"][0] if not result["error"]]
+    for start in range(0, args.baskets, SEED_BATCH):
+        batch = [
+            {
+                "items": [{"product_id": id, "quantity": rng.randint(1, 3)}
+                          for id in rng.sample(product_ids, min(len(product_ids), rng.randint(1, 5)))],
+                "status": rng.choice(["received", "processing", "delivered"]),
+            }
+            for _ in range(start, min(args.baskets, start + SEED_BATCH))
+        ]
+        await seed_request(client, "POST", "/basket/bulk", headers=headers, json_body=batch)
+    await client.close()
+    return {"usernames": usernames, "product_ids": product_ids}
+
+
+# One virtual user. Actions are picked with fixed weights from a seeded random
+# generator, so the same arguments replay the same request mix.
+class Session:
+    def __init__(self, url: str, recorder: Recorder, seeded: dict, rng):
+        self.client = HttpClient(url)
+        self.recorder = recorder
+        self.seeded = seeded
+        self.rng = rng
+        self.headers = None
+        self.baskets = []
+
+    async def call(self, name: str, method: str, path: str, **kwargs):
+        return await self.recorder.call(self.client, name, method, path, headers=self.headers, **kwargs)
+
+    async def login(self):
+        username = self.rng.choice(self.seeded["usernames"])
+        self.headers = await login(self.client, self.recorder, username)
+
+    async def browse(self):
+        sort = self.rng.choice(["", "&sort=price", "&sort=-price", "&sort=name"])
+        status, body = await self.call("GET /product", "GET", "/product?limit=20" + sort)
+        next_after = json.loads(body).get("next_after") if status == 200 else None
+        if next_after and self.rng.random() < 0.5:
+            await self.call("GET /product", "GET", "/product?limit=20{}&after={}".format(sort, next_after))
+
+    async def view_product(self):
+        id = self.rng.choice(self.seeded["product_ids"])
+        await self.call("GET /product/{id}", "GET", "/product/{}".format(id))
+
+    async def build_basket(self):
+        status, body = await self.call("POST /basket", "POST", "/basket", json_body={"items": [], "status": "received"})
+        if status != 200:
+            return
+        id = json.loads(body)["data"][0]["id"]
+        for product_id in self.rng.sample(self.seeded["product_ids"], self.rng.randint(1, 5)):
+            await self.call("POST /basket/{id}/items", "POST", "/basket/{}/items".format(id),
+                            json_body={"product_id": product_id, "quantity": self.rng.randint(1, 3)})
+        await self.call("GET /basket/{id}", "GET", "/basket/{}?expand=true".format(id))
+        self.baskets.append([id, "received"])
+
+    async def checkout(self):
+        if not self.baskets:
+            return await self.build_basket()
+        basket = self.baskets[0]
+        basket[1] = "processing" if basket[1] == "received" else "delivered"
+        await self.call("PUT /basket/{id}", "PUT", "/basket/{}".format(basket[0]), json_body={"status": basket[1]})
+        if basket[1] == "delivered":
+            self.baskets.pop(0)
+
+    async def list_baskets(self):
+        await self.call("GET /basket", "GET", "/basket?status=received&limit=20")
+
+    ACTIONS = (("login", 1), ("browse", 5), ("view_product", 5), ("build_basket", 2), ("checkout", 2),
+               ("list_baskets", 1))
+
+    async def run(self, deadline: float):
+        names, weights = zip(*self.ACTIONS)
+        await self.login()
+        while time.perf_counter() < deadline:
+            await getattr(self, self.rng.choices(names, weights)[0])()
+        await self.client.close()
+
+
+async def workload(url: str, seeded: dict, args, seconds: float, recorder: Recorder) -> float:
+    started = time.perf_counter()
+    deadline = started + seconds
+    sessions = [Session(url, recorder, seeded, random.Random(args.seed + i)) for i in range(args.clients)]
+    await asyncio.gather(*(session.run(deadline) for session in sessions))
+    return time.perf_counter() - started
+
+
+def report(recorder: Recorder, elapsed: float) -> dict:
+    endpoints = {
+        name: dict(summarize(latencies, elapsed), statuses={str(k): v for k, v in sorted(recorder.statuses[name].items())})
+        for name, latencies in sorted(recorder.latencies.items())
+    }
+    everything = [latency for latencies in recorder.latencies.values() for latency in latencies]
+    return {"total": summarize(everything, elapsed), "endpoints": endpoints}
+
+
+def print_table(results: dict, baseline: dict = None):
+    rows = [("total", results["total"])] + list(results["endpoints"].items())
+    print("{:<28} {:>8} {:>9} {:>9} {:>9} {:>9}".format("endpoint", "count", "rps", "p50 ms", "p95 ms", "p99 ms"))
+    for name, summary in rows:
+        line = "{:<28} {:>8} {:>9} {:>9} {:>9} {:>9}".format(
+            name, summary["count"], summary.get("throughput_rps", ""), summary["p50_ms"], summary["p95_ms"],
+            summary["p99_ms"])
+        old = baseline and (baseline["total"] if name == "total" else baseline["endpoints"].get(name))
+        if old:
+            line += "   rps {:+.0%}  p99 {:+.0%}".format(
+                summary["throughput_rps"] / old["throughput_rps"] - 1 if old.get("throughput_rps") else 0,
+                summary["p99_ms"] / old["p99_ms"] - 1 if old["p99_ms"] else 0)
+        print(line)
+
+
+def save(results: dict, label: str = None) -> str:
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    name = results["revision"] + ("-" + label if label else "")
+    path = os.path.join(RESULTS_DIR, name + ".json")
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2)
+    return path
+
+
+# The app serves requests before its indexes exist; /ready says when they do.
+async def wait_ready(url: str, timeout: float = 60):
+    client = HttpClient(url)
+    deadline = time.monotonic() + timeout
+    while (await client.request("GET", "/ready"))[0] == 503:
+        if time.monotonic() > deadline:
+            raise SystemExit("the app did not become ready")
+        await asyncio.sleep(0.1)
+    await client.close()
+
+
+async def run(url: str, args) -> dict:
+    await wait_ready(url)
+    rng = random.Random(args.seed)
+    seeded = await seed(url, args, rng)
+    if args.warmup:
+        await workload(url, seeded, args, args.warmup, Recorder())
+    recorder = Recorder()
+    elapsed = await workload(url, seeded, args, args.seconds, recorder)
+    return report(recorder, elapsed)
+
+
+def main(args):
+    backend, mongod, server = "url", None, None
+    if not args.url:
+        backend = args.backend
+        if backend == "auto":
+            backend = "mongod" if shutil.which("mongod") else "mongomock"
+        if backend == "mongod":
+            mongod = Mongod()
+        else:
+            use_mongomock()
+        port = free_port()
+        server, thread = start_app(port)
+        url = "http://127.0.0.1:{}".format(port)
+    else:
+        url = args.url
+    try:
+        results = asyncio.run(run(url, args))
+    finally:
+        if server is not None:
+            server.should_exit = True
+            thread.join(10)
+        if mongod is not None:
+            mongod.stop()
+    revision, dirty = git_revision()
+    results = {
+        "revision": revision + ("-dirty" if dirty else ""),
+        "label": args.label,
+        "backend": backend,
+        "started_at": datetime.utcnow().isoformat(),
+        "python": platform.python_version(),
+        "config": {k: v for k, v in vars(args).items() if k not in ("compare", "no_save")},
+        **results,
+    }
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_table(results, baseline)
+    if not args.no_save:
+        print("results written to", save(results, args.label))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", help="benchmark a running server instead of booting one")
+    parser.add_argument("--backend", choices=["auto", "mongod", "mongomock"], default="auto")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--products", type=int, default=2000)
+    parser.add_argument("--baskets", type=int, default=1000)
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--seconds", type=float, default=20)
+    parser.add_argument("--warmup", type=float, default=2)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--label", help="suffix for the results file, e.g. the change being measured")
+    parser.add_argument("--compare", help="an earlier results file to compare against")
+    parser.add_argument("--no-save", action="store_true")
+    main(parser.parse_args())
@@ -0,0 +1,80 @@
+# p99 latency of GET /product while /token is saturated with bcrypt logins.
+#
+# Start the API (cd app && python main.py), create the user with POST /user,
+# then:
+#
+#     python benchmarks/login_storm.py --url http://localhost:8000 \
+#         --username johndoe --password secret --logins 64 --seconds 10
+#
+# The script measures GET /product alone, then again while `--logins` clients
+# post to /token in a loop, and prints both summaries. With hashing on the
+# event loop the second p99 grows by the bcrypt cost times the queue depth.
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+from common import HttpClient, summarize, timed  # noqa: E402
+
+
+async def login(client, username, password):
+    status, _, body = await client.request("POST", "/token", form={"username": username, "password": password})
+    if status != 200:
+        raise SystemExit("login failed: {} {}".format(status, body[:200]))
+    return json.loads(body)["access_token"]
+
+
+async def browse(url, token, seconds):
+    client = HttpClient(url)
+    headers = {"Authorization": "Bearer " + token}
+    latencies = []
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        (status, _, _), elapsed = await timed(client.request("GET", "/product?limit=20", headers=headers))
+        latencies.append(elapsed)
+    await client.close()
+    return latencies
+
+
+async def storm(url, username, password, stop):
+    client = HttpClient(url)
+    statuses = {}
+    while not stop.is_set():
+        status, _, _ = await client.request("POST", "/token", form={"username": username, "password": password})
+        statuses[status] = statuses.get(status, 0) + 1
+    await client.close()
+    return statuses
+
+
+async def run(args):
+    client = HttpClient(args.url)
+    token = await login(client, args.username, args.password)
+    await client.close()
+
+    idle = await browse(args.url, token, args.seconds)
+    print("GET /product idle        ", summarize(idle, args.seconds))
+
+    stop = asyncio.Event()
+    logins = [asyncio.ensure_future(storm(args.url, args.username, args.password, stop)) for _ in range(args.logins)]
+    loaded = await browse(args.url, token, args.seconds)
+    stop.set()
+    statuses = {}
+    for result in await asyncio.gather(*logins):
+        for status, count in result.items():
+            statuses[status] = statuses.get(status, 0) + count
+    print("GET /product during storm", summarize(loaded, args.seconds))
+    print("/token responses         ", statuses)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--username", default="johndoe")
+    parser.add_argument("--password", default="secret")
+    parser.add_argument("--logins", type=int, default=64)
+    parser.add_argument("--seconds", type=float, default=10)
+    asyncio.run(run(parser.parse_args()))
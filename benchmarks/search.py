@@ -0,0 +1,119 @@
+# Latency of the product search index (server/search.py) on a large catalog.
+#
+# No server or database is needed; a synthetic catalog is generated with a
+# Zipf-distributed vocabulary (a few very common words, a long tail of rare
+# ones), indexed, and queried in-process with
+#   - word      one whole word, drawn from the catalog's own word frequencies,
+#   - two       two whole words from the same product,
+#   - prefix    the first 2-5 characters of a word (autocomplete),
+#   - typo      a word with one character dropped, swapped or replaced,
+# and the cost of re-indexing a product (what every product write pays).
+#
+#     python benchmarks/search.py --products 500000
+import argparse
+import json
+import os
+import random
+import resource
+import string
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+from common import summarize  # noqa: E402
+from server.search import SearchIndex  # noqa: E402
+
+
+def vocabulary(rng, size: int) -> list:
+    words = set()
+    while len(words) < size:
+        words.add("".join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(4, 10))))
+    return sorted(words)
+
+
+def catalog(rng, words: list, count: int):
+    weights = [1 / rank for rank in range(1, len(words) + 1)]
+    cumulative, total = [], 0.0
+    for weight in weights:
+        total += weight
+        cumulative.append(total)
+    for i in range(count):
+        drawn = rng.choices(words, cum_weights=cumulative, k=15)
+        yield "p{}".format(i), {"name": " ".join(drawn[:3]), "description": " ".join(drawn[3:])}
+
+
+def typo(rng, word: str) -> str:
+    i = rng.randrange(len(word) - 1)
+    kind = rng.randrange(3)
+    if kind == 0:
+        return word[:i] + word[i + 1:]
+    if kind == 1:
+        return word[:i] + word[i + 1] + word[i] + word[i + 2:]
+    return word[:i] + rng.choice(string.ascii_lowercase) + word[i + 1:]
+
+
+def measure(index: SearchIndex, queries: list, limit: int) -> dict:
+    latencies, hits = [], 0
+    for query in queries:
+        started = time.perf_counter()
+        results, total, _ = index.search(query, limit)
+        latencies.append(time.perf_counter() - started)
+        hits += bool(total)
+    summary = summarize(latencies)
+    summary["with_results"] = round(hits / len(queries), 3)
+    return summary
+
+
+def main(args):
+    rng = random.Random(args.seed)
+    words = vocabulary(rng, args.vocabulary)
+    index = SearchIndex()
+    documents = []
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.perf_counter()
+    for id, document in catalog(rng, words, args.products):
+        index.add(id, document)
+        if len(documents) < 10000:
+            documents.append(document)
+    for _ in index.warm():
+        pass
+    index.finish_build()
+    build_seconds = time.perf_counter() - started
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    sample = [rng.choice(documents) for _ in range(args.queries)]
+    queries = {
+        "word": [rng.choice(document["description"].split()) for document in sample],
+        "two": [" ".join(rng.sample(document["name"].split(), 2)) for document in sample],
+        "prefix": [rng.choice(document["name"].split())[:rng.randint(2, 5)] for document in sample],
+        "typo": [typo(rng, rng.choice(document["name"].split())) for document in sample],
+    }
+    results = {name: measure(index, batch, args.limit) for name, batch in queries.items()}
+
+    latencies = []
+    for i in range(min(args.queries, 1000)):
+        id, document = "p{}".format(rng.randrange(args.products)), rng.choice(documents)
+        started = time.perf_counter()
+        index.add(id, document)
+        latencies.append(time.perf_counter() - started)
+    results["reindex"] = summarize(latencies)
+
+    print(json.dumps({
+        "products": args.products,
+        "index": dict(index.stats(), build_seconds=round(build_seconds, 1),
+                      # ru_maxrss is in KiB on Linux.
+                      rss_growth_mib=round((rss_after - rss_before) / 1024)),
+        "results": results,
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--products", type=int, default=500000)
+    parser.add_argument("--vocabulary", type=int, default=50000)
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--limit", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=1)
+    main(parser.parse_args())
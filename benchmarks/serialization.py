@@ -0,0 +1,88 @@
+# Serialization cost of a listing response at 1k, 10k and 100k documents.
+#
+# No server or database is needed; documents are generated the way the driver
+# returns them (ObjectId `_id`, nested line items) and run through
+#   - default   basket_helper() per document, ResponseModel, jsonable_encoder
+#               and JSONResponse, as a plain listing does,
+#   - fast      raw_document() in place and FastJSONResponse, as `fast=true`.
+#
+#     python benchmarks/serialization.py
+import argparse
+import copy
+import json
+import os
+import sys
+import time
+from datetime import datetime
+
+from bson.objectid import ObjectId
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+from server.database import basket_helper  # noqa: E402
+from server.models.basket import ResponseModel  # noqa: E402
+from server.responses import FastJSONResponse, orjson, raw_document  # noqa: E402
+
+SIZES = (1000, 10000, 100000)
+
+
+def documents(count: int) -> list:
+    created = datetime(2022, 1, 1).isoformat()
+    return [
+        {
+            "_id": ObjectId(),
+            "items": [{"product_id": str(ObjectId()), "quantity": i % 5 + 1} for i in range(3)],
+            "created_at": created,
+            "updated_at": created,
+            "status": "received",
+            "version": 1,
+        }
+        for _ in range(count)
+    ]
+
+
+def default_path(docs: list) -> bytes:
+    data = [basket_helper(doc) for doc in docs]
+    return JSONResponse(jsonable_encoder(ResponseModel(data, "baskets data retrieved successfully"))).body
+
+
+def fast_path(docs: list) -> bytes:
+    for doc in docs:
+        raw_document(doc)
+    return FastJSONResponse({"data": docs, "code": 200, "message": "baskets data retrieved successfully"}).body
+
+
+def measure(path, source: list, repeat: int) -> dict:
+    timings, size = [], 0
+    for _ in range(repeat):
+        # The fast path converts in place, so every run gets fresh documents.
+        docs = copy.deepcopy(source)
+        started = time.perf_counter()
+        size = len(path(docs))
+        timings.append(time.perf_counter() - started)
+    best = min(timings)
+    return {"best_ms": round(best * 1000, 2), "docs_per_sec": int(len(source) / best), "bytes": size}
+
+
+def main(args):
+    results = []
+    for size in SIZES:
+        source = documents(size)
+        repeat = max(1, args.repeat * 1000 // size)
+        default = measure(default_path, source, repeat)
+        fast = measure(fast_path, source, repeat)
+        results.append({
+            "documents": size,
+            "default": default,
+            "fast": fast,
+            "speedup": round(default["best_ms"] / fast["best_ms"], 1),
+        })
+    print(json.dumps({"orjson": orjson is not None, "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=10, help="runs at 1k documents, scaled down for larger sizes")
+    main(parser.parse_args())